@@ -0,0 +1,88 @@
+import time
+import logging
+import bisect
+import urllib.request
+import urllib.parse
+from obspy import UTCDateTime as UTC
+from rfsks_support.telemetry import telemetry, request_status
+
+## fdsnws-availability query returning the continuous time spans of the channels
+AVAILABILITY_PATH = "/fdsnws/availability/1/query"
+
+
+def query_availability(client,net,stn,starttime,endtime,channels="BHE,BHN,BHZ",timeout=None):
+    '''
+    Continuous time spans (loc, cha, start, end) of the station channels between starttime and endtime,
+    from the availability of a local source or the fdsnws-availability service of an FDSN client.
+    Returns [] if the service has no data for the channels (HTTP 204), None if the availability is unknown
+    (no such service, HTTP 404 of the datacenters without it, or any other error)
+    '''
+    logger = logging.getLogger(__name__)
+    if hasattr(client,'get_availability'):
+        return client.get_availability(net,stn,starttime,endtime,channels=channels)
+    base_url = getattr(client,'base_url',None)
+    if not base_url:
+        return None
+    params = {'net':net,'sta':stn,'cha':channels,'starttime':str(UTC(starttime))[:19],'endtime':str(UTC(endtime))[:19],
+                'format':'text','merge':'samplerate,quality','mergegaps':'1.0','nodata':'204'}
+    url = base_url+AVAILABILITY_PATH+"?"+urllib.parse.urlencode(params)
+    datacenter = getattr(client,'datacenter',base_url)
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(url,timeout=timeout) as response:
+            status = response.status
+            data = response.read()
+    except Exception as exception:
+        telemetry.record(datacenter,'availability',time.monotonic()-start,0,request_status(exception))
+        logger.debug(f"No availability service for {base_url}: {exception}")
+        return None
+    telemetry.record(datacenter,'availability',time.monotonic()-start,len(data),str(status))
+    if status == 204:
+        return []
+    return parse_availability(data.decode('utf-8'))
+
+
+def parse_availability(text):
+    '''
+    Spans of the fdsnws-availability text format (Network Station Location Channel [Quality SampleRate] Earliest Latest)
+    '''
+    spans = []
+    for line in text.splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        cols = line.split()
+        try:
+            loc = "" if cols[2] == "--" else cols[2]
+            spans.append((loc,cols[3],UTC(cols[-2]).timestamp,UTC(cols[-1]).timestamp))
+        except Exception:
+            continue
+    return spans
+
+
+def availability_index(spans):
+    '''
+    Sorted start and end times of the spans of each (loc, cha)
+    '''
+    index = {}
+    for loc,cha,start,end in sorted(spans):
+        starts, ends = index.setdefault((loc,cha),([],[]))
+        starts.append(start)
+        ends.append(end)
+    return index
+
+
+def covered(index,loc,cha,t1,t2):
+    starts, ends = index.get((loc,cha),([],[]))
+    i = bisect.bisect_right(starts,t1)-1
+    ## the spans are merged: t1-t2 is covered if the last span starting before t1 lasts until t2
+    return i >= 0 and ends[i] >= t2
+
+
+def window_available(index,win,locations=[""],cha="BHE,BHN,BHZ"):
+    '''
+    True if, for one of the locations, each channel of the window has a continuous span covering it
+    (index is the availability_index of the station spans)
+    '''
+    t1, t2 = UTC(win['t1']).timestamp, UTC(win['t2']).timestamp
+    channels = [ch.strip() for ch in win.get('cha',cha).split(",")]
+    return any(all(covered(index,loc,ch,t1,t2) for ch in channels) for loc in locations)
@@ -0,0 +1,135 @@
+import logging
+import time
+from rfsks_support.fdsn_clients import get_client
+from rfsks_support.rfsks_extras import process_waveform, location_list
+from rfsks_support.other_support import RequestTimeout, timed_call
+
+
+def plan_bulk_requests(windows, group_by='station', max_size=50):
+    '''
+    Group the event windows (see rfsks_extras.event_window) by station or by event
+    and split each group in chunks of at most max_size windows (one bulk request per chunk).
+    The windows of an event are grouped per network, as the clients of a request are ordered per network
+    '''
+    groups = {}
+    for win in windows:
+        if group_by == 'event':
+            key = (str(win['evtime']),win['net'])
+        else:
+            key = (win['net'],win['stn'])
+        groups.setdefault(key,[]).append(win)
+    max_size = max(1,int(max_size))
+    chunks = []
+    for group in groups.values():
+        for i in range(0,len(group),max_size):
+            chunks.append(group[i:i+max_size])
+    return chunks
+
+
+def bulk_lines(windows, loc="", cha="BHE,BHN,BHZ"):
+    '''
+    FDSN dataselect bulk lines for the windows, one line per channel
+    (the channels selected for the window in win['cha'], if any). The windows whose channels
+    only exist at other locations (win['locations']) are left out
+    '''
+    lines = []
+    for win in windows:
+        if loc not in win.get('locations',[loc]):
+            continue
+        for ch in win.get('cha',cha).split(","):
+            lines.append((win['net'],win['stn'],loc if loc else "--",ch.strip(),win['t1'],win['t2']))
+    return lines
+
+
+def split_bulk_stream(st, win):
+    '''
+    Extract the raw traces of one window from the stream returned by a bulk request
+    '''
+    return st.select(network=win['net'],station=win['stn']).slice(win['t1'],win['t2']).copy()
+
+
+def bulk_download(client, windows, locations=[""], cha="BHE,BHN,BHZ", client_slots=None, timeouts=None, attempts=None, cache=None, single_request=False):
+    '''
+    Download the windows with get_waveforms_bulk, trying the clients and locations in order
+    for the windows not yet retrieved.
+    timeouts is the same dict as in multi_download; the 'event' budget of each window requested bounds
+    a bulk request (a request of n windows gets n times the budget of one event)
+    and a datacenter exceeding it is skipped for the remaining locations.
+    attempts is a dict filled with the list of attempts of each window (keyed by id(window)),
+    the latency of a bulk request being shared between its windows.
+    The windows found in the WaveformCache cache (if any) are not requested, and the retrieved ones are stored in it.
+    With single_request, the lines of all the locations are sent in one request per client and the first complete
+    3C set in the locations order is kept for each window.
+    Returns a list of (window, stream or False, client name)
+    '''
+    logger = logging.getLogger(__name__)
+    client_slots = client_slots if client_slots is not None else {}
+    timeouts = timeouts if timeouts is not None else {}
+    attempts = attempts if attempts is not None else {}
+    attach_response = any(win['phase']=='SKS' for win in windows)
+    done = []
+    remaining = []
+    for win in windows:
+        strm = False
+        if cache is not None:
+            for loc in win.get('locations',locations):
+                st = cache.get(win['net'],win['stn'],loc,win.get('cha',cha),win['t1'],win['t2'])
+                if st is not None:
+                    strm = process_waveform(st,stats_dict=dict(win['stats']),pharr=win['pharr'],phasenm=win['phase'])
+                    attempts.setdefault(id(win),[]).append({'client':client[0],'location':loc,'status':'ok' if strm else 'nodata','nbytes':0,'latency':0.0,'message':'cache'})
+                    if strm:
+                        break
+        if strm:
+            done.append((win,strm,client[0]))
+        else:
+            remaining.append(win)
+    location_sets = [list(locations)] if single_request else [[loc] for loc in locations]
+    for cl in client:
+        for locs in location_sets:
+            if not remaining:
+                break
+            loc = location_list(locs) if len(locs)>1 else locs[0]
+            ## the windows whose channels exist at one of these locations
+            requested = [win for win in remaining if any(location in win.get('locations',locs) for location in locs)]
+            if not requested:
+                continue
+            tstart = time.monotonic()
+            try:
+                client_local = get_client(cl,timeout=timeouts.get('read'),connect_timeout=timeouts.get('connect'))
+                lines = [line for location in locs for line in bulk_lines(requested,loc=location,cha=cha)]
+                budget = timeouts['event']*len(requested) if timeouts.get('event') else None
+                st = timed_call(budget,client_local.get_waveforms_bulk,lines,attach_response=attach_response,slot=client_slots.get(cl))
+            except RequestTimeout as exception:
+                logger.warning(f"Bulk request of {len(requested)} windows timed out for {cl}: {exception}")
+                latency = (time.monotonic()-tstart)/len(requested)
+                for win in requested:
+                    attempts.setdefault(id(win),[]).append({'client':cl,'location':loc,'status':'timeout','nbytes':0,'latency':latency,'message':str(exception)})
+                break
+            except Exception as exception:
+                logger.debug(f"Bulk request of {len(requested)} windows failed for {cl}: {exception}")
+                latency = (time.monotonic()-tstart)/len(requested)
+                for win in requested:
+                    attempts.setdefault(id(win),[]).append({'client':cl,'location':loc,'status':'nodata','nbytes':0,'latency':latency,'message':str(exception).split("\n")[0]})
+                continue
+            latency = (time.monotonic()-tstart)/len(requested)
+            retrieved = set()
+            for win in requested:
+                raw = split_bulk_stream(st,win)
+                nbytes = sum(tr.data.nbytes for tr in raw)
+                strm, chosen = False, loc
+                for location in locs:
+                    sub = raw.select(location=location) if len(locs)>1 else raw
+                    if cache is not None and len(sub):
+                        try:
+                            cache.put(win['net'],win['stn'],location,win.get('cha',cha),win['t1'],win['t2'],sub)
+                        except Exception as exception:
+                            logger.warning(f"Could not cache {win['net']}-{win['stn']} {win['evtime']}: {exception}")
+                    if not strm and len(sub):
+                        strm = process_waveform(sub.copy(),stats_dict=dict(win['stats']),pharr=win['pharr'],phasenm=win['phase'])
+                        chosen = location if strm else loc
+                attempts.setdefault(id(win),[]).append({'client':cl,'location':chosen,'status':'ok' if strm else 'nodata','nbytes':nbytes,'latency':latency,'message':''})
+                if strm:
+                    done.append((win,strm,cl))
+                    retrieved.add(id(win))
+            remaining = [win for win in remaining if id(win) not in retrieved]
+    return done + [(win,False,None) for win in remaining]
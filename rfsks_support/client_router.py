@@ -0,0 +1,101 @@
+import threading
+import logging
+
+
+class ClientRouter:
+    '''
+    Order the datacenters of a request from their observed performance.
+    Keeps per-datacenter success/timeout counts and latency, and the datacenter that actually serves
+    each network. A datacenter is skipped for a network already served elsewhere once it missed it
+    max_misses times, and for all networks when its success rate stays below min_success
+    after min_requests requests. At least one datacenter is always returned.
+    '''
+    def __init__(self,clients,max_misses=3,min_success=0.02,min_requests=50):
+        self.logger = logging.getLogger(__name__)
+        self.clients = list(clients)
+        self.max_misses = max_misses
+        self.min_success = min_success
+        self.min_requests = min_requests
+        self.lock = threading.Lock()
+        self.stats = {cl: {'ok':0,'nodata':0,'timeout':0,'latency':0.0} for cl in self.clients}
+        self.network_client = {}
+        self.network_misses = {}
+
+    def record(self,net,attempts):
+        '''
+        Update the statistics with the attempts (dicts with client, status and latency) made for a network
+        '''
+        with self.lock:
+            for att in attempts:
+                cl = att.get('client')
+                if cl not in self.stats or att.get('message') == 'cache' or att.get('status') == 'unavailable':
+                    continue
+                status = att.get('status')
+                key = status if status in ('ok','timeout') else 'nodata'
+                self.stats[cl][key] += 1
+                self.stats[cl]['latency'] += float(att.get('latency',0))
+                if status == 'ok':
+                    self.network_client.setdefault(net,cl)
+                    self.network_misses[(net,cl)] = 0
+                else:
+                    self.network_misses[(net,cl)] = self.network_misses.get((net,cl),0)+1
+
+    def load_history(self,rows):
+        '''
+        Initialise the statistics from the ledger history: rows of (net, client, status, count, total latency)
+        '''
+        with self.lock:
+            for net,cl,status,count,latency in rows:
+                if cl not in self.stats:
+                    continue
+                key = status if status in ('ok','timeout') else 'nodata'
+                self.stats[cl][key] += int(count)
+                self.stats[cl]['latency'] += float(latency or 0)
+                if status == 'ok':
+                    self.network_client.setdefault(net,cl)
+                else:
+                    self.network_misses[(net,cl)] = self.network_misses.get((net,cl),0)+int(count)
+            ## misses only count for the datacenters not serving the network
+            for (net,cl) in list(self.network_misses):
+                if self.network_client.get(net) == cl:
+                    self.network_misses[(net,cl)] = 0
+
+    def record_network(self,net,cl):
+        '''
+        Remember that the datacenter cl serves the network (e.g. from its inventory)
+        '''
+        with self.lock:
+            self.network_client.setdefault(net,cl)
+
+    def success_rate(self,cl):
+        st = self.stats[cl]
+        total = st['ok']+st['nodata']+st['timeout']
+        return (st['ok']/total if total else 1.0), total
+
+    def mean_latency(self,cl):
+        st = self.stats[cl]
+        total = st['ok']+st['nodata']+st['timeout']
+        return st['latency']/total if total else 0.0
+
+    def order(self,net):
+        '''
+        Datacenters to try for a network, best first
+        '''
+        with self.lock:
+            served_by = self.network_client.get(net)
+            candidates = []
+            for idx,cl in enumerate(self.clients):
+                rate, total = self.success_rate(cl)
+                if cl != served_by:
+                    if served_by is not None and self.network_misses.get((net,cl),0) >= self.max_misses:
+                        continue
+                    if total >= self.min_requests and rate < self.min_success:
+                        continue
+                candidates.append((cl != served_by, -round(rate,1), self.mean_latency(cl), idx, cl))
+            if not candidates:
+                return list(self.clients)
+            return [cand[-1] for cand in sorted(candidates)]
+
+    def summary(self):
+        with self.lock:
+            return {cl: dict(st, success_rate=self.success_rate(cl)[0], mean_latency=self.mean_latency(cl)) for cl,st in self.stats.items()}
@@ -0,0 +1,127 @@
+'''
+Offline benchmark of the download engine (get_stnxml, obtain_events, download_data) against a local FDSN stand-in.
+Run from the project directory (the Settings are read from Settings/*.yaml), e.g.
+
+    python -m rfsks_support.download_benchmark --stations 20 --events 300 --latency 0.2 --failure-rate 0.05 --workers 8
+
+Synthetic inventory, catalog and waveforms are served unless --inventory, --catalog and --waveforms
+(a "MSEED:/path" or "SDS:/path" source) give recorded ones.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import threading
+import argparse
+import tempfile
+from obspy import read_inventory, read_events
+from obspy.clients.fdsn import Client
+from rfsks_support.fdsn_standin import StandinServer, StandinData, synthetic_inventory, synthetic_catalog
+from rfsks_support.fdsn_clients import register_client, clear_clients
+from rfsks_support.local_sources import LocalWaveformClient
+from rfsks_support.telemetry import telemetry
+from rfsks_support.download_ledger import OK
+import rfsks_support.other_support as oss
+
+## name of the stand-in datacenter, also the only catalog provider of the benchmark
+STANDIN = 'STANDIN'
+
+
+def total_requests():
+    return sum(row['requests'] for row in telemetry.snapshot())
+
+
+def run_benchmark(workdir,data,method='RF',latency=0.0,jitter=0.0,failure_rate=0.0,timeout_rate=0.0,nodata_rate=0.0,hang=30.0,
+                    max_workers=4,max_per_client=4,bulk_group='none',read_timeout=30,minmagnitude=5.5,maxmagnitude=9.5):
+    '''
+    Run the inventory, catalog and waveform stages in workdir against a StandinServer serving data.
+    Returns a dict with the requests, wall time and requests/s of each stage, and events/s of the download
+    '''
+    from rfsks_support.download_large_data import downloadDataclass
+    logger = logging.getLogger(__name__)
+    infodir, datadir, tmpdir = [os.path.join(workdir,name)+'/' for name in ('info','data','tmp')]
+    for folder in (infodir,datadir,tmpdir):
+        os.makedirs(folder,exist_ok=True)
+    lons = [sta.longitude for net in data.inventory for sta in net]
+    lats = [sta.latitude for net in data.inventory for sta in net]
+    results = {'method':method,'stations':len(lons),'events':len(data.events),'latency':latency,'jitter':jitter,'failure_rate':failure_rate,
+                'timeout_rate':timeout_rate,'nodata_rate':nodata_rate,'max_workers':max_workers,'max_per_client':max_per_client,'bulk_group':bulk_group}
+    with StandinServer(data,latency=latency,jitter=jitter,failure_rate=failure_rate,timeout_rate=timeout_rate,nodata_rate=nodata_rate,hang=hang) as server:
+        register_client(STANDIN,Client(server.url,timeout=read_timeout,_discover_services=False))
+        try:
+            dl = downloadDataclass(inventoryfile=infodir+'inventory.xml',client=[STANDIN],minlongitude=min(lons)-1,maxlongitude=max(lons)+1,
+                    minlatitude=min(lats)-1,maxlatitude=max(lats)+1,inventorytxtfile=infodir+'stations.txt',method=method,tmpdir=tmpdir)
+            ## benchmark the requests only: no waveform cache, the given concurrency
+            dl.cache = None
+            dl.catalog_providers = [STANDIN]
+            dl.max_workers, dl.max_per_client, dl.bulk_group = max_workers, max_per_client, bulk_group
+            dl.client_slots = {cl: threading.BoundedSemaphore(max_per_client) for cl in dl.client}
+            dl.timeouts['read'] = read_timeout
+            stages = (('inventory',lambda: dl.get_stnxml()),
+                      ('events',lambda: dl.obtain_events(catalogxmlloc=infodir,minmagnitude=minmagnitude,maxmagnitude=maxmagnitude)),
+                      ('download',lambda: oss.select_to_download_events(infodir,datadir,infodir,dl.inventorytxtfile,dl,minmagnitude,maxmagnitude,
+                            False,False,[""],method=method)))
+            for stage,run in stages:
+                nrequests = total_requests()
+                start = time.monotonic()
+                run()
+                walltime = time.monotonic()-start
+                nrequests = total_requests()-nrequests
+                results[stage] = {'walltime':round(walltime,3),'requests':nrequests,'requests_per_s':round(nrequests/walltime,2) if walltime else None}
+                logger.info(f"{stage}: {nrequests} requests in {walltime:.1f} s")
+            counts = dl.ledger.status_counts(method)
+            results['download']['windows'] = counts
+            results['download']['events_per_s'] = round(counts.get(OK,0)/results['download']['walltime'],2) if results['download']['walltime'] else None
+            results['server'] = {f"{service} {outcome}": count for (service,outcome),count in sorted(server.counts.items())}
+        finally:
+            clear_clients()
+    with open(os.path.join(workdir,'benchmark.json'),'w') as f:
+        json.dump(results,f,indent=1)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the download engine against a local FDSN stand-in")
+    parser.add_argument('--stations',type=int,default=10,help="number of synthetic stations")
+    parser.add_argument('--events',type=int,default=100,help="number of synthetic events")
+    parser.add_argument('--region',type=float,nargs=4,default=(-10,10,-10,10),metavar=('MINLON','MAXLON','MINLAT','MAXLAT'))
+    parser.add_argument('--sampling-rate',type=float,default=40.0)
+    parser.add_argument('--inventory',help="StationXML file served instead of the synthetic inventory")
+    parser.add_argument('--catalog',help="QuakeML file served instead of the synthetic catalog")
+    parser.add_argument('--waveforms',help="MSEED:/path or SDS:/path of the recorded waveforms served instead of synthetic noise")
+    parser.add_argument('--method',default='RF',choices=('RF','SKS'))
+    parser.add_argument('--latency',type=float,default=0.0,help="latency of each request (s)")
+    parser.add_argument('--jitter',type=float,default=0.0,help="uniform random latency added to each request (s)")
+    parser.add_argument('--failure-rate',type=float,default=0.0,help="fraction of the requests answered with HTTP 503")
+    parser.add_argument('--timeout-rate',type=float,default=0.0,help="fraction of the requests stalled for --hang s")
+    parser.add_argument('--nodata-rate',type=float,default=0.0,help="fraction of the waveform requests answered with no data")
+    parser.add_argument('--hang',type=float,default=30.0)
+    parser.add_argument('--read-timeout',type=float,default=10.0)
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--per-client',type=int,default=4)
+    parser.add_argument('--bulk-group',default='none',choices=('none','station','event'))
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--workdir',help="directory of the benchmark project (a temporary directory, removed afterwards, if not given)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    inventory = read_inventory(args.inventory) if args.inventory else synthetic_inventory(args.stations,args.region,sampling_rate=args.sampling_rate,seed=args.seed)
+    catalog = read_events(args.catalog) if args.catalog else synthetic_catalog(args.events,seed=args.seed)
+    waveforms = LocalWaveformClient(args.waveforms) if args.waveforms else None
+    data = StandinData(inventory,catalog,waveforms=waveforms,seed=args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='rfsks-benchmark-')
+    try:
+        results = run_benchmark(workdir,data,method=args.method,latency=args.latency,jitter=args.jitter,failure_rate=args.failure_rate,
+                    timeout_rate=args.timeout_rate,nodata_rate=args.nodata_rate,hang=args.hang,max_workers=args.workers,
+                    max_per_client=args.per_client,bulk_group=args.bulk_group,read_timeout=args.read_timeout)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir,ignore_errors=True)
+    json.dump(results,sys.stdout,indent=1)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,29 @@
-import sys, os, glob, shutil
-from obspy.clients.fdsn import Client
-from rfsks_support.other_support import avg, date2time, write_station_file, Timeout, organize_inventory
-from obspy import read_inventory
+import sys, os, shutil, re, itertools
+import threading, time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from rfsks_support.fdsn_clients import get_client
+from rfsks_support.telemetry import telemetry
+from rfsks_support.other_support import avg, date2time, write_station_file, organize_inventory
 import pandas as pd
 from obspy import UTCDateTime as UTC
 from rf import RFStream
 import numpy as np
-from rfsks_support.rfsks_extras import retrieve_waveform, multi_download
+from rfsks_support.rfsks_extras import multi_download, event_window, order_locations
+from rfsks_support.client_router import ClientRouter
+from rfsks_support.waveform_cache import WaveformCache
+from rfsks_support.download_ledger import DownloadLedger, OK, NODATA, TIMEOUT, ERROR, FAILED, LOWSNR, UNAVAILABLE
+from rfsks_support.quality_gate import window_snr
+from rfsks_support.travel_times import arrivals_for_events
+from rfsks_support.download_planner import DownloadPlan
+from rfsks_support.availability import query_availability, availability_index, window_available
+from rfsks_support.inventory_table import InventoryTable, ChannelSelector, load_inventory_table
+from rfsks_support.inventory_tiles import region_tiles, merge_inventories
+from rfsks_support.event_catalog import regional_catalog, catalog_table, merge_catalogs, assign_events
+from rfsks_support.event_table import EventTable, StationEventIndex, back_azimuths
+from obspy.geodetics import locations2degrees
+from obspy.clients.fdsn.header import FDSNNoDataException
+from rfsks_support.bulk_download import plan_bulk_requests, bulk_download
 from rfsks_support.plotting_map import plot_merc, station_map, events_map
 import logging, yaml
 
@@ -18,13 +35,29 @@ with open('Settings/advRFparam.yaml') as f:
 with open('Settings/advSKSparam.yaml') as f:
     inpSKSdict = yaml.load(f, Loader=yaml.FullLoader)
 
+## Download settings
+with open('Settings/stepwise.yaml') as f:
+    inp_step = yaml.load(f, Loader=yaml.FullLoader)
+
+## minimum time (s) since the last events query of a station epoch before its catalog is updated (incremental mode)
+CATALOG_UPDATE_MIN = 3600
+## number of attempts of a station inventory tile before the inventory is given up
+TILE_ATTEMPTS = 3
+
 class downloadDataclass:
     
-    def __init__(self,inventoryfile,client, minlongitude,maxlongitude,minlatitude,maxlatitude,inventorytxtfile,fig_frmt="png",method='RF',channel = "BHZ,BHE,BHN"):
+    def __init__(self,inventoryfile,client, minlongitude,maxlongitude,minlatitude,maxlatitude,inventorytxtfile,fig_frmt="png",method='RF',channel = "BHZ,BHE,BHN",tmpdir=None,inventory_source=None):
+        '''
+        inventory_source is the downloadDataclass whose inventory and inventory table this one shares
+        (see share_inventory), if any
+        '''
         self.logger = logging.getLogger(__name__)
+        self.tmpdir = tmpdir
         self.inventoryfile = inventoryfile
         self.inventorytxtfile = inventorytxtfile
+        self.inventory_source = inventory_source
         self.inv = None
+        self._inv_table = None
         self.client = []
         if len(client) != 0:
             for cl in client:
@@ -38,6 +71,46 @@ class downloadDataclass:
         self.channel = channel
         self.fig_frmt = fig_frmt
         self.method = method.upper()
+        dl_settings = inp_step.get('download_settings') or {}
+        self.max_workers = max(1,int(dl_settings.get('max_workers',1)))
+        self.max_per_client = max(1,int(dl_settings.get('max_per_client',self.max_workers)))
+        self.bulk_group = str(dl_settings.get('bulk_group','none')).lower()
+        self.bulk_size = int(dl_settings.get('bulk_size',50))
+        self.timeouts = {key: float(dl_settings[f'{key}_timeout']) if dl_settings.get(f'{key}_timeout') else None for key in ('connect','read','event','metadata')}
+        self.h5_flush_every = max(1,int(dl_settings.get('h5_flush_every',10)))
+        self.retry_failed_only = int(dl_settings.get('retry_failed_only',0))
+        self.ledger = DownloadLedger(self.tmpdir+'download_ledger.sqlite' if self.tmpdir else ':memory:')
+        self.router = ClientRouter(self.client)
+        self.adaptive_routing = int(dl_settings.get('adaptive_routing',1))
+        if self.adaptive_routing:
+            self.router.load_history(self.ledger.client_history())
+        self.cache = WaveformCache(dl_settings['waveform_cache'],max_size_gb=dl_settings.get('cache_size_gb',20)) if dl_settings.get('waveform_cache') else None
+        self.inventory_tile_deg = float(dl_settings.get('inventory_tile_deg',20))
+        self.single_location_request = int(dl_settings.get('single_location_request',1))
+        self.location_priority = dl_settings.get('location_priority') or []
+        self.channel_bands = [band.strip() for band in str(dl_settings.get('channel_bands') or '').split(",") if band.strip()]
+        self.min_sampling_rate = float(dl_settings.get('min_sampling_rate',20))
+        self.availability_prefilter = int(dl_settings.get('availability_prefilter',0))
+        self.min_snr = float(dl_settings.get('min_snr',0))
+        self.incremental = int(dl_settings.get('incremental',0))
+        self.catalog_time = None
+        ## events of the project (shared by RF and SKS) and the station -> event index of the method, next to its station list
+        infoloc = os.path.dirname(self.inventorytxtfile)
+        self.eventfile = os.path.join(self.tmpdir or infoloc,'event_table.npz')
+        self.indexfile = StationEventIndex.indexfile(infoloc,self.method)
+        self.event_index = None
+        self.failed_epochs = set()
+        self.dry_run = int(dl_settings.get('dry_run',0))
+        self.catalog_mode = str(dl_settings.get('catalog_mode','station')).lower()
+        self.catalog_chunk_years = float(dl_settings.get('catalog_chunk_years',5))
+        self.catalog_providers = [provider.strip() for provider in str(dl_settings.get('catalog_providers') or 'IRIS').split(",") if provider.strip()]
+        self.catalog_dedup_seconds = float(dl_settings.get('catalog_dedup_seconds',16))
+        self.catalog_dedup_km = float(dl_settings.get('catalog_dedup_km',100))
+        self.traveltime_table = int(dl_settings.get('traveltime_table',1))
+        self.telemetryfile = self.tmpdir+'download_telemetry.json' if self.tmpdir else None
+        telemetry.configure(textfile=dl_settings.get('prometheus_textfile'))
+        self.tabledir = self.tmpdir+'traveltimes/' if self.tmpdir else None
+        self.client_slots = {cl: threading.BoundedSemaphore(self.max_per_client) for cl in self.client}
         try:
             if self.method=='RF':
                 self.minradius,self.maxradius=int(inpRFdict['rf_event_search_settings']['minradiusRF']),int(inpRFdict['rf_event_search_settings']['maxradiusRF'])
@@ -48,51 +121,98 @@ class downloadDataclass:
             self.logger.error(f"Illegal method input {self.method}", exc_info=True)
             sys.exit()
 
+    def record_networks(self,inventory,client_name):
+        '''
+        Remember the datacenter serving each network of the inventory for the waveform requests
+        '''
+        for net in inventory:
+            self.router.record_network(net.code,client_name)
+
+    def request_clients(self,net):
+        '''
+        Datacenters to try for the waveforms of a network: in the configured order,
+        or ordered by their observed performance with adaptive_routing
+        '''
+        if self.adaptive_routing:
+            return self.router.order(net)
+        return self.client
+
     ## Defining get_stnxml
     def get_stnxml(self,network='*', station="*",channel = "BHZ,BHE,BHN"):
         print("\n")
         self.logger.info('Retrieving station information')
-        ninvt=0
-        while ninvt < len(self.client):
+        clients = []
+        for cl in self.client:
             try:
-                client = Client(self.client[ninvt])
+                get_client(cl,timeout=self.timeouts['metadata'],connect_timeout=self.timeouts['connect'],metadata=True)
+                clients.append(cl)
             except Exception as e:
-                self.logger.error(f"No FDSN services could be discovered for {self.client[ninvt]}! Try again after some time.")
-                sys.exit()
-            self.logger.info(f'from {self.client[ninvt]}')
-            try:
-                invt = client.get_stations(network=network, station=station, channel=self.channel, level='channel',minlongitude=self.minlongitude, maxlongitude=self.maxlongitude,minlatitude=self.minlatitude, maxlatitude=self.maxlatitude)
-                inventory = invt
-                break
-            except Exception as exception:
-                self.logger.error(f"No stations found for the given parameters for {self.client[ninvt]}", exc_info=True)
-            ninvt+=1
-            # sys.exit()
-        if len(self.client)>1:
-            for cl in self.client[ninvt+1:]:
-                self.logger.info(f'from {cl}')
+                self.logger.error(f"No FDSN services could be discovered for {cl}! Try again after some time.")
+        if not clients:
+            sys.exit()
+        tiles = region_tiles(self.minlongitude,self.maxlongitude,self.minlatitude,self.maxlatitude,self.inventory_tile_deg)
+        self.logger.info(f"Requesting {len(tiles)} tiles from {', '.join(clients)}")
+
+        def request(cl,tile):
+            minlon,maxlon,minlat,maxlat = tile
+            for attempt in range(TILE_ATTEMPTS):
+                try:
+                    with self.client_slots.get(cl,nullcontext()):
+                        client = get_client(cl,timeout=self.timeouts['metadata'],connect_timeout=self.timeouts['connect'],metadata=True)
+                        return client.get_stations(network=network, station=station, channel=self.inventory_channels(), level='channel',minlongitude=minlon, maxlongitude=maxlon,minlatitude=minlat, maxlatitude=maxlat)
+                except FDSNNoDataException:
+                    ## an empty tile, e.g. outside the inventory.xml of a local source
+                    return None
+                except Exception as exception:
+                    if attempt == TILE_ATTEMPTS-1:
+                        raise
+                    self.logger.debug(f"Requesting again the tile {tile} of {cl}: {exception}")
+                    time.sleep(2**attempt)
+
+        ## tiles and datacenters are requested concurrently, the inventories are merged in the client order
+        results, failed = {}, []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(request,cl,tile): (cl,itile) for cl in clients for itile,tile in enumerate(tiles)}
+            for future in as_completed(futures):
+                cl, itile = futures[future]
                 try:
-                    client = Client(cl)
-                    invt = client.get_stations(network=network, station=station, channel=self.channel, level='channel',minlongitude=self.minlongitude, maxlongitude=self.maxlongitude,minlatitude=self.minlatitude, maxlatitude=self.maxlatitude)
-                    inventory +=invt
+                    invt = future.result()
                 except Exception as exception:
-                    self.logger.warning(f"FDSNNoDataException for {cl}")
-        # self.logger.info(inventory)
+                    self.logger.warning(f"Unable to obtain the stations of {cl} in the tile {tiles[itile]}: {exception}")
+                    failed.append((cl,itile))
+                    continue
+                if invt is not None:
+                    results[(cl,itile)] = invt
+        ## an incomplete inventory is not written, otherwise it would be taken as the complete station list
+        if failed:
+            raise Exception(f"{len(failed)} station inventory tiles could not be obtained; the inventory is not written, try again later")
+        for cl in clients:
+            invts = [results[(cl,itile)] for itile in range(len(tiles)) if (cl,itile) in results]
+            if invts:
+                self.logger.info(f"{sum(len(invt.get_contents()['stations']) for invt in invts)} station epochs from {cl}")
+                for invt in invts:
+                    self.record_networks(invt,cl)
+            else:
+                self.logger.warning(f"FDSNNoDataException for {cl}")
+        inventory = merge_inventories(results[key] for key in sorted(results,key=lambda key: (clients.index(key[0]),key[1])))
+        if not len(inventory.networks):
+            raise Exception(f"No stations found for the given parameters for {', '.join(clients)}")
 
         inventory.write(self.inventoryfile, 'STATIONXML')
         self.inv = inventory
+        self.inv_table = load_inventory_table(self.inventoryfile,inv=inventory)
         inventory.write(self.inventorytxtfile, 'STATIONTXT',level='station')
         organize_inventory(self.inventorytxtfile)
+        self.write_telemetry()
         # self.inventorytxtfile = organize_inventory(self.inventorytxtfile)
         
 
     ## inventory_catalog
-    def obtain_events(self, catalogxmlloc,catalogtxtloc,minmagnitude=5.5,maxmagnitude=9.5):
+    def obtain_events(self,catalogxmlloc,minmagnitude=5.5,maxmagnitude=9.5):
 
         ## Check for the station information
         if os.path.exists(self.inventorytxtfile):
             invent_df = pd.read_csv(self.inventorytxtfile,sep="|",keep_default_na=False, na_values=[""])
-            total_stations = invent_df.shape[0]
             if invent_df.shape[0]==0:
                 self.logger.error("No data available, exiting...")
                 sys.exit()
@@ -100,109 +220,577 @@ class downloadDataclass:
             self.logger.error("No data available, exiting...")
             sys.exit()
 
-
-        tot_evnt_stns = 0
-        if not self.inv:
+        if self.inv_table is None:
             self.logger.info("Reading station inventory to obtain events catalog")
             try:
-                # Read the station inventory
-                self.inv = read_inventory(self.inventoryfile, format="STATIONXML")
+                # Read the station inventory table (parsing the StationXML only if it changed)
+                self.inv_table = load_inventory_table(self.inventoryfile)
             except Exception as exception:
                 self.logger.error("No available data", exc_info=True)
                 sys.exit()
         # list all the events during the station active time
-        self.staNamesNet,staLats,staLons=[],[],[]
-        count = 1
-        for net in self.inv:
-            for sta in net:
-                network = net.code #network name
-                station = sta.code #station name
-                print("\n")
-                self.logger.info(f"{count}/{total_stations} Retrieving event info for {network}-{station}")
-                count+=1
-                self.staNamesNet.append(f"{network}_{station}")
-
-                sta_lat = sta.latitude #station latitude
-                staLats.append(sta_lat)
-
-                sta_lon = sta.longitude #station longitude
-                staLons.append(sta_lon)
-
-                sta_sdate = sta.start_date #station start date
-                sta_edate = sta.end_date #station end date
-                # sta_edate_str = sta_edate
-                if not sta_edate:
-                    sta_edate = UTC("2599-12-31T23:59:59")
-                    # sta_edate_str = "2599-12-31T23:59:59"
-
-                stime, etime = date2time(sta_sdate,sta_edate) #station start and end time in UTC
-
-
-                catalogxml = catalogxmlloc+f'{network}-{station}-{sta_sdate.year}-{sta_edate.year}-{self.method}-{self.method}_events.xml' #xml catalog
-                # self.allcatalogxml.append(catalogxml)
-                catalogtxt = catalogtxtloc+f'{network}-{station}-{sta_sdate.year}-{sta_edate.year}-events-info-{self.method}.txt' #txt catalog
-                if not os.path.exists(catalogxml) and not os.path.exists(catalogtxt):
-                    self.logger.info(f"Obtaining catalog: {self.method}: {network}-{station}-{sta_sdate.year}-{sta_edate.year}")
-                    kwargs = {'starttime': stime, 'endtime': etime, 
-                                    'latitude': sta_lat, 'longitude': sta_lon,
-                                    'minradius': self.minradius, 'maxradius': self.maxradius,
-                                    'minmagnitude': minmagnitude, 'maxmagnitude': maxmagnitude}
-                    client = Client('IRIS')
-
-                    try:
-                        catalog = client.get_events(**kwargs)
-                    except:
-                        self.logger.warning("ConnectionResetError while obtaining the events from the client - IRIS")
-                        continue
-                    catalog.write(catalogxml, 'QUAKEML') #writing xml catalog
-
-                    
-                    tot_evnt_stns += len(catalog)
-
-                    evtimes,evlats,evlons,evdps,evmgs,evmgtps=[],[],[],[],[],[]
-                    self.logger.info("Writing the event data into a text file")
-
-                    with open(catalogtxt, 'w') as f:
-                        f.write('evtime,evlat,evlon,evdp,evmg\n')
-                        for cat in catalog:
-                            try:
-                                try:
-                                    evtime,evlat,evlon,evdp,evmg,evmgtp=cat.origins[0].time,cat.origins[0].latitude,cat.origins[0].longitude,cat.origins[0].depth/1000,cat.magnitudes[0].mag,cat.magnitudes[0].magnitude_type
-                                except:
-                                    evtime,evlat,evlon,evdp,evmg,evmgtp=cat.origins[0].time,cat.origins[0].latitude,cat.origins[0].longitude,cat.origins[0].depth/1000,cat.magnitudes[0].mag,"Mww"
-                                evtimes.append(str(evtime))
-                                evlats.append(float(evlat))
-                                evlons.append(float(evlon))
-                                evdps.append(float(evdp))
-                                evmgs.append(float(evmg))
-                                evmgtps.append(str(evmgtp))
-                                f.write('{},{:.4f},{:.4f},{:.1f},{:.1f}\n'.format(evtime,evlat,evlon,evdp,evmg)) #writing txt catalog
-                                
-                            except Exception as exception:
-                                self.logger.warning(f"Unable to write for {evtime}")
-                    self.logger.info("Finished writing the event data into a text and xml file")
-                else:
-                    self.logger.info(f"{catalogxml.split('/')[-1]} and {catalogtxt.split('/')[-1]} already exists!")
+        self.catalog_time = UTC()
+        pending = self.pending_epochs(self.station_epochs())
+        if not pending:
+            self.logger.info(f"The {self.method} events of all the stations are already in {self.indexfile}")
+        else:
+            self.logger.info(f"Obtaining the {self.method} events of {len(pending)} station epochs")
+            if self.catalog_mode == 'regional':
+                events = self.regional_events(pending,catalogxmlloc,self.minradius,self.maxradius,minmagnitude,maxmagnitude)
+            else:
+                events = self.station_events(pending,self.minradius,self.maxradius,minmagnitude,maxmagnitude)
+            self.write_station_events(pending,events,minmagnitude,maxmagnitude,failed=self.failed_epochs)
+        self.write_telemetry()
+
+    def pending_epochs(self,epochs):
+        '''
+        Station epochs (see station_epochs) whose events have to be requested: the epochs never queried and,
+        in incremental mode, the epochs still open after the end of their last events query (cutoff).
+        The stime of the latter is set to the cutoff and they are flagged as 'update'
+        '''
+        pending, updates = [], []
+        for epoch in epochs:
+            cutoff = self.ledger.catalog_cutoff(self.method,epoch['epoch'])
+            if cutoff is None:
+                pending.append(epoch)
+            elif self.incremental and cutoff < min(epoch['etime'],self.catalog_time)-CATALOG_UPDATE_MIN:
+                updates.append(dict(epoch,stime=cutoff,update=True))
+        if updates:
+            self.logger.info(f"Updating the events of {len(updates)} station epochs after their last query")
+        return pending+updates
+
+    def write_telemetry(self):
+        '''
+        Write the requests counters of each datacenter (tmp/download_telemetry.json and the Prometheus textfile, if set)
+        '''
+        if self.telemetryfile:
+            telemetry.write_json(self.telemetryfile)
+        if telemetry.textfile:
+            telemetry.write_prometheus(telemetry.textfile)
+        for row in telemetry.snapshot():
+            self.logger.info(f"{row['datacenter']} {row['service']}: {row['requests']} requests, {row['bytes']/1024**2:.1f} MB, mean latency {row['latency_mean']} s, {row['timeouts']} timeouts")
+
+    def station_epochs(self):
+        '''
+        List the station epochs of the inventory (net, stn, slat, slon, stime, etime) with their key in the ledger
+        '''
+        epochs = []
+        stas = self.inv_table.stations
+        for net,stn,slat,slon,start,end in zip(stas['net'],stas['stn'],stas['slat'],stas['slon'],stas['start'],stas['end']):
+            sta_sdate = UTC(start)
+            sta_edate = UTC(end) if end else UTC("2599-12-31T23:59:59")
+            stime, etime = date2time(sta_sdate,sta_edate)
+            epochs.append({'net':net,'stn':stn,'slat':float(slat),'slon':float(slon),'sdate':sta_sdate,'edate':sta_edate,'stime':stime,'etime':etime,
+                'epoch':f'{net}-{stn}-{sta_sdate}-{sta_edate}'})
+        return epochs
+
+    def regional_events(self,stations,catalogxmlloc,minradius,maxradius,minmagnitude=5.5,maxmagnitude=9.5):
+        '''
+        Obtain the events of all the stations with one regional catalog per provider (requested concurrently):
+        the minradius-maxradius annulus around the centroid of the region is padded by the distance of the farthest
+        station. Returns the events table of all the providers (merged by write_station_events); the epochs that
+        no provider answered (failed provider or time chunk) are kept in self.failed_epochs
+        '''
+        self.failed_epochs = set()
+        dists = locations2degrees(self.clat,self.clon,np.array([sta['slat'] for sta in stations]),np.array([sta['slon'] for sta in stations]))
+        pad = float(np.max(dists))
+        starttime = min(sta['stime'] for sta in stations)
+        endtime = min(max(sta['etime'] for sta in stations),UTC())
+        def provider_events(provider):
+            try:
+                catalog, failed = regional_catalog(provider,self.clat,self.clon,max(0,minradius-pad),min(180,maxradius+pad),starttime,endtime,
+                        minmagnitude,maxmagnitude,chunk_years=self.catalog_chunk_years,max_workers=self.max_workers,timeouts=self.timeouts)
+            except Exception as exception:
+                self.logger.warning(f"Unable to obtain the regional catalog from {provider}: {exception}")
+                return catalog_table([],provider), set()
+            label = re.sub(r'\W+','_',provider)
+            catalog.write(catalogxmlloc+f'regional-{label}-{starttime.year}-{endtime.year}-{self.method}_events.xml', 'QUAKEML')
+            events = catalog_table(catalog,provider)
+            self.logger.info(f"Regional catalog of {provider}: {events.shape[0]} events for {len(stations)} stations")
+            ## the epochs overlapping a failed time chunk are not answered by this provider
+            answered = {sta['epoch'] for sta in stations if not any(sta['stime'] < t2 and sta['etime'] > t1 for t1,t2 in failed)}
+            return events, answered
+        with ThreadPoolExecutor(max_workers=len(self.catalog_providers)) as executor:
+            results = list(executor.map(provider_events,self.catalog_providers))
+        answered = set().union(*(epochs for events,epochs in results))
+        self.failed_epochs = {sta['epoch'] for sta in stations} - answered
+        return pd.concat([events for events,epochs in results],ignore_index=True)
+
+    def station_events(self,stations,minradius,maxradius,minmagnitude=5.5,maxmagnitude=9.5):
+        '''
+        Obtain the events with one catalog request per station epoch and provider (in parallel). Returns the events
+        table of all the providers (merged by write_station_events); the epochs that no provider answered are kept
+        in self.failed_epochs, to be requested again in the next run
+        '''
+        self.failed_epochs = set()
+        def request(provider,sta):
+            kwargs = {'starttime': sta['stime'], 'endtime': sta['etime'],
+                            'latitude': sta['slat'], 'longitude': sta['slon'],
+                            'minradius': minradius, 'maxradius': maxradius,
+                            'minmagnitude': minmagnitude, 'maxmagnitude': maxmagnitude}
+            client = get_client(provider,timeout=self.timeouts['metadata'],connect_timeout=self.timeouts['connect'],metadata=True)
+            try:
+                return catalog_table(client.get_events(**kwargs),provider)
+            except FDSNNoDataException:
+                return catalog_table([],provider)
+
+        tables, answered = [], set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(request,provider,sta): (provider,sta) for provider in self.catalog_providers for sta in stations}
+            for future in as_completed(futures):
+                provider, sta = futures[future]
+                try:
+                    tables.append(future.result())
+                    answered.add(sta['epoch'])
+                except Exception as exception:
+                    self.logger.warning(f"Unable to obtain the events of {sta['net']}-{sta['stn']} from the client - {provider}")
+        self.failed_epochs = {sta['epoch'] for sta in stations} - answered
+        return pd.concat(tables,ignore_index=True).drop_duplicates('evid').reset_index(drop=True) if tables else catalog_table([])
+
+    def write_station_events(self,stations,events,minmagnitude=5.5,maxmagnitude=9.5,failed=()):
+        '''
+        Assign the events within the magnitude range to each station from the station-event distances
+        and the station epochs: the events are added to the event table of the project and the station
+        pairs (with distance and back-azimuth) to the station index of the method. The duplicated events of the
+        providers, or of the events already in the table, are merged first (see merge_catalogs). The cutoff of the
+        epochs (except the failed ones) is recorded in the ledger. Returns the number of new station events
+        '''
+        table = EventTable.load(self.eventfile)
+        events = merge_catalogs([events],self.catalog_providers,seconds=self.catalog_dedup_seconds,km=self.catalog_dedup_km,known=table.events)
+        events = events[(events['evmg']>=minmagnitude) & (events['evmg']<=maxmagnitude)].reset_index(drop=True)
+        assigned, distances = assign_events([sta['slat'] for sta in stations],[sta['slon'] for sta in stations],
+                        [sta['stime'] for sta in stations],[sta['etime'] for sta in stations],events,self.minradius,self.maxradius)
+        rows = table.add(events)
+        table.save(self.eventfile)
+        index = StationEventIndex.load(self.indexfile,self.eventfile)
+        before = len(index.pairs)
+        new = []
+        for sta,idx,dists in zip(stations,assigned,distances):
+            bazs = back_azimuths(sta['slat'],sta['slon'],events['evlat'].values[idx],events['evlon'].values[idx])
+            new.append((sta['net'],sta['stn'],rows[idx],dists,bazs))
+            if sta['epoch'] not in failed:
+                self.ledger.set_catalog_cutoff(self.method,sta['net'],sta['stn'],sta['epoch'],min(sta['etime'],self.catalog_time or UTC()))
+        ## all the station pairs are merged into the index at once
+        index.add_many(new)
+        index.save(self.indexfile)
+        self.event_index = None
+        tot_evnt_stns = len(index.pairs)-before
+        self.logger.info(f"{tot_evnt_stns} new {self.method} station events ({len(table)} events in {self.eventfile}, {len(index.pairs)} station events in {self.indexfile})")
+        return tot_evnt_stns
+
+    def station_catalog(self,sta):
+        '''
+        Events of a station from the station index (see StationEventIndex.station_catalog)
+        '''
+        if self.event_index is None:
+            self.event_index = StationEventIndex.load(self.indexfile,self.eventfile)
+        return self.event_index.station_catalog(sta['net'],sta['stn'])
+
+    def station_event_counts(self):
+        '''
+        Dict "net-stn" -> number of events of the station in the station index
+        '''
+        if self.event_index is None:
+            self.event_index = StationEventIndex.load(self.indexfile,self.eventfile)
+        return self.event_index.counts()
+
+    @property
+    def inv_table(self):
+        '''
+        Station/channel table of the inventory, the one of the inventory_source when the inventory is shared
+        '''
+        if self.inventory_source is not None:
+            return self.inventory_source.inv_table
+        return self._inv_table
+
+    @inv_table.setter
+    def inv_table(self,table):
+        if self.inventory_source is not None:
+            self.inventory_source.inv_table = table
+        else:
+            self._inv_table = table
+
+    def share_inventory(self,source):
+        '''
+        Use the inventory obtained by another downloadDataclass of the same region and channels instead of requesting
+        it again: the inventory files are copied and the table is the one of the source
+        '''
+        if source.inv_table is None:
+            source.inv_table = load_inventory_table(source.inventoryfile)
+        self.inventory_source = source
+        self.inv = source.inv
+        ## the modification time is kept, so that the copied table cache is valid without hashing the copy
+        shutil.copy2(source.inventoryfile,self.inventoryfile)
+        shutil.copyfile(InventoryTable.cachefile(source.inventoryfile),InventoryTable.cachefile(self.inventoryfile))
+        shutil.copyfile(source.inventorytxtfile,self.inventorytxtfile)
+        organize_inventory(self.inventorytxtfile)
+
+    def obtain_shared_events(self,datasets,catalogxmllocs,magnitudes):
+        '''
+        Obtain one events catalog covering the distance and magnitude ranges of all the datasets (e.g. RF and SKS,
+        sharing this inventory) and partition it into the station indexes of each dataset
+        '''
+        pending = []
+        for data in datasets:
+            if data.inv_table is None:
+                data.inv_table = load_inventory_table(data.inventoryfile)
+            data.catalog_time = UTC()
+            pending.append(data.pending_epochs(data.station_epochs()))
+        stations = list({(sta['net'],sta['stn'],str(sta['stime']),str(sta['etime'])): sta for stations in pending for sta in stations}.values())
+        if not stations:
+            self.logger.info("The events of all the stations are already in the station indexes")
+            return
+        minradius, maxradius = min(data.minradius for data in datasets), max(data.maxradius for data in datasets)
+        minmagnitude, maxmagnitude = min(mag[0] for mag in magnitudes), max(mag[1] for mag in magnitudes)
+        self.logger.info(f"Obtaining one events catalog ({minradius}-{maxradius} deg, M{minmagnitude}-{maxmagnitude}) for {', '.join(data.method for data in datasets)}")
+        if self.catalog_mode == 'regional':
+            events = self.regional_events(stations,catalogxmllocs[0],minradius,maxradius,minmagnitude,maxmagnitude)
+        else:
+            events = self.station_events(stations,minradius,maxradius,minmagnitude,maxmagnitude)
+        for data,stas,mag in zip(datasets,pending,magnitudes):
+            data.write_station_events(stas,events,mag[0],mag[1],failed=self.failed_epochs)
+        self.write_telemetry()
+
+    def station_windows(self,sta):
+        '''
+        Read the events of a station from the station index and compute the request window of each event.
+        When resuming a station, the events already retrieved according to the ledger are skipped
+        (and in retry_failed_only mode, only the failed events are kept)
+        '''
+        df = self.station_catalog(sta)
+        if sta.get('resume'):
+            status = self.ledger.event_status(self.method,sta['net'],sta['stn'])
+            statuses = df['evtime'].astype(str).map(status)
+            if self.retry_failed_only:
+                keep = statuses.isin(FAILED)
+            elif self.incremental and not os.path.exists(sta['partfile']):
+                ## only the events never requested (added to the catalog since the last run)
+                keep = statuses.isna()
+            else:
+                keep = ~statuses.isin([OK,LOWSNR])
+            self.logger.info(f"Resuming {sta['net']}-{sta['stn']}: {int(keep.sum())}/{df.shape[0]} events to download")
+            df = df[keep.values].reset_index(drop=True)
+        evmg = df['evmg'].values
+        evmgtp = df['evmgtp'].values
+        if self.traveltime_table and df.shape[0]:
+            ## all the event-station pairs of the station are interpolated at once (distances from the station index)
+            arr = arrivals_for_events(sta['phase'],df['dist'].values.astype(float),df['evdp'].values,tabledir=self.tabledir)
+            arrivals = list(zip(arr['time'],arr['incident_angle'],arr['ray_param']))
+        else:
+            arrivals = [None]*df.shape[0]
+        windows = []
+        for evtime,evdp,elat,elon,em,emt,arrival in zip(df['evtime'],df['evdp'],df['evlat'],df['evlon'],evmg,evmgtp,arrivals):
+            try:
+                windows.append(event_window(sta['net'],sta['stn'],sta['slat'],sta['slon'],elat,elon,evdp,evtime,em,emt,phase=sta['phase'],arrival=arrival))
+            except Exception as exception:
+                self.logger.warning(f"Unable to compute the {sta['phase']} arrival for {evtime}")
+        return windows
+
+    def merge_result(self,sta,win,strm,attempts,tot_evnt_stns,status=None,msg=None):
+        '''
+        Merge the result of one event download into the station stream and record it in the ledger.
+        Only called from the thread running download_data
+        '''
+        self.rem_dl -= 1
+        self.num_try += 1
+        if status is None:
+            if strm:
+                status = OK
+            elif any(att['status']==TIMEOUT for att in attempts):
+                status = TIMEOUT
+            else:
+                status = NODATA
+        if strm and self.min_snr > 0:
+            snr = window_snr(strm,sta['phase'])
+            if not snr >= self.min_snr:
+                status, strm = LOWSNR, None
+                msg = f"Low SNR {win['evtime']} ({snr:.1f} < {self.min_snr:.1f})"
+        retrieved = [att for att in attempts if att['status']==OK]
+        client_name,location = (retrieved[-1]['client'],retrieved[-1]['location']) if retrieved else (None,None)
+        self.router.record(sta['net'],attempts)
+        if strm:
+            self.succ_dl+=1
+            ## recorded as retrieved once written to the part file (see flush_station)
+            self.append_station(sta,strm,(win,status,attempts,client_name,location))
+            self.stalons.append(sta['slon'])
+            self.stalats.append(sta['slat'])
+            self.staNetNames.append(f"{sta['net']}_{sta['stn']}")
+        else:
+            self.ledger.record_event(self.method,win,status,attempts,client=client_name,location=location)
+        if msg is None:
+            msg = f"Data {win['evtime']}" if strm else f"No data {win['evtime']} ({status})"
+        self.logger.info(f"{msg}; rem: {self.rem_dl}/{tot_evnt_stns}; dl: {self.succ_dl}/{self.num_try}")
+
+    def has_new_events(self,sta):
+        '''
+        Whether the station has events never requested according to the ledger
+        '''
+        status = self.ledger.event_status(self.method,sta['net'],sta['stn'])
+        evtimes = self.station_catalog(sta)['evtime'].astype(str)
+        return bool((~evtimes.isin(status.keys())).any())
+
+    def open_station(self,sta):
+        '''
+        Start the download of a station: the retrieved windows are buffered in sta['stream'] and appended
+        to {datafile}.part every h5_flush_every events; the part file is renamed to the data file
+        once the station is complete, so an interrupted download is not taken as a finished station
+        '''
+        self.logger.info(f"Searching and downloading data for {self.method}; {sta['net']}-{sta['stn']}")
+        sta['stream'] = RFStream()
+        sta['records'] = []
+        sta['nwritten'] = 0
+        if self.station_resume(sta) and not os.path.exists(sta['partfile']):
+            os.replace(sta['datafile'],sta['partfile'])
+        if sta['resume']:
+            self.logger.info(f"Appending to the partial data file {sta['partfile']}")
+
+    def station_resume(self,sta):
+        '''
+        Whether the download of the station continues a partial (or, in retry_failed_only mode, complete) data file
+        '''
+        sta['partfile'] = sta['datafile']+'.part'
+        sta['resume'] = os.path.exists(sta['partfile']) or bool((self.retry_failed_only or self.incremental) and os.path.exists(sta['datafile']))
+        return sta['resume']
+
+    def plan_downloads(self,stations,locations=[""]):
+        '''
+        Build the request plan of the stations to download: the event windows of each station and the clients to try
+        '''
+        self.logger.info("Reading events catalog files")
+        plan = DownloadPlan(method=self.method)
+        selector = self.channel_selector()
+        for sta in stations:
+            self.station_resume(sta)
+            windows = self.station_windows(sta)
+            if selector is not None:
+                ## the channels and the locations where they exist (see ChannelSelector.select)
+                for win in windows:
+                    win['cha'], win['locations'] = selector.select(sta['net'],sta['stn'],win['evtime'],locations)
+            plan.add(sta,windows,self.request_clients(sta['net']))
+        if self.availability_prefilter:
+            self.filter_available(plan,locations)
+        return plan
+
+    def filter_available(self,plan,locations=[""]):
+        '''
+        Drop the windows of the plan that the availability of none of the clients of each station covers
+        (one availability query per station and client); they are recorded as NODATA in the ledger without any
+        waveform request, their attempts being tagged UNAVAILABLE so that they do not count in the routing history. The windows of a station are all kept if the availability of one of its clients is unknown.
+        In a dry run, the windows are only counted and nothing is recorded
+        '''
+        def station_availability(sta):
+            t1 = min(win['t1'] for win in sta['windows'])
+            t2 = max(win['t2'] for win in sta['windows'])
+            channels = sorted({ch.strip() for win in sta['windows'] for ch in win.get('cha',self.channel).split(",")})
+            indexes = []
+            for cl in sta['clients']:
+                try:
+                    client = get_client(cl,timeout=self.timeouts['read'],connect_timeout=self.timeouts['connect'])
+                    spans = query_availability(client,sta['net'],sta['stn'],t1,t2,",".join(channels),timeout=self.timeouts['read'])
+                except Exception as exception:
+                    self.logger.debug(f"{sta['net']}-{sta['stn']}: no availability from {cl}: {exception}")
+                    spans = None
+                if spans is None:
+                    return None
+                indexes.append(availability_index(spans))
+            return indexes
+
+        stations = [sta for sta in plan.stations if sta['windows'] and sta['clients']]
+        nunknown, nskipped = 0, 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(station_availability,sta): sta for sta in stations}
+            for future in as_completed(futures):
+                sta = futures[future]
+                indexes = future.result()
+                if indexes is None:
+                    nunknown += 1
+                    continue
+                available = []
+                for win in sta['windows']:
+                    if any(window_available(index,win,win.get('locations',locations),cha=self.channel) for index in indexes):
+                        available.append(win)
+                    elif not self.dry_run:
+                        self.ledger.record_event(self.method,win,NODATA,[{'client':cl,'location':'','status':UNAVAILABLE,'nbytes':0,'latency':0.0,'message':'unavailable'} for cl in sta['clients']])
+                if len(available) < len(sta['windows']):
+                    self.logger.info(f"{sta['net']}-{sta['stn']}: {len(sta['windows'])-len(available)} of {len(sta['windows'])} event windows not available")
+                nskipped += len(sta['windows'])-len(available)
+                sta['windows'] = available
+        self.logger.info(f"Availability prefilter: skipped {nskipped} event windows; availability unknown for {nunknown} of {len(stations)} stations")
+
+    def channel_selector(self):
+        '''
+        ChannelSelector of the inventory table when channel_bands is set, None to request the channel setting as is
+        '''
+        if not self.channel_bands:
+            return None
+        try:
+            if self.inv_table is None:
+                self.inv_table = load_inventory_table(self.inventoryfile)
+        except Exception as exception:
+            self.logger.warning(f"No inventory table for the channel selection: {exception}")
+            return None
+        return ChannelSelector(self.inv_table,bands=self.channel_bands,min_rate=self.min_sampling_rate,default=",".join(sorted(ch.strip() for ch in self.channel.split(","))))
+
+    def inventory_channels(self):
+        '''
+        Channels requested in the inventory: all the components of the channel_bands, or the channel setting
+        '''
+        if self.channel_bands:
+            return ",".join(f"{band}?" for band in self.channel_bands)
+        return self.channel
+
+    def estimate_plan(self,plan):
+        '''
+        Estimate the volume and wall time of the plan from the inventory sampling rates and the ledger history
+        '''
+        try:
+            if self.inv_table is None:
+                self.inv_table = load_inventory_table(self.inventoryfile)
+            ## channels of the plan (selected per station epoch with channel_bands)
+            channels = {ch for sta in plan.stations for win in sta['windows'] for ch in win.get('cha',self.channel).split(",")}
+            sampling_rates = self.inv_table.sampling_rates(",".join(sorted(channels)) if channels else self.channel)
+        except Exception as exception:
+            self.logger.warning(f"No sampling rates for the download estimate: {exception}")
+            sampling_rates = {}
+        if self.bulk_group in ('station','event'):
+            nrequests = len(plan_bulk_requests([win for sta in plan.stations for win in sta['windows']],group_by=self.bulk_group,max_size=self.bulk_size))
+        else:
+            nrequests = plan.nwindows
+        workers = min(self.max_workers,len(self.client)*self.max_per_client)
+        return plan.estimate(sampling_rates=sampling_rates,history=self.ledger.throughput(),max_workers=workers,nrequests=nrequests)
+
+    def append_station(self,sta,strm,record):
+        '''
+        Buffer a retrieved window with its ledger record (win, status, attempts, client, location)
+        '''
+        sta['stream'].extend(strm)
+        sta['records'].append(record)
+        if len(sta['stream']) >= 3*self.h5_flush_every:
+            self.flush_station(sta)
+
+    def flush_station(self,sta):
+        '''
+        Append the buffered windows to the part file, then record them in the ledger: a window is never
+        marked as retrieved before it is on disk, so an interrupted download requests it again on resume
+        '''
+        if len(sta['stream']):
+            sta['stream'].write(sta['partfile'], 'H5', mode='a', override='ignore')
+            sta['nwritten'] += len(sta['stream'])
+            sta['stream'] = RFStream()
+        for win,status,attempts,client_name,location in sta['records']:
+            self.ledger.record_event(self.method,win,status,attempts,client=client_name,location=location)
+        sta['records'] = []
+
+    def close_station(self,sta):
+        self.flush_station(sta)
+        if not sta['nwritten'] and not os.path.exists(sta['partfile']):
+            self.logger.warning(f"No data {sta['datafile']}")
+            sta['stream'].write(sta['partfile'], 'H5')
+        os.replace(sta['partfile'],sta['datafile'])
+        sta['stream'] = None
+
+    def request_window(self,sta,win,locations,attempts):
+        '''
+        Download one event window, trying the clients of the station in order (run in the worker threads).
+        Returns a list of (window, stream or False, message)
+        '''
+        strm,res,msg = multi_download(self.request_clients(sta['net']),sta['net'],sta['stn'],sta['slat'],sta['slon'],win['elat'],win['elon'],win['evdp'],win['evtime'],win['em'],win['emt'],phase=sta['phase'],locations=win.get('locations',locations),client_slots=self.client_slots,win=win,timeouts=self.timeouts,attempts=attempts.setdefault(id(win),[]),cache=self.cache,single_request=self.single_location_request)
+        return [(win,strm,msg)]
+
+    def window_tasks(self,stations,locations=[""]):
+        '''
+        Download tasks (function, windows, arguments) of the stations, one per event window.
+        Each station is opened when its first task is taken (and closed at once if it has no window)
+        '''
+        for sta in stations:
+            self.open_station(sta)
+            if not sta['windows']:
+                self.close_station(sta)
+            for win in sta['windows']:
+                yield self.request_window,[win],(sta,win,locations)
+
+    def download_windows(self,executor,tasks,stations,tot_evnt_stns):
+        '''
+        Run the download tasks (function, windows, arguments) in the executor with at most 2*max_workers of them
+        in flight, across the stations, so that the workers never wait for a station to complete.
+        The results are merged in the calling thread as they complete and a station is closed (written)
+        as soon as all its windows are merged. A task raising an exception is recorded as ERROR for all its windows
+        '''
+        station_of = {id(win): sta for sta in stations for win in sta['windows']}
+        remaining = {id(sta): len(sta['windows']) for sta in stations}
+        tasks = iter(tasks)
+        futures = {}
+        while True:
+            for func,windows,args in itertools.islice(tasks,max(0,2*self.max_workers-len(futures))):
+                attempts = {}
+                futures[executor.submit(func,*args,attempts=attempts)] = (windows,attempts)
+            if not futures:
+                break
+            done,_ = wait(futures,return_when=FIRST_COMPLETED)
+            for future in done:
+                windows,attempts = futures.pop(future)
+                try:
+                    results = [(win,strm,None,msg) for win,strm,msg in future.result()]
+                except Exception as exception:
+                    self.logger.warning(f"Download failed for {len(windows)} windows: {exception}")
+                    results = [(win,None,ERROR,f"Failed {win['evtime']}") for win in windows]
+                for win,strm,status,msg in results:
+                    sta = station_of[id(win)]
+                    self.merge_result(sta,win,strm,attempts.get(id(win),[]),tot_evnt_stns,status=status,msg=msg)
+                    remaining[id(sta)] -= 1
+                    if not remaining[id(sta)]:
+                        self.close_station(sta)
+
+    def request_chunk(self,chunk,locations,attempts):
+        '''
+        Download the windows of one bulk request (run in the worker threads).
+        Returns a list of (window, stream or False, message)
+        '''
+        results = bulk_download(self.request_clients(chunk[0]['net']),chunk,locations=locations,client_slots=self.client_slots,timeouts=self.timeouts,attempts=attempts,cache=self.cache,single_request=self.single_location_request)
+        return [(win,strm,None) for win,strm,client_name in results]
+
+    def bulk_tasks(self,stations,locations=[""]):
+        '''
+        Download tasks (function, windows, arguments) of the stations, one per bulk dataselect request grouped
+        by station or by event. The chunks of all the stations are planned up front and each station is opened
+        when its first chunk is taken (the stations without any window are opened and closed at once)
+        '''
+        station_of = {id(win): sta for sta in stations for win in sta['windows']}
+        chunks = plan_bulk_requests([win for sta in stations for win in sta['windows']],group_by=self.bulk_group,max_size=self.bulk_size)
+        self.logger.info(f"{len(station_of)} windows in {len(chunks)} bulk requests (grouped by {self.bulk_group})")
+        for sta in stations:
+            if not sta['windows']:
+                self.open_station(sta)
+                self.close_station(sta)
+        opened = set()
+        for chunk in chunks:
+            for win in chunk:
+                sta = station_of[id(win)]
+                if id(sta) not in opened:
+                    self.open_station(sta)
+                    opened.add(id(sta))
+            yield self.request_chunk,chunk,(chunk,locations)
 
         ################################## Download
     def download_data(self,catalogtxtloc,datafileloc,tot_evnt_stns,rem_evnts, plot_stations=True, plot_events=True,dest_map="./",locations=[""]):
      
         self.logger.info(f"Total data files to download: {tot_evnt_stns}")
-        rem_dl = rem_evnts
-        succ_dl,num_try = 0, 0 
-        rf_stalons,sks_stalons = [],[]
-        rf_stalats, sks_stalats = [], []
-        rf_staNetNames, sks_staNetNames = [],[]
+        self.logger.info(f"Concurrent downloads: {self.max_workers} workers; {self.max_per_client} per datacenter")
+        self.rem_dl = rem_evnts
+        self.succ_dl,self.num_try = 0, 0 
+        self.stalons,self.stalats,self.staNetNames = [],[],[]
+        locations = order_locations(locations,self.location_priority)
 
         all_stns_df = pd.read_csv(self.inventorytxtfile,sep="|")
+        counts = self.station_event_counts()
 
         all_sta_lats=all_stns_df['Latitude'].values
         all_sta_lons=all_stns_df['Longitude'].values
         all_sta_nms=all_stns_df['Station'].values
         all_sta_nets=all_stns_df['#Network'].values
         
+        stations = []
         sta_str_list = []
-        #Retrive waveform data for the events
         for slat,slon,stn,net in zip(all_sta_lats,all_sta_lons,all_sta_nms,all_sta_nets):
             sta_str = f"{net}-{stn}-{slon}-{slat}"
             if sta_str in sta_str_list:
@@ -210,135 +798,88 @@ class downloadDataclass:
             else:
                 sta_str_list.append(sta_str)
 
-            catfile = catalogtxtloc+f"{net}-{stn}-events-info-{self.method}.txt"
-            cattxtnew = catalogtxtloc+f"{net}-{stn}-events-info-available-{self.method}.txt"
-            
+            sta = {'net':net,'stn':stn,'slat':slat,'slon':slon,'stream':None,
+                    'nevents':counts.get(f"{net}-{stn}",0)}
             if self.method == 'RF':
-                print("\n")
-                self.logger.info(f"Searching and downloading data for {self.method}; {net}-{stn}")
-                rfdatafile = datafileloc+f"{net}-{stn}-{str(inpRFdict['filenames']['data_rf_suffix'])}.h5"
-                # rfdatafile = datafileloc+f"{net}-{stn}-{str(inpRF.loc['data_rf_suffix','VALUES'])}.h5"
-                # rfdatafile = datafileloc+f"{net}-{stn}-{str(inpRF.loc['data_rf_suffix','VALUES'])}.h5"
-                if os.path.exists(catfile) and not os.path.exists(rfdatafile) and tot_evnt_stns > 0:
-                    stream = RFStream()
-                    df = pd.read_csv(catfile,sep=",")
-                    # df = pd.read_csv(catfile,delimiter="\||,", names=['evtime','evlat','evlon','evdp','evmg','evmgtp'],header=None,engine="python")
-                    evmg = df['evmg'].values
-                    evmgtp = ["Mww" for val in df['evmg']]
-                    # evmg = [float(val.split()[0]) for val in df['evmg']]
-                    # evmgtp = [str(val.split()[1]) for val in df['evmg']]
-                    
-                    fcat = open(cattxtnew,'w')
-                    for evtime,evdp,elat,elon,em,emt in zip(df['evtime'],df['evdp'],df['evlat'],df['evlon'],evmg,evmgtp):
-                        rem_dl -= 1
-                        num_try += 1
-                        
-                        strm,res,msg = multi_download(self.client,self.inv,net,stn,slat,slon,elat,elon,evdp,evtime,em,emt,fcat,stalons=rf_stalons,stalats=rf_stalats,staNetNames=rf_staNetNames,phase='P',locations=locations)
-                        if res:
-                            succ_dl+=1
-                            
-                        if not msg:
-                            self.logger.info(f"Event: {evtime}; rem: {rem_dl}/{tot_evnt_stns}; dl: {succ_dl}/{num_try}")
-                        else:
-                            self.logger.info(f"{msg}; rem: {rem_dl}/{tot_evnt_stns}; dl: {succ_dl}/{num_try}")
-
-                        if strm:
-                            stream.extend(strm)
-
-                    if not len(stream):
-                        self.logger.warning(f"No data {rfdatafile}")
-                    stream.write(rfdatafile, 'H5')
-                    fcat.close()
-                ### Event map plot
-                # cattxtnew = catalogtxtloc+f'{net}-{stn}-events-info-rf.txt'
-                if os.path.exists(cattxtnew) and plot_events and not os.path.exists(f"{net}-{stn}-{str(inpRFdict['filenames']['events_map_suffix'])}.png"):
-                # if os.path.exists(cattxtnew) and plot_events and not os.path.exists(f"{net}-{stn}-{str(inpRF.loc['events_map_suffix','VALUES'])}.png"):
-                    df = pd.read_csv(cattxtnew,delimiter="\||,", names=['evtime','evlat','evlon','evdp','evmg','client'],header=None,engine="python")
-                    if df.shape[0]:
-                        evmg = [float(val.split()[0]) for val in df['evmg']]
-                        event_plot_name=f"{net}-{stn}-{str(inpRFdict['filenames']['events_map_suffix'])}"
-                        # event_plot_name=f"{net}-{stn}-{str(inpRF.loc['events_map_suffix','VALUES'])}"
-                        if not os.path.exists(dest_map+event_plot_name+f".{self.fig_frmt}"):
-                            self.logger.info(f"Plotting events map "+event_plot_name+f".{self.fig_frmt}")
-                            events_map(evlons=df['evlon'], evlats=df['evlat'], evmgs=evmg, evdps=df['evdp'], stns_lon=slon, stns_lat=slat, destination=dest_map,figfrmt=self.fig_frmt, clon = slon , outname=f'{event_plot_name}')
-        
-
-                        
-            if self.method == 'SKS':
-                print("\n")
-                self.logger.info(f"Searching and downloading data for {self.method}; {net}-{stn}")
-
-                sksdatafile = datafileloc+f"{net}-{stn}-{str(inpSKSdict['filenames']['data_sks_suffix'])}.h5"
-                if os.path.exists(catfile) and not os.path.exists(sksdatafile) and tot_evnt_stns > 0:
-                    self.logger.info("Reading events catalog file")
-                    stream = RFStream()
+                sta['datafile'] = datafileloc+f"{net}-{stn}-{str(inpRFdict['filenames']['data_rf_suffix'])}.h5"
+                sta['event_plot_name'] = f"{net}-{stn}-{str(inpRFdict['filenames']['events_map_suffix'])}"
+                sta['event_plot_outname'] = sta['event_plot_name']
+                sta['phase'] = 'P'
+            elif self.method == 'SKS':
+                sta['datafile'] = datafileloc+f"{net}-{stn}-{str(inpSKSdict['filenames']['data_sks_suffix'])}.h5"
+                sta['event_plot_name'] = f"{net}-{stn}-{str(inpSKSdict['filenames']['events_map_suffix'])}"
+                sta['event_plot_outname'] = f'{net}-{stn}-SKS'
+                sta['phase'] = 'SKS'
+            if self.retry_failed_only:
+                missing = self.ledger.has_failed(self.method,net,stn)
+            elif self.incremental and os.path.exists(sta['datafile']):
+                missing = self.has_new_events(sta)
+            else:
+                missing = not os.path.exists(sta['datafile'])
+            sta['to_download'] = sta['nevents'] > 0 and missing and tot_evnt_stns > 0
+            stations.append(sta)
+
+        ## plan all the requests before downloading
+        plan = self.plan_downloads([sta for sta in stations if sta['to_download']],locations=locations)
+        estimate = self.estimate_plan(plan)
+        report = plan.report(estimate)
+        for line in report.split("\n")[:7]:
+            self.logger.info(line)
+        if self.tmpdir:
+            with open(self.tmpdir+f'download_plan-{self.method}.txt','w') as f:
+                f.write(report)
+        if self.dry_run:
+            self.logger.info(f"Dry run: no waveform requested (see {self.tmpdir}download_plan-{self.method}.txt)")
+            return
 
-                    df = pd.read_csv(catfile,sep=",")
-                    # df = pd.read_csv(catfile,delimiter="\||,", names=['evtime','evlat','evlon','evdp','evmg','evmgtp'],header=None,engine="python")
+        #Retrive waveform data for the events
+        to_download = [sta for sta in stations if sta['to_download']]
+        if self.bulk_group in ('station','event'):
+            tasks = self.bulk_tasks(to_download,locations)
+        else:
+            tasks = self.window_tasks(to_download,locations)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.download_windows(executor,tasks,to_download,tot_evnt_stns)
+
+        for sta in stations:
+            net, stn, slat, slon = sta['net'], sta['stn'], sta['slat'], sta['slon']
+            if not sta['to_download']:
+                self.logger.info(f"{sta['nevents']} events of {net}-{stn} in {self.indexfile}")
+                if not os.path.exists(sta['datafile']):
+                    self.logger.info(f"datafile {sta['datafile']} does not exist!")
+                if tot_evnt_stns > 0:
+                    self.logger.info(f"Total files to download {tot_evnt_stns}")
+
+            ### Event map plot
+            event_plot_name = sta['event_plot_name']
+            if plot_events and not os.path.exists(f"{event_plot_name}.png"):
+                df = self.ledger.available_events(self.method,net,stn)
+                if df.shape[0]:
                     evmg = df['evmg'].values
-                    evmgtp = ["Mww" for val in df['evmg']]
-                    # evmg = [float(val.split()[0]) for val in df['evmg']]
-                    # evmgtp = [str(val.split()[1]) for val in df['evmg']]
-                    # cattxtnew = catalogtxtloc+f'{net}-{stn}-events-info-sks.txt'
-                    fcat = open(cattxtnew,'w')
-                    for i,evtime,evdp,elat,elon,em,emt in zip(range(len(df['evtime'])),df['evtime'],df['evdp'],df['evlat'],df['evlon'],evmg,evmgtp):
-                        rem_dl -= 1
-                        num_try += 1
-                        # self.logger.info(f"Event: {evtime}; rem: {rem_dl}/{tot_evnt_stns}; dl: {succ_dl}/{num_try}")
-                        strm,res,msg = multi_download(self.client,self.inv,net,stn,slat,slon,elat,elon,evdp,evtime,em,emt,fcat,stalons = sks_stalons,stalats = sks_stalats,staNetNames = sks_staNetNames,phase='SKS',locations=locations)
-                        if not msg:
-                            self.logger.info(f"Event: {evtime}; rem: {rem_dl}/{tot_evnt_stns}; dl: {succ_dl}/{num_try}")
-                        else:
-                            self.logger.info(f"{msg}; rem: {rem_dl}/{tot_evnt_stns}; dl: {succ_dl}/{num_try}")
-
-
-                        if strm:
-                            stream.extend(strm)
-                        if res:
-                            succ_dl+=1
-                    if not len(stream):
-                        self.logger.warning(f"No data {sksdatafile}")
-
-                    stream.write(sksdatafile, 'H5')
-                    fcat.close()
-                else:
-                    if os.path.exists(catfile):
-                        self.logger.info(f"catalog {catfile} exists!")
-                    else:
-                        self.logger.info(f"catalog {catfile} does not exist!")
-                    if not os.path.exists(sksdatafile):
-                        self.logger.info(f"datafile {sksdatafile} does not exist!")
-                    if tot_evnt_stns > 0:
-                        self.logger.info(f"Total files to download {tot_evnt_stns}")
-                    
-                ### Event map plot
-                # cattxtnew = catalogtxtloc+f'{net}-{stn}-events-info-sks.txt'
-                if os.path.exists(cattxtnew) and plot_events and not os.path.exists(f"{net}-{stn}-{str(inpSKSdict['filenames']['events_map_suffix'])}.png"):
-                    df = pd.read_csv(cattxtnew,delimiter="\||,", names=['evtime','evlat','evlon','evdp','evmg','client'],header=None,engine="python")
-                    if df.shape[0]:
-                        evmg = [float(val.split()[0]) for val in df['evmg']]
-                        event_plot_name=f"{net}-{stn}-{str(inpSKSdict['filenames']['events_map_suffix'])}"
-                        if not os.path.exists(dest_map+event_plot_name+f".{self.fig_frmt}"):
-                            self.logger.info(f"Plotting events map "+event_plot_name+f".{self.fig_frmt}")
-                            events_map(evlons=df['evlon'], evlats=df['evlat'], evmgs=evmg, evdps=df['evdp'], stns_lon=slon, stns_lat=slat, destination=dest_map,figfrmt=self.fig_frmt, clon = slon , outname=f'{net}-{stn}-SKS')
+                    if not os.path.exists(dest_map+event_plot_name+f".{self.fig_frmt}"):
+                        self.logger.info("Plotting events map "+event_plot_name+f".{self.fig_frmt}")
+                        events_map(evlons=df['evlon'], evlats=df['evlat'], evmgs=evmg, evdps=df['evdp'], stns_lon=slon, stns_lat=slat, destination=dest_map,figfrmt=self.fig_frmt, clon = slon , outname=sta['event_plot_outname'])
+
+        self.write_telemetry()
 
         ## plot station map for all the stations for which the data has been successfully retrieved
-        if plot_stations and self.method == 'RF' and len(rf_stalons):
+        if plot_stations and self.method == 'RF' and len(self.stalons):
             print("\n")
             self.logger.info("Plotting station map for RF")
             map = plot_merc(resolution='h',llcrnrlon=self.minlongitude-1, llcrnrlat=self.minlatitude-1,urcrnrlon=self.maxlongitude+1, urcrnrlat=self.maxlatitude+1,topo=True)
-            station_map(map, stns_lon=rf_stalons, stns_lat=rf_stalats,stns_name= rf_staNetNames,figname=str(inpRFdict['filenames']['retr_station_prefix']), destination=dest_map,figfrmt=self.fig_frmt)
-            # station_map(map, stns_lon=rf_stalons, stns_lat=rf_stalats,stns_name= rf_staNetNames,figname=str(inpRF.loc['retr_station_prefix','VALUES']), destination=dest_map,figfrmt=self.fig_frmt)
+            station_map(map, stns_lon=self.stalons, stns_lat=self.stalats,stns_name= self.staNetNames,figname=str(inpRFdict['filenames']['retr_station_prefix']), destination=dest_map,figfrmt=self.fig_frmt)
+            # station_map(map, stns_lon=self.stalons, stns_lat=self.stalats,stns_name= self.staNetNames,figname=str(inpRF.loc['retr_station_prefix','VALUES']), destination=dest_map,figfrmt=self.fig_frmt)
 
 
-        if plot_stations and self.method == 'SKS' and len(sks_stalons):
+        if plot_stations and self.method == 'SKS' and len(self.stalons):
             print("\n")
             self.logger.info("Plotting station map for SKS")
             map = plot_merc(resolution='h',llcrnrlon=self.minlongitude-1, llcrnrlat=self.minlatitude-1,urcrnrlon=self.maxlongitude+1, urcrnrlat=self.maxlatitude+1,topo=True)
-            station_map(map, stns_lon=sks_stalons, stns_lat=sks_stalats,stns_name= sks_staNetNames,figname=str(inpSKSdict['filenames']['retr_station_prefix']), destination=dest_map,figfrmt=self.fig_frmt)
-        ## Write the retrieved station catalog
+            station_map(map, stns_lon=self.stalons, stns_lat=self.stalats,stns_name= self.staNetNames,figname=str(inpSKSdict['filenames']['retr_station_prefix']), destination=dest_map,figfrmt=self.fig_frmt)
+        ## Write the retrieved station catalog (including the stations retrieved in previous runs)
+        self.staNetNames = sorted(set(self.staNetNames) | set(self.ledger.retrieved_stations(self.method)))
         if self.method == 'RF':
-            write_station_file(self.inventorytxtfile,rf_staNetNames,outfile=catalogtxtloc+str(inpRFdict['filenames']['retr_stations']))
-            # write_station_file(self.inventorytxtfile,rf_staNetNames,outfile=catalogtxtloc+str(inpRF.loc['retr_stations','VALUES']))
+            write_station_file(self.inventorytxtfile,self.staNetNames,outfile=catalogtxtloc+str(inpRFdict['filenames']['retr_stations']))
+            # write_station_file(self.inventorytxtfile,self.staNetNames,outfile=catalogtxtloc+str(inpRF.loc['retr_stations','VALUES']))
         elif self.method == 'SKS':
-            write_station_file(self.inventorytxtfile,sks_staNetNames,outfile=catalogtxtloc+str(inpSKSdict['filenames']['retr_stations']))
\ No newline at end of file
+            write_station_file(self.inventorytxtfile,self.staNetNames,outfile=catalogtxtloc+str(inpSKSdict['filenames']['retr_stations']))
\ No newline at end of file
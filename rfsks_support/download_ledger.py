@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import threading
+import logging
+import pandas as pd
+from obspy import UTCDateTime as UTC
+
+## status of an event download
+OK, NODATA, TIMEOUT, ERROR = 'ok', 'nodata', 'timeout', 'error'
+FAILED = (NODATA, TIMEOUT, ERROR)
+## retrieved but rejected by the download quality gate (not written to the data file, not retried)
+LOWSNR = 'lowsnr'
+## attempt skipped by the availability prefilter: no request was sent, so it is not a miss of the datacenter
+UNAVAILABLE = 'unavailable'
+
+
+class DownloadLedger:
+    '''
+    SQLite ledger of the waveform downloads.
+    `attempts` keeps every (station, event, client, location) request with its status, bytes and latency,
+    `events` keeps the last status of each (method, station, event) and the event info of the retrieved ones
+    (it replaces the {net}-{stn}-events-info-available-{method}.txt files)
+    '''
+    def __init__(self,dbfile=':memory:'):
+        self.logger = logging.getLogger(__name__)
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        if dbfile != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(dbfile)),exist_ok=True)
+        self.conn = sqlite3.connect(dbfile,check_same_thread=False)
+        if dbfile != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS attempts (
+                method TEXT, net TEXT, stn TEXT, evtime TEXT, client TEXT, location TEXT,
+                status TEXT, nbytes INTEGER, latency REAL, message TEXT, attempt_time TEXT)''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                method TEXT, net TEXT, stn TEXT, evtime TEXT, evlat REAL, evlon REAL, evdp REAL,
+                evmg REAL, evmgtp TEXT, client TEXT, location TEXT, status TEXT, ntries INTEGER,
+                PRIMARY KEY (method, net, stn, evtime))''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS catalog_cutoffs (
+                method TEXT, epoch TEXT, net TEXT, stn TEXT, cutoff TEXT,
+                PRIMARY KEY (method, epoch))''')
+
+    def record_event(self,method,win,status,attempts=(),client=None,location=None):
+        '''
+        Store the attempts made for the event window `win` (see rfsks_extras.event_window)
+        and its final status
+        '''
+        now = str(UTC())
+        evtime = str(win['evtime'])
+        rows = [(method,str(win['net']),str(win['stn']),evtime,att.get('client'),att.get('location'),
+                    att.get('status'),int(att.get('nbytes',0)),float(att.get('latency',0)),str(att.get('message','')),now) for att in attempts]
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO attempts VALUES (?,?,?,?,?,?,?,?,?,?,?)',rows)
+            self.conn.execute('''INSERT INTO events VALUES (?,?,?,?,?,?,?,?,?,?,?,?,1)
+                ON CONFLICT (method, net, stn, evtime) DO UPDATE SET client=excluded.client, location=excluded.location,
+                status=excluded.status, ntries=ntries+1''',
+                (method,str(win['net']),str(win['stn']),evtime,float(win['elat']),float(win['elon']),float(win['evdp']),
+                    float(win['em']),str(win['emt']),client,location,status))
+
+    def event_status(self,method,net,stn):
+        '''
+        Dict evtime -> last status of the events of a station
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT evtime, status FROM events WHERE method=? AND net=? AND stn=?',(method,str(net),str(stn)))
+            return dict(cur.fetchall())
+
+    def has_failed(self,method,net,stn):
+        with self.lock:
+            cur = self.conn.execute(f'SELECT COUNT(*) FROM events WHERE method=? AND net=? AND stn=? AND status IN ({",".join("?"*len(FAILED))})',(method,str(net),str(stn))+FAILED)
+            return cur.fetchone()[0] > 0
+
+    def available_events(self,method,net,stn):
+        '''
+        DataFrame of the retrieved events of a station (evtime, evlat, evlon, evdp, evmg, client)
+        '''
+        with self.lock:
+            return pd.read_sql_query('SELECT evtime, evlat, evlon, evdp, evmg, client FROM events WHERE method=? AND net=? AND stn=? AND status=? ORDER BY evtime',
+                self.conn,params=(method,str(net),str(stn),OK))
+
+    def retrieved_stations(self,method):
+        '''
+        List of the "net_stn" stations with at least one retrieved event
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT DISTINCT net, stn FROM events WHERE method=? AND status=?',(method,OK))
+            return [f"{net}_{stn}" for net,stn in cur.fetchall()]
+
+    def client_history(self):
+        '''
+        Rows of (net, client, status, number of attempts, total latency) of all the requests sent
+        (the attempts skipped by the availability prefilter are left out)
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT net, client, status, COUNT(*), SUM(latency) FROM attempts WHERE client IS NOT NULL AND status!=? GROUP BY net, client, status',(UNAVAILABLE,))
+            return cur.fetchall()
+
+    def throughput(self):
+        '''
+        (number of requests, bytes, total latency) of the successful requests sent to the datacenters
+        '''
+        with self.lock:
+            count, nbytes, latency = self.conn.execute("SELECT COUNT(*), SUM(nbytes), SUM(latency) FROM attempts WHERE status=? AND message!='cache'",(OK,)).fetchone()
+        return count, nbytes or 0, latency or 0
+
+    def catalog_cutoff(self,method,epoch):
+        '''
+        End time of the last events query of a station epoch (None if not recorded)
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT cutoff FROM catalog_cutoffs WHERE method=? AND epoch=?',(method,epoch)).fetchone()
+        return UTC(row[0]) if row else None
+
+    def set_catalog_cutoff(self,method,net,stn,epoch,cutoff):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO catalog_cutoffs VALUES (?,?,?,?,?)',(method,epoch,str(net),str(stn),str(cutoff)))
+
+    def status_counts(self,method):
+        '''
+        Dict status -> number of event windows with this last status
+        '''
+        with self.lock:
+            cur = self.conn.execute('SELECT status, COUNT(*) FROM events WHERE method=? GROUP BY status',(method,))
+            return dict(cur.fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
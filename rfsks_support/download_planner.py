@@ -0,0 +1,77 @@
+import logging
+import numpy as np
+
+## Assumptions used without download history
+DEFAULT_SAMPLING_RATE = 40.0
+DEFAULT_LATENCY = 3.0
+## Bytes of a decoded sample (int32), as recorded in the ledger
+BYTES_PER_SAMPLE = 4
+
+
+class DownloadPlan:
+    '''
+    The (station, event window, clients) requests of a download, built before any waveform request.
+    The duplicated events of a station are removed, and the volume and wall time of the download are
+    estimated from the sampling rates of the stations and the past requests of the ledger.
+    '''
+    def __init__(self,method='RF'):
+        self.logger = logging.getLogger(__name__)
+        self.method = method
+        self.stations = []
+
+    def add(self,sta,windows,clients):
+        '''
+        Add the windows of a station (stored in sta['windows']), keeping one window per event
+        '''
+        seen = set()
+        unique = []
+        for win in windows:
+            key = str(win['evtime'])
+            if key not in seen:
+                seen.add(key)
+                unique.append(win)
+        if len(unique) < len(windows):
+            self.logger.info(f"{sta['net']}-{sta['stn']}: removed {len(windows)-len(unique)} duplicated events")
+        sta['windows'] = unique
+        sta['clients'] = list(clients)
+        self.stations.append(sta)
+
+    @property
+    def nwindows(self):
+        return sum(len(sta['windows']) for sta in self.stations)
+
+    def estimate(self,sampling_rates=None,history=None,max_workers=1,nrequests=None,nchannels=3):
+        '''
+        Estimated bytes (decoded samples) and wall time of the plan.
+        sampling_rates maps (net, stn) to the sampling rate of the station, history is the
+        (number of requests, bytes, latency) of the past successful requests (DownloadLedger.throughput)
+        '''
+        sampling_rates = sampling_rates if sampling_rates is not None else {}
+        nbytes = 0.0
+        for sta in self.stations:
+            rate = sampling_rates.get((sta['net'],sta['stn']),DEFAULT_SAMPLING_RATE)
+            duration = np.sum([win['t2']-win['t1'] for win in sta['windows']])
+            nbytes += duration*rate*nchannels*BYTES_PER_SAMPLE
+        nrequests = self.nwindows if nrequests is None else nrequests
+        count, hbytes, hlatency = history if history else (0,0,0)
+        latency = hlatency/count if count else DEFAULT_LATENCY
+        throughput = hbytes/hlatency if hlatency else None
+        ## a request lasts its observed latency, or the transfer of its bytes at the observed throughput
+        per_request = max(latency, (nbytes/nrequests)/throughput) if throughput and nrequests else latency
+        walltime = nrequests*per_request/max(1,max_workers)
+        return {'stations': len(self.stations), 'windows': self.nwindows, 'requests': nrequests,
+                'bytes': nbytes, 'seconds_per_request': per_request, 'walltime': walltime, 'from_history': bool(count)}
+
+    def report(self,estimate):
+        lines = [f"Download plan ({self.method})",
+                f"stations: {estimate['stations']}",
+                f"event windows: {estimate['windows']}",
+                f"requests: {estimate['requests']}",
+                f"estimated volume: {estimate['bytes']/1024**2:.1f} MB",
+                f"estimated time per request: {estimate['seconds_per_request']:.2f} s ({'past downloads' if estimate['from_history'] else 'default'})",
+                f"estimated wall time: {estimate['walltime']/3600:.2f} h",
+                "",
+                "net|stn|windows|clients"]
+        for sta in self.stations:
+            lines.append(f"{sta['net']}|{sta['stn']}|{len(sta['windows'])}|{','.join(sta['clients'])}")
+        return "\n".join(lines)+"\n"
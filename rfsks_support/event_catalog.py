@@ -0,0 +1,161 @@
+import logging
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from obspy import UTCDateTime as UTC
+from obspy.core.event import Catalog
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.geodetics import locations2degrees
+from rfsks_support.fdsn_clients import get_client
+
+## Maximum number of station x event distances computed at once
+DIST_BLOCK = 5_000_000
+## km per degree of epicentral distance
+DEG2KM = 111.2
+
+
+def catalog_table(catalog,provider=''):
+    '''
+    DataFrame (evid, evtime, evlat, evlon, evdp, evmg, evmgtp, provider) of the preferred (or first) origin and
+    magnitude of the events. Events without depth or magnitude are dropped
+    '''
+    logger = logging.getLogger(__name__)
+    rows = []
+    for cat in catalog:
+        try:
+            org = cat.preferred_origin() or cat.origins[0]
+            mag = cat.preferred_magnitude() or cat.magnitudes[0]
+            rows.append((str(cat.resource_id),str(org.time),float(org.latitude),float(org.longitude),org.depth/1000,float(mag.mag),str(mag.magnitude_type or "Mww"),provider))
+        except Exception as exception:
+            logger.warning(f"Unable to read the event {cat.resource_id}")
+    df = pd.DataFrame(rows,columns=['evid','evtime','evlat','evlon','evdp','evmg','evmgtp','provider'])
+    return df.drop_duplicates('evid').reset_index(drop=True)
+
+
+def duplicate_groups(evtimes,evlats,evlons,seconds=16,km=100):
+    '''
+    Group of each event: the events with origin times within `seconds` and epicentres within `km` of each other
+    (possibly through other events) are in the same group. The events are hashed in (time, latitude) cells of the
+    tolerances and only compared with the events of the neighbouring cells
+    '''
+    evtimes = np.array([UTC(evtime).timestamp for evtime in evtimes])
+    evlats, evlons = np.asarray(evlats,dtype=float), np.asarray(evlons,dtype=float)
+    cells = {}
+    for i,key in enumerate(zip(np.floor(evtimes/seconds).astype(int),np.floor((evlats+90)*DEG2KM/km).astype(int))):
+        cells.setdefault(key,[]).append(i)
+    parent = np.arange(len(evtimes))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for (tcell,latcell),members in cells.items():
+        ## the pairs with the cells before in time are compared when their turn comes
+        others = [j for dt in (0,1) for dlat in (-1,0,1) for j in cells.get((tcell+dt,latcell+dlat),[])]
+        if len(others) < 2:
+            continue
+        i, j = np.array(members)[:,None], np.array(others)[None,:]
+        close = (i != j) & (np.abs(evtimes[i]-evtimes[j]) <= seconds) & (locations2degrees(evlats[i],evlons[i],evlats[j],evlons[j])*DEG2KM <= km)
+        for a,b in zip(*np.nonzero(close)):
+            parent[root(members[a])] = root(others[b])
+    return np.array([root(i) for i in range(len(evtimes))])
+
+
+def merge_catalogs(tables,providers,seconds=16,km=100,known=None):
+    '''
+    One event set from the catalog tables of several providers: the duplicated events (see duplicate_groups)
+    are replaced by the event of the first provider in the providers order (with its preferred origin and magnitude).
+    The events duplicating an event of known (e.g. the events already in the event table) are replaced by it
+    '''
+    logger = logging.getLogger(__name__)
+    events = pd.concat(tables,ignore_index=True) if tables else catalog_table([])
+    if not events.shape[0]:
+        return events
+    new = set(events['evid'])
+    rank = {provider: i for i,provider in enumerate(providers)}
+    events['rank'] = events['provider'].map(rank).fillna(len(providers))
+    if known is not None and known.shape[0]:
+        ## the known events of the same period come first, so they represent their group
+        tmin, tmax = str(UTC(events['evtime'].min())-seconds), str(UTC(events['evtime'].max())+seconds)
+        known = known[(known['evtime'] >= tmin) & (known['evtime'] <= tmax)]
+        events = pd.concat([known.assign(rank=-1),events],ignore_index=True)
+    events = events.sort_values('rank',kind='stable').drop_duplicates('evid').reset_index(drop=True)
+    events['group'] = duplicate_groups(events['evtime'],events['evlat'],events['evlon'],seconds=seconds,km=km)
+    merged = events.drop_duplicates('group')
+    merged = merged[merged['group'].isin(events.loc[events['evid'].isin(new),'group'])]
+    logger.info(f"{merged.shape[0]} events after merging the duplicates of {', '.join(providers)} ({len(new)} events)")
+    return merged.drop(columns=['rank','group']).reset_index(drop=True)
+
+
+def time_chunks(starttime,endtime,chunk_years=5):
+    '''
+    Split the period in chunks of chunk_years
+    '''
+    step = float(chunk_years)*365.25*86400
+    chunks = []
+    t1 = UTC(starttime)
+    while t1 < endtime:
+        t2 = min(t1+step,UTC(endtime))
+        chunks.append((t1,t2))
+        t1 = t2
+    return chunks
+
+
+def regional_catalog(client_name,clat,clon,minradius,maxradius,starttime,endtime,minmagnitude,maxmagnitude,chunk_years=5,max_workers=4,timeouts=None):
+    '''
+    One catalog for the whole region: the events between minradius and maxradius of (clat, clon),
+    requested in parallel time chunks. Returns the merged Catalog and the list of the chunks whose request
+    failed (a chunk without event is not a failure)
+    '''
+    logger = logging.getLogger(__name__)
+    timeouts = timeouts if timeouts is not None else {}
+    client = get_client(client_name,timeout=timeouts.get('metadata'),connect_timeout=timeouts.get('connect'),metadata=True)
+    chunks = time_chunks(starttime,endtime,chunk_years)
+    logger.info(f"Obtaining the regional catalog from {client_name} in {len(chunks)} time chunks")
+
+    def request(chunk):
+        kwargs = {'starttime': chunk[0], 'endtime': chunk[1],
+                    'latitude': clat, 'longitude': clon,
+                    'minradius': minradius, 'maxradius': maxradius,
+                    'minmagnitude': minmagnitude, 'maxmagnitude': maxmagnitude}
+        try:
+            return client.get_events(**kwargs)
+        except FDSNNoDataException:
+            logger.debug(f"No events for {chunk[0]}-{chunk[1]}")
+            return Catalog()
+        except Exception as exception:
+            msg = str(exception).split("\n")[0]
+            logger.warning(f"Unable to obtain the events of {chunk[0]}-{chunk[1]} from {client_name}: {msg}")
+            return None
+
+    catalog, failed = Catalog(), []
+    with ThreadPoolExecutor(max_workers=max(1,int(max_workers))) as executor:
+        for chunk,cat in zip(chunks,executor.map(request,chunks)):
+            if cat is None:
+                failed.append(chunk)
+            else:
+                catalog += cat
+    return catalog, failed
+
+
+def assign_events(stalats,stalons,stimes,etimes,events,minradius,maxradius):
+    '''
+    Indices of the events of each station: within minradius-maxradius of the station and during its epoch,
+    and their distances (deg). The station x event distances are computed in blocks of stations with numpy
+    '''
+    evlats = events['evlat'].values
+    evlons = events['evlon'].values
+    evtimes = np.array([UTC(evtime).timestamp for evtime in events['evtime']])
+    stalats, stalons = np.asarray(stalats,dtype=float), np.asarray(stalons,dtype=float)
+    stimes = np.array([UTC(val).timestamp for val in stimes])
+    etimes = np.array([UTC(val).timestamp for val in etimes])
+    block = max(1,DIST_BLOCK//max(1,len(evlats)))
+    assigned, distances = [], []
+    for i in range(0,len(stalats),block):
+        dists = locations2degrees(stalats[i:i+block,None],stalons[i:i+block,None],evlats[None,:],evlons[None,:])
+        inside = (dists >= minradius) & (dists <= maxradius) & (evtimes[None,:] >= stimes[i:i+block,None]) & (evtimes[None,:] <= etimes[i:i+block,None])
+        for row,dist in zip(inside,dists):
+            idx = np.flatnonzero(row)
+            assigned.append(idx)
+            distances.append(dist[idx])
+    return assigned, distances
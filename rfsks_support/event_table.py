@@ -0,0 +1,145 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+
+def save_npz(fname,**arrays):
+    ## written to a temporary file first, so an interrupted write does not leave a truncated table
+    with open(fname+'.tmp','wb') as f:
+        np.savez_compressed(f,**arrays)
+    os.replace(fname+'.tmp',fname)
+
+
+def back_azimuths(slat,slon,evlats,evlons):
+    '''
+    Back-azimuth (deg, clockwise from north) of the events seen from the station, on the sphere
+    '''
+    slat, slon = np.radians(slat), np.radians(slon)
+    evlats, evlons = np.radians(np.asarray(evlats,dtype=float)), np.radians(np.asarray(evlons,dtype=float))
+    dlon = evlons-slon
+    baz = np.degrees(np.arctan2(np.sin(dlon)*np.cos(evlats),np.cos(slat)*np.sin(evlats)-np.sin(slat)*np.cos(evlats)*np.cos(dlon)))
+    return baz % 360
+
+
+class EventTable:
+    '''
+    Columnar table of the events of the project (one row per event id, shared by the RF and SKS catalogs),
+    saved as a compressed npz. Rows are only appended, so the row of an event never changes and the station
+    indexes can refer to it
+    '''
+    columns = ['evid','evtime','evlat','evlon','evdp','evmg','evmgtp']
+    float_columns = ('evlat','evlon','evdp','evmg')
+
+    def __init__(self,events=None):
+        if events is None:
+            events = pd.DataFrame({col: np.array([],dtype=float if col in self.float_columns else str) for col in self.columns})
+        self.events = events.reset_index(drop=True)
+        self.rows = pd.Series(np.arange(len(self.events)),index=self.events['evid'].values)
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self,events):
+        '''
+        Append the events (see event_catalog.catalog_table) not in the table yet. Returns the rows of all the given events
+        '''
+        new = events[~events['evid'].isin(self.rows.index)].drop_duplicates('evid')
+        if len(new):
+            self.events = pd.concat([self.events,new[self.columns]],ignore_index=True)
+            self.rows = pd.Series(np.arange(len(self.events)),index=self.events['evid'].values)
+        return self.rows.loc[events['evid'].values].values
+
+    def save(self,fname):
+        save_npz(fname,**{col: self.events[col].values.astype(float if col in self.float_columns else str) for col in self.columns})
+
+    @classmethod
+    def load(cls,fname):
+        '''
+        Table saved in fname (empty if the file does not exist)
+        '''
+        if not os.path.exists(fname):
+            return cls()
+        with np.load(fname) as data:
+            return cls(pd.DataFrame({col: data[col] for col in cls.columns}))
+
+
+class StationEventIndex:
+    '''
+    Station -> event index of one method: the events assigned to each station epoch as rows of the EventTable
+    (eventfile), with the epicentral distance and the back-azimuth from the station precomputed (float32).
+    Saved as a compressed npz in the info directory of the method (station_events-{method}.npz)
+    '''
+    columns = ['net','stn','row','dist','baz']
+
+    def __init__(self,eventfile,pairs=None):
+        self.eventfile = eventfile
+        if pairs is None:
+            pairs = pd.DataFrame({'net':np.array([],dtype=str),'stn':np.array([],dtype=str),'row':np.array([],dtype=np.int32),
+                        'dist':np.array([],dtype=np.float32),'baz':np.array([],dtype=np.float32)})
+        self.pairs = pairs
+        self.table = None
+        self.groups = None
+
+    @staticmethod
+    def indexfile(infoloc,method):
+        return os.path.join(infoloc,f'station_events-{method}.npz')
+
+    def add_many(self,stations):
+        '''
+        Add the events of several stations at once, skipping the known pairs: stations is a list of
+        (net, stn, rows, dists, bazs) with the EventTable rows of the events, their distances and back-azimuths
+        '''
+        if not stations:
+            return
+        sizes = [len(rows) for net,stn,rows,dists,bazs in stations]
+        new = pd.DataFrame({'net':np.repeat([str(sta[0]) for sta in stations],sizes),'stn':np.repeat([str(sta[1]) for sta in stations],sizes),
+                    'row':np.concatenate([np.asarray(sta[2],dtype=np.int32) for sta in stations]),
+                    'dist':np.concatenate([np.asarray(sta[3],dtype=np.float32) for sta in stations]),
+                    'baz':np.concatenate([np.asarray(sta[4],dtype=np.float32) for sta in stations])})
+        self.pairs = pd.concat([self.pairs,new],ignore_index=True).drop_duplicates(['net','stn','row']).reset_index(drop=True)
+        self.groups = None
+
+    def counts(self):
+        '''
+        Dict "net-stn" -> number of events of the station
+        '''
+        sizes = self.pairs.groupby(['net','stn']).size()
+        return {f"{net}-{stn}": int(size) for (net,stn),size in sizes.items()}
+
+    def station_catalog(self,net,stn):
+        '''
+        DataFrame (evid, evtime, evlat, evlon, evdp, evmg, evmgtp, dist, baz) of the events of a station, in time order
+        '''
+        if self.table is None:
+            self.table = EventTable.load(self.eventfile) if self.eventfile else EventTable()
+        if self.groups is None:
+            self.groups = self.pairs.groupby(['net','stn']).indices
+        idx = self.groups.get((str(net),str(stn)),np.array([],dtype=int))
+        pairs = self.pairs.iloc[idx]
+        df = self.table.events.iloc[pairs['row'].values].reset_index(drop=True)
+        df['dist'] = pairs['dist'].values
+        df['baz'] = pairs['baz'].values
+        return df.sort_values('evtime',kind='stable').reset_index(drop=True)
+
+    def save(self,fname):
+        dtypes = {'net':str,'stn':str,'row':np.int32,'dist':np.float32,'baz':np.float32}
+        save_npz(fname,eventfile=np.array(self.eventfile),**{col: self.pairs[col].values.astype(dtypes[col]) for col in self.columns})
+
+    @classmethod
+    def load(cls,fname,eventfile=None):
+        '''
+        Index saved in fname (empty, referring to eventfile, if the file does not exist)
+        '''
+        if not os.path.exists(fname):
+            return cls(eventfile)
+        with np.load(fname) as data:
+            return cls(eventfile or str(data['eventfile']),pd.DataFrame({col: data[col] for col in cls.columns}))
+
+
+def load_station_indexes(infoloc):
+    '''
+    Station event indexes saved in an info directory
+    '''
+    return {os.path.basename(fname)[len('station_events-'):-len('.npz')]: StationEventIndex.load(fname)
+                for fname in sorted(glob.glob(os.path.join(infoloc,'station_events-*.npz')))}
@@ -0,0 +1,64 @@
+import time
+import threading
+import logging
+from obspy.clients.fdsn import Client
+from rfsks_support.other_support import timed_call
+from rfsks_support.local_sources import LocalWaveformClient, is_local_source
+from rfsks_support.telemetry import telemetry, instrument, request_status
+
+## Process-wide registry of FDSN clients, one per datacenter
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name,timeout=None,connect_timeout=None,metadata=False):
+    '''
+    Return the FDSN client for the datacenter `name`, creating it on first use.
+    With metadata, a separate client of the datacenter is returned for the station and event requests,
+    so their (longer) socket timeout does not apply to the waveform requests.
+    A name such as "SDS:/path/to/archive" or "MSEED:/path/to/dir" returns a LocalWaveformClient.
+    The service discovery is done only once per process and the client is shared between threads.
+    The requests of the FDSN clients (and their service discovery) are recorded in the telemetry.
+    timeout is the socket timeout of the client requests, connect_timeout bounds the service discovery
+    (RequestTimeout is raised if it takes longer). Both are only used when the client is created.
+    '''
+    key = (name,'metadata') if metadata else name
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            logger = logging.getLogger(__name__)
+            logger.debug(f"Creating FDSN client for {name}")
+            if is_local_source(name):
+                client = LocalWaveformClient(name)
+            else:
+                kwargs = {'timeout': timeout} if timeout else {}
+                start = time.monotonic()
+                try:
+                    client = timed_call(connect_timeout,Client,name,**kwargs)
+                except Exception as exception:
+                    telemetry.record(name,'discovery',time.monotonic()-start,0,request_status(exception))
+                    raise
+                telemetry.record(name,'discovery',time.monotonic()-start)
+                client = instrument(client,name)
+            _clients[key] = client
+    return client
+
+
+def register_client(name,client):
+    '''
+    Use client for the datacenter `name` (e.g. a client of a local FDSN stand-in server),
+    for the waveform and the metadata requests
+    '''
+    with _clients_lock:
+        _clients[name] = _clients[(name,'metadata')] = instrument(client,name)
+
+
+def clear_clients():
+    '''
+    Drop all the cached clients (e.g. after a datacenter changed its services)
+    '''
+    with _clients_lock:
+        _clients.clear()
@@ -0,0 +1,311 @@
+import io
+import copy
+import time
+import zlib
+import fnmatch
+import logging
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from obspy import Stream, Trace, UTCDateTime as UTC
+from obspy.core.inventory import Inventory, Network, Station, Channel, Site
+from obspy.core.event import Catalog, Event, Origin, Magnitude, ResourceIdentifier
+from obspy.geodetics import locations2degrees
+
+## short and long names of the FDSN query parameters
+PARAM_ALIASES = {'net': 'network', 'sta': 'station', 'loc': 'location', 'cha': 'channel', 'start': 'starttime', 'end': 'endtime',
+    'minlat': 'minlatitude', 'maxlat': 'maxlatitude', 'minlon': 'minlongitude', 'maxlon': 'maxlongitude',
+    'lat': 'latitude', 'lon': 'longitude', 'minmag': 'minmagnitude', 'maxmag': 'maxmagnitude'}
+
+
+def synthetic_inventory(nstations=10,region=(-10,10,-10,10),network='XX',sampling_rate=40.0,starttime=UTC(2000,1,1),seed=0):
+    '''
+    Inventory of nstations broadband stations (BHZ, BHN, BHE) at random positions in the region (minlon, maxlon, minlat, maxlat)
+    '''
+    rng = np.random.default_rng(seed)
+    lons = rng.uniform(region[0],region[1],nstations)
+    lats = rng.uniform(region[2],region[3],nstations)
+    stations = []
+    for i,(lon,lat) in enumerate(zip(lons,lats)):
+        sta = Station(code=f"S{i:03d}",latitude=float(lat),longitude=float(lon),elevation=0.0,start_date=UTC(starttime),
+                    creation_date=UTC(starttime),site=Site(name=f"Synthetic station {i}"))
+        for comp,azimuth,dip in (('Z',0.0,-90.0),('N',0.0,0.0),('E',90.0,0.0)):
+            sta.channels.append(Channel(code=f"BH{comp}",location_code="",latitude=float(lat),longitude=float(lon),elevation=0.0,depth=0.0,
+                    azimuth=azimuth,dip=dip,sample_rate=float(sampling_rate),start_date=UTC(starttime)))
+        stations.append(sta)
+    return Inventory(networks=[Network(code=network,stations=stations,start_date=UTC(starttime))],source="rfsks-standin")
+
+
+def synthetic_catalog(nevents=100,starttime=UTC(2010,1,1),endtime=UTC(2020,1,1),minmagnitude=5.5,maxmagnitude=7.5,seed=0):
+    '''
+    Catalog of nevents uniformly distributed on the sphere and in time
+    '''
+    rng = np.random.default_rng(seed)
+    times = np.sort(rng.uniform(UTC(starttime).timestamp,UTC(endtime).timestamp,nevents))
+    lats = np.degrees(np.arcsin(rng.uniform(-1,1,nevents)))
+    lons = rng.uniform(-180,180,nevents)
+    depths = rng.uniform(10,600,nevents)
+    mags = rng.uniform(minmagnitude,maxmagnitude,nevents)
+    catalog = Catalog()
+    for i in range(nevents):
+        catalog.append(Event(resource_id=ResourceIdentifier(f"smi:rfsks/standin/event/{i}"),
+                origins=[Origin(time=UTC(times[i]),latitude=float(lats[i]),longitude=float(lons[i]),depth=float(depths[i])*1000)],
+                magnitudes=[Magnitude(mag=round(float(mags[i]),1),magnitude_type="Mww")]))
+    return catalog
+
+
+def match(code,patterns):
+    '''
+    True if code matches one of the comma separated FDSN patterns ("--" is the empty location code)
+    '''
+    if patterns is None:
+        return True
+    return any(fnmatch.fnmatchcase(code,"" if pattern.strip()=="--" else pattern.strip()) for pattern in patterns.split(","))
+
+
+class StandinData:
+    '''
+    Content served by the stand-in: an inventory, a catalog and either recorded waveforms
+    (a LocalWaveformClient of a miniSEED directory or SDS archive) or synthetic noise at the channel sampling rates
+    '''
+    def __init__(self,inventory,catalog,waveforms=None,seed=0):
+        self.inventory = inventory
+        self.catalog = catalog
+        self.waveforms = waveforms
+        self.seed = seed
+        ## event arrays for the vectorized event queries
+        self.events = list(catalog)
+        self.evtimes = np.array([ev.origins[0].time.timestamp for ev in self.events])
+        self.evlats = np.array([ev.origins[0].latitude for ev in self.events])
+        self.evlons = np.array([ev.origins[0].longitude for ev in self.events])
+        self.evmags = np.array([ev.magnitudes[0].mag for ev in self.events])
+        self.channels = [(net.code,sta.code,cha.location_code,cha.code,cha.sample_rate,cha.start_date,cha.end_date)
+                            for net in inventory for sta in net for cha in sta]
+
+    def stations(self,params):
+        inv = Inventory(networks=[],source=self.inventory.source)
+        level = params.get('level','station')
+        box = [float(params[key]) if key in params else default for key,default in
+                (('minlongitude',-180),('maxlongitude',180),('minlatitude',-90),('maxlatitude',90))]
+        for net in self.inventory:
+            if not match(net.code,params.get('network')):
+                continue
+            stations = []
+            for sta in net:
+                if not (match(sta.code,params.get('station')) and box[0] <= sta.longitude <= box[1] and box[2] <= sta.latitude <= box[3]):
+                    continue
+                channels = [cha for cha in sta if match(cha.location_code,params.get('location')) and match(cha.code,params.get('channel'))]
+                if not channels:
+                    continue
+                sta = copy.copy(sta)
+                sta.channels = channels if level in ('channel','response') else []
+                stations.append(sta)
+            if stations:
+                net = copy.copy(net)
+                net.stations = stations
+                inv.networks.append(net)
+        if not inv.networks:
+            return None
+        buf = io.BytesIO()
+        inv.write(buf,'STATIONXML')
+        return buf.getvalue()
+
+    def events_query(self,params):
+        keep = np.ones(len(self.events),dtype=bool)
+        if 'starttime' in params:
+            keep &= self.evtimes >= UTC(params['starttime']).timestamp
+        if 'endtime' in params:
+            keep &= self.evtimes <= UTC(params['endtime']).timestamp
+        if 'minmagnitude' in params:
+            keep &= self.evmags >= float(params['minmagnitude'])
+        if 'maxmagnitude' in params:
+            keep &= self.evmags <= float(params['maxmagnitude'])
+        for key,values,cmp in (('minlatitude',self.evlats,np.greater_equal),('maxlatitude',self.evlats,np.less_equal),
+                                ('minlongitude',self.evlons,np.greater_equal),('maxlongitude',self.evlons,np.less_equal)):
+            if key in params:
+                keep &= cmp(values,float(params[key]))
+        if 'latitude' in params and 'longitude' in params:
+            dists = locations2degrees(float(params['latitude']),float(params['longitude']),self.evlats,self.evlons)
+            keep &= (dists >= float(params.get('minradius',0))) & (dists <= float(params.get('maxradius',180)))
+        if not keep.any():
+            return None
+        buf = io.BytesIO()
+        Catalog(events=[self.events[i] for i in np.flatnonzero(keep)]).write(buf,'QUAKEML')
+        return buf.getvalue()
+
+    def traces(self,net,sta,loc,cha,t1,t2):
+        '''
+        Traces of the channels matching the (possibly comma separated or wildcarded) codes between t1 and t2
+        '''
+        t1, t2 = UTC(t1), UTC(t2)
+        st = Stream()
+        for cnet,csta,cloc,ccha,rate,start,end in self.channels:
+            if not (match(cnet,net) and match(csta,sta) and match(cloc,loc) and match(ccha,cha)):
+                continue
+            if (start and start > t2) or (end and end < t1):
+                continue
+            if self.waveforms is not None:
+                try:
+                    st += self.waveforms.get_waveforms(cnet,csta,cloc,ccha,t1,t2)
+                except Exception:
+                    continue
+            else:
+                ## deterministic noise for a given channel and window
+                rng = np.random.default_rng(zlib.crc32(f"{cnet}.{csta}.{cloc}.{ccha}.{t1.timestamp}".encode())+self.seed)
+                npts = int((t2-t1)*rate)
+                data = rng.normal(0,1000,npts).astype(np.int32)
+                st += Trace(data=data,header={'network':cnet,'station':csta,'location':cloc,'channel':ccha,'sampling_rate':rate,'starttime':t1})
+        return st
+
+    def dataselect(self,requests):
+        st = Stream()
+        for net,sta,loc,cha,t1,t2 in requests:
+            st += self.traces(net,sta,loc,cha,t1,t2)
+        if not len(st):
+            return None
+        buf = io.BytesIO()
+        st.write(buf,'MSEED')
+        return buf.getvalue()
+
+    def availability(self,params):
+        t1, t2 = UTC(params.get('starttime',UTC(0))), UTC(params.get('endtime',UTC()))
+        lines = ["#Network Station Location Channel Quality SampleRate Earliest Latest"]
+        for cnet,csta,cloc,ccha,rate,start,end in self.channels:
+            if not (match(cnet,params.get('network')) and match(csta,params.get('station')) and match(cloc,params.get('location')) and match(ccha,params.get('channel'))):
+                continue
+            span1, span2 = max(t1,start or t1), min(t2,end or t2)
+            if span1 < span2:
+                lines.append(f"{cnet} {csta} {cloc or '--'} {ccha} M {rate} {span1} {span2}")
+        return "\n".join(lines).encode() if len(lines) > 1 else None
+
+
+class StandinServer:
+    '''
+    Local HTTP stand-in of the FDSN station, event, dataselect and availability services of one datacenter,
+    with injected latency (latency + uniform jitter, s) and failures: failure_rate of the requests answered
+    with HTTP 503, timeout_rate of them stalled for hang s, nodata_rate of the dataselect requests answered with 204.
+    Used with an obspy Client created with _discover_services=False (see download_benchmark)
+    '''
+    def __init__(self,data,host='127.0.0.1',port=0,latency=0.0,jitter=0.0,failure_rate=0.0,timeout_rate=0.0,nodata_rate=0.0,hang=30.0,seed=0):
+        self.logger = logging.getLogger(__name__)
+        self.data = data
+        self.latency, self.jitter, self.hang = float(latency), float(jitter), float(hang)
+        self.failure_rate, self.timeout_rate, self.nodata_rate = float(failure_rate), float(timeout_rate), float(nodata_rate)
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.httpd = ThreadingHTTPServer((host,port),self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self.thread.start()
+        self.logger.info(f"FDSN stand-in serving at {self.url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*args):
+        self.stop()
+
+    def count(self,service,outcome):
+        with self.lock:
+            self.counts[(service,outcome)] = self.counts.get((service,outcome),0)+1
+
+    def draw(self):
+        with self.lock:
+            return self.rng.uniform(), self.rng.uniform(0,self.jitter) if self.jitter else 0.0
+
+    def respond(self,service,params,requests=None):
+        '''
+        (HTTP status, body) of a request
+        '''
+        outcome, delay = self.draw()
+        time.sleep(self.latency+delay)
+        if outcome < self.timeout_rate:
+            self.count(service,'timeout')
+            time.sleep(self.hang)
+            return 503, None
+        if outcome < self.timeout_rate+self.failure_rate:
+            self.count(service,'503')
+            return 503, None
+        if service == 'dataselect' and outcome < self.timeout_rate+self.failure_rate+self.nodata_rate:
+            self.count(service,'204')
+            return 204, None
+        if service == 'station':
+            body = self.data.stations(params)
+        elif service == 'event':
+            body = self.data.events_query(params)
+        elif service == 'dataselect':
+            if requests is None:
+                requests = [(params.get('network'),params.get('station'),params.get('location'),params.get('channel'),params['starttime'],params['endtime'])]
+            body = self.data.dataselect(requests)
+        elif service == 'availability':
+            body = self.data.availability(params)
+        else:
+            self.count(service,'404')
+            return 404, None
+        status = 200 if body is not None else 204
+        self.count(service,str(status))
+        return status, body
+
+    def handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def parse(self):
+                url = urlparse(self.path)
+                parts = [part for part in url.path.split("/") if part]
+                service = parts[1] if len(parts) >= 4 and parts[0] == 'fdsnws' else 'other'
+                params = {PARAM_ALIASES.get(key,key): values[-1] for key,values in parse_qs(url.query).items()}
+                return service, params
+
+            def reply(self,status,body):
+                self.send_response(status)
+                self.send_header('Content-Length',str(len(body) if body else 0))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                service, params = self.parse()
+                try:
+                    self.reply(*standin.respond(service,params))
+                except Exception as exception:
+                    standin.logger.debug(f"Bad request {self.path}: {exception}")
+                    self.reply(400,str(exception).encode())
+
+            def do_POST(self):
+                service, params = self.parse()
+                body = self.rfile.read(int(self.headers.get('Content-Length',0))).decode()
+                requests = []
+                for line in body.splitlines():
+                    if "=" in line:
+                        key, value = line.split("=",1)
+                        params[PARAM_ALIASES.get(key.strip(),key.strip())] = value.strip()
+                    elif line.strip():
+                        requests.append(tuple(line.split()[:6]))
+                try:
+                    self.reply(*standin.respond(service,params,requests=requests))
+                except Exception as exception:
+                    standin.logger.debug(f"Bad request {self.path}: {exception}")
+                    self.reply(400,str(exception).encode())
+
+            def log_message(self,format,*args):
+                standin.logger.debug(format % args)
+
+        return Handler
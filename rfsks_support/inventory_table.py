@@ -0,0 +1,147 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from obspy import read_inventory
+from obspy import UTCDateTime as UTC
+
+
+def file_digest(fname,blocksize=1<<20):
+    sha = hashlib.sha1()
+    with open(fname,'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_stamp(fname):
+    '''
+    (modification time in ns, size) of a file, compared before hashing it
+    '''
+    stat = os.stat(fname)
+    return np.array([stat.st_mtime_ns,stat.st_size],dtype=np.int64)
+
+
+class InventoryTable:
+    '''
+    Columnar table of the station and channel epochs of an inventory (coordinates, site name, start and end times,
+    sampling rate), saved next to the StationXML file as a compressed npz. Loading it takes milliseconds instead of
+    parsing the StationXML again; it is rebuilt when the StationXML content changes. The content is only hashed
+    when the modification time or size of the StationXML file differs from the ones saved with the table.
+    '''
+    station_columns = ['net','stn','slat','slon','elev','sitename','start','end']
+    channel_columns = ['net','stn','loc','cha','clat','clon','start','end','sampling_rate']
+
+    def __init__(self,stations,channels):
+        self.stations = stations
+        self.channels = channels
+
+    @classmethod
+    def from_inventory(cls,inv):
+        stations, channels = [], []
+        for net in inv:
+            for sta in net:
+                stations.append((net.code,sta.code,sta.latitude,sta.longitude,sta.elevation,
+                    str(sta.site.name or ''),str(sta.start_date),str(sta.end_date) if sta.end_date else ''))
+                for cha in sta:
+                    channels.append((net.code,sta.code,cha.location_code,cha.code,cha.latitude,cha.longitude,
+                        str(cha.start_date),str(cha.end_date) if cha.end_date else '',cha.sample_rate or 0))
+        return cls(pd.DataFrame(stations,columns=cls.station_columns),pd.DataFrame(channels,columns=cls.channel_columns))
+
+    def sampling_rates(self,channel="BHZ,BHE,BHN"):
+        '''
+        Dict (net, stn) -> highest sampling rate of the channels of the station
+        '''
+        cha = self.channels[self.channels['cha'].isin([ch.strip() for ch in channel.split(",")])]
+        rates = cha.groupby(['net','stn'])['sampling_rate'].max()
+        return {key: float(val) for key,val in rates.items()}
+
+    @staticmethod
+    def cachefile(inventoryfile):
+        return os.path.splitext(inventoryfile)[0]+'_table.npz'
+
+    def save(self,inventoryfile,digest=None):
+        arrays = {f"sta_{col}": self.stations[col].values.astype(float if col in ('slat','slon','elev') else str) for col in self.station_columns}
+        arrays.update({f"cha_{col}": self.channels[col].values.astype(float if col in ('clat','clon','sampling_rate') else str) for col in self.channel_columns})
+        np.savez_compressed(self.cachefile(inventoryfile),digest=np.array(digest or file_digest(inventoryfile)),stamp=file_stamp(inventoryfile),**arrays)
+
+    @classmethod
+    def load(cls,inventoryfile):
+        '''
+        Table of the StationXML file if its cache is up to date, None otherwise
+        '''
+        cachefile = cls.cachefile(inventoryfile)
+        if not os.path.exists(cachefile):
+            return None
+        with np.load(cachefile) as data:
+            touched = 'stamp' not in data.files or not np.array_equal(data['stamp'],file_stamp(inventoryfile))
+            digest = str(data['digest'])
+            if touched and digest != file_digest(inventoryfile):
+                return None
+            stations = pd.DataFrame({col: data[f"sta_{col}"] for col in cls.station_columns})
+            channels = pd.DataFrame({col: data[f"cha_{col}"] for col in cls.channel_columns})
+        table = cls(stations,channels)
+        if touched:
+            ## same content (e.g. the file was copied): the new modification time is saved to skip the hash next time
+            table.save(inventoryfile,digest=digest)
+        return table
+
+
+class ChannelSelector:
+    '''
+    Choose the channels of each station epoch and location among the bands (e.g. BH, HH, EH, SH): the band with
+    Z, N and E components active at the event time and the lowest sampling rate still >= min_rate
+    (ties are broken by the order of bands). The traces are then decimated to 20 Hz by the RF/SKS filters
+    '''
+    components = ('E','N','Z')
+
+    def __init__(self,table,bands=('BH','HH'),min_rate=20,default="BHE,BHN,BHZ"):
+        self.bands = [band.strip() for band in bands]
+        self.min_rate = float(min_rate)
+        self.default = default
+        self.epochs = {}
+        cha = table.channels[table.channels['cha'].str[:2].isin(self.bands) & table.channels['cha'].str[2:].isin(self.components)]
+        for net,stn,loc,code,start,end,rate in zip(cha['net'],cha['stn'],cha['loc'],cha['cha'],cha['start'],cha['end'],cha['sampling_rate']):
+            self.epochs.setdefault((net,stn,"" if loc in ("--",None) else str(loc)),[]).append((code[:2],code[2],UTC(start).timestamp,UTC(end).timestamp if end else np.inf,float(rate)))
+
+    def band(self,net,stn,evtime,loc=""):
+        '''
+        Band selected at the location of the station at evtime, None if no band is complete there
+        '''
+        t = UTC(evtime).timestamp
+        bands = {}
+        for band,comp,start,end,rate in self.epochs.get((net,stn,loc),[]):
+            if start <= t <= end and rate >= self.min_rate:
+                comps, minrate = bands.get(band,(set(),np.inf))
+                bands[band] = (comps | {comp}, min(minrate,rate))
+        complete = [(rate,self.bands.index(band),band) for band,(comps,rate) in bands.items() if comps >= set(self.components)]
+        return min(complete)[2] if complete else None
+
+    def select(self,net,stn,evtime,locations=("",)):
+        '''
+        Comma separated channels of the station at evtime and the locations (in the given order) where they
+        are complete: the band is the one selected at the first location with a complete band.
+        Returns the default channels and all the locations if no band is complete at any location
+        '''
+        bands = {loc: self.band(net,stn,evtime,loc) for loc in locations}
+        chosen = next((band for band in bands.values() if band is not None),None)
+        if chosen is None:
+            return self.default, list(locations)
+        return ",".join(chosen+comp for comp in self.components), [loc for loc,band in bands.items() if band == chosen]
+
+
+def load_inventory_table(inventoryfile,inv=None):
+    '''
+    Station/channel table of the StationXML file: loaded from its cache, or built from inv
+    (read from the file if not given) and cached
+    '''
+    logger = logging.getLogger(__name__)
+    table = InventoryTable.load(inventoryfile) if inv is None else None
+    if table is None:
+        if inv is None:
+            logger.info(f"Reading {os.path.basename(inventoryfile)} to build the inventory table")
+            inv = read_inventory(inventoryfile, format="STATIONXML")
+        table = InventoryTable.from_inventory(inv)
+        table.save(inventoryfile)
+    return table
@@ -0,0 +1,51 @@
+import copy
+import logging
+import numpy as np
+from obspy import Inventory
+
+
+def region_tiles(minlongitude,maxlongitude,minlatitude,maxlatitude,tile_deg=20):
+    '''
+    Split the region in tiles of at most tile_deg x tile_deg degrees (a single tile if tile_deg is 0)
+    '''
+    if not tile_deg or tile_deg <= 0:
+        return [(minlongitude,maxlongitude,minlatitude,maxlatitude)]
+    nlon = max(1,int(np.ceil((maxlongitude-minlongitude)/tile_deg)))
+    nlat = max(1,int(np.ceil((maxlatitude-minlatitude)/tile_deg)))
+    lons = np.linspace(minlongitude,maxlongitude,nlon+1)
+    lats = np.linspace(minlatitude,maxlatitude,nlat+1)
+    return [(float(lons[i]),float(lons[i+1]),float(lats[j]),float(lats[j+1])) for i in range(nlon) for j in range(nlat)]
+
+
+def merge_inventories(inventories):
+    '''
+    Merge the inventories, keeping only the first occurrence of each network, station and channel epoch
+    (stations on the tile boundaries or distributed by several datacenters)
+    '''
+    logger = logging.getLogger(__name__)
+    merged = Inventory(networks=[],source="rfsks")
+    networks, stations, channels = {}, {}, set()
+    nduplicates = 0
+    for inv in inventories:
+        for net in inv:
+            netkey = (net.code,str(net.start_date))
+            if netkey not in networks:
+                networks[netkey] = copy.copy(net)
+                networks[netkey].stations = []
+                merged.networks.append(networks[netkey])
+            for sta in net:
+                stakey = netkey+(sta.code,str(sta.start_date))
+                if stakey not in stations:
+                    stations[stakey] = copy.copy(sta)
+                    stations[stakey].channels = []
+                    networks[netkey].stations.append(stations[stakey])
+                for cha in sta:
+                    chakey = stakey+(cha.location_code,cha.code,str(cha.start_date))
+                    if chakey in channels:
+                        nduplicates += 1
+                        continue
+                    channels.add(chakey)
+                    stations[stakey].channels.append(cha)
+    if nduplicates:
+        logger.info(f"Removed {nduplicates} duplicated channels from the inventory")
+    return merged
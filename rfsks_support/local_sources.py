@@ -0,0 +1,138 @@
+import os
+import glob
+import threading
+import logging
+from obspy import read, read_inventory, Stream
+from obspy import UTCDateTime as UTC
+from obspy.clients.filesystem.sds import Client as SDSClient
+from obspy.clients.fdsn.header import FDSNNoDataException
+
+## Prefixes of the local waveform sources in the client list, e.g. "SDS:/data/archive"
+LOCAL_PREFIXES = ('SDS','MSEED')
+## Station metadata of a local source, looked up at the root of the archive/directory
+LOCAL_INVENTORY = 'inventory.xml'
+
+
+def is_local_source(name):
+    return ':' in str(name) and str(name).split(':',1)[0].upper() in LOCAL_PREFIXES
+
+
+class LocalWaveformClient:
+    '''
+    Waveform source reading a local SDS archive ("SDS:/path") or a directory of miniSEED files
+    ("MSEED:/path", indexed on first use) with the same get_waveforms, get_waveforms_bulk and
+    get_stations interface as the FDSN client.
+    The station metadata (and the responses for attach_response) are read from the StationXML
+    file inventory.xml at the root of the archive, if present.
+    Like an FDSN client, a request without data raises FDSNNoDataException.
+    '''
+    local = True
+
+    def __init__(self,name):
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        kind, root = str(name).split(':',1)
+        self.kind = kind.upper()
+        self.root = os.path.expanduser(root)
+        if not os.path.isdir(self.root):
+            raise ValueError(f"Local waveform source {self.root} does not exist")
+        self.lock = threading.Lock()
+        self.index = None
+        self.sds = SDSClient(self.root) if self.kind == 'SDS' else None
+        invfile = os.path.join(self.root,LOCAL_INVENTORY)
+        self.inventory = read_inventory(invfile) if os.path.exists(invfile) else None
+
+    def build_index(self):
+        '''
+        Map each (net, stn, loc, cha) to the (start, end, file) of its traces in the miniSEED files of the directory
+        '''
+        index = {}
+        for fname in glob.glob(os.path.join(self.root,'**','*'),recursive=True):
+            if not os.path.isfile(fname) or fname.endswith('.xml'):
+                continue
+            try:
+                st = read(fname,format='MSEED',headonly=True)
+            except Exception:
+                continue
+            for tr in st:
+                index.setdefault((tr.stats.network,tr.stats.station,tr.stats.location,tr.stats.channel),[]).append((tr.stats.starttime,tr.stats.endtime,fname))
+        self.logger.info(f"Indexed {sum(len(val) for val in index.values())} traces in {self.root}")
+        return index
+
+    def read_window(self,net,stn,loc,cha,t1,t2):
+        if self.sds is not None:
+            return self.sds.get_waveforms(net,stn,loc,cha,t1,t2)
+        with self.lock:
+            if self.index is None:
+                self.index = self.build_index()
+        st = Stream()
+        files = {fname for start,end,fname in self.index.get((net,stn,loc,cha),[]) if start<=t2 and end>=t1}
+        for fname in sorted(files):
+            st += read(fname,format='MSEED',starttime=t1,endtime=t2).select(network=net,station=stn,location=loc,channel=cha)
+        return st
+
+    def get_waveforms(self,network,station,location,channel,starttime,endtime,attach_response=False,**kwargs):
+        t1, t2 = UTC(starttime), UTC(endtime)
+        st = Stream()
+        for loc in location.split(","):
+            loc = "" if loc == "--" else loc
+            for cha in channel.split(","):
+                st += self.read_window(network,station,loc,cha.strip(),t1,t2)
+        if not len(st):
+            raise FDSNNoDataException(f"No data available for {network}-{station} in {self.name}")
+        st.trim(t1,t2)
+        if attach_response and self.inventory is not None:
+            st.attach_response(self.inventory)
+        return st
+
+    def get_availability(self,net,stn,starttime,endtime,channels="BHE,BHN,BHZ"):
+        '''
+        Spans (loc, cha, start, end) of the indexed traces of a miniSEED directory, None for an SDS archive
+        '''
+        if self.sds is not None:
+            return None
+        with self.lock:
+            if self.index is None:
+                self.index = self.build_index()
+        t1, t2 = UTC(starttime), UTC(endtime)
+        wanted = {cha.strip() for cha in channels.split(",")}
+        spans = []
+        for (inet,istn,loc,icha),traces in self.index.items():
+            if inet!=net or istn!=stn or icha not in wanted:
+                continue
+            ## merge the contiguous traces (e.g. day files) into continuous spans
+            merged = []
+            for start,end in sorted((start.timestamp,end.timestamp) for start,end,_ in traces if start<=t2 and end>=t1):
+                if merged and start <= merged[-1][1]+1.0:
+                    merged[-1][1] = max(merged[-1][1],end)
+                else:
+                    merged.append([start,end])
+            spans.extend((loc,icha,start,end) for start,end in merged)
+        return spans
+
+    def get_waveforms_bulk(self,bulk,attach_response=False,**kwargs):
+        st = Stream()
+        for net,stn,loc,cha,t1,t2 in bulk:
+            try:
+                st += self.get_waveforms(net,stn,loc,cha,t1,t2,attach_response=attach_response)
+            except FDSNNoDataException:
+                continue
+        if not len(st):
+            raise FDSNNoDataException(f"No data available for the bulk request in {self.name}")
+        return st
+
+    def get_stations(self,network='*',station='*',channel='*',level='channel',minlongitude=None,maxlongitude=None,minlatitude=None,maxlatitude=None,**kwargs):
+        if self.inventory is None:
+            raise FDSNNoDataException(f"No {LOCAL_INVENTORY} in {self.root}")
+        inv = self.inventory.select(network=network,station=station,minlongitude=minlongitude,maxlongitude=maxlongitude,minlatitude=minlatitude,maxlatitude=maxlatitude)
+        channels = [cha.strip() for cha in channel.split(",")]
+        if len(channels) > 1 and len({cha[:-1] for cha in channels}) == 1:
+            ## fnmatch pattern such as BH[ENZ] for BHE,BHN,BHZ
+            sel = inv.select(channel=f"{channels[0][:-1]}[{''.join(cha[-1] for cha in channels)}]")
+        else:
+            sel = inv.select(channel=channels[0])
+            for cha in channels[1:]:
+                sel += inv.select(channel=cha)
+        if not len(sel.get_contents()['stations']):
+            raise FDSNNoDataException(f"No stations found in {LOCAL_INVENTORY} of {self.root}")
+        return sel
@@ -2,10 +2,11 @@ import os, tqdm, glob, sys
 import shutil
 import numpy as np
 from obspy import UTCDateTime as UTC
+from rfsks_support.inventory_table import load_inventory_table
 import pandas as pd
 import logging
 import logging.config
-import signal
+import threading
 import time
 import yaml
 
@@ -34,15 +35,6 @@ def setup_logging(
         print("Selecting basic config")
         logging.basicConfig(level=default_level)
 
-def rem_duplicate_lines(inpfile,outfile):
-    lines_seen = set() # holds lines already seen
-    outfile = open(outfile, "w")
-    for line in open(inpfile, "r"):
-        if line not in lines_seen: # not a duplicate
-            outfile.write(line)
-            lines_seen.add(line)
-    outfile.close()
-
 def create_dir(direc):
     '''
     Create a directory
@@ -104,13 +96,13 @@ def date2time(sta_sdate,sta_edate):
     return UTC(stime), UTC(etime)
 
 def write_station_file(inventorytxtfile,rf_staNetNames,outfile):
+    '''
+    Write the rows of the inventory text file of the "net_sta" stations (in the inventory order)
+    '''
     df_stations = pd.read_csv(inventorytxtfile,sep="|")
-    allnetsrf = [netsta.split("_")[0] for netsta in set(rf_staNetNames)]
-    allstnsrf = [netsta.split("_")[1] for netsta in set(rf_staNetNames)]
-    df_stations_new = pd.DataFrame()
-    for net, stn in zip(allnetsrf,allstnsrf):
-        df_stations_extract = df_stations[(df_stations['#Network']==net) & (df_stations['Station']==stn)]
-        df_stations_new = df_stations_new.append(df_stations_extract, ignore_index=True)
+    net_sta = {(netsta.split("_")[0],netsta.split("_")[1]) for netsta in set(rf_staNetNames)}
+    selected = pd.MultiIndex.from_arrays([df_stations['#Network'],df_stations['Station']]).isin(net_sta)
+    df_stations_new = df_stations[selected].reset_index(drop=True) if net_sta else pd.DataFrame()
     df_stations_new.to_csv(outfile, index = None, header=True, sep = "|")
 
 
@@ -129,24 +121,34 @@ def obtain_inventory_events(rf_data,invRFfile,catalogxmlloc,network,station,dirs
     if obtain_events:
         logger.info("\n")
         logger.info("Obtaining events catalog")
-        rf_data.obtain_events(catalogxmlloc=catalogxmlloc,catalogtxtloc=catalogxmlloc,minmagnitude=minmagnitudeRF,maxmagnitude=maxmagnitudeRF)
+        rf_data.obtain_events(catalogxmlloc=catalogxmlloc,minmagnitude=minmagnitudeRF,maxmagnitude=maxmagnitudeRF)
 
 
-def concat_event_catalog(catfile,all_catalogtxt):
+def obtain_shared_inventory_events(datasets,catalogxmllocs,magnitudes,network,station):
+    '''
+    Obtain the inventory and the events once for several downloadDataclass of the same region (RF and SKS):
+    the inventory of the first one is copied to the others and one catalog is partitioned into their catalogs.
+    magnitudes is the list of (minmagnitude, maxmagnitude) of the datasets
+    '''
     logger = logging.getLogger(__name__)
-    if len(all_catalogtxt)>1:
-        logger.debug(f"length(all_catalogtxt): {len(all_catalogtxt)}")
-        f = open(catfile, "w")
-        for fl in all_catalogtxt:
-            flr = open(fl,'r')
-            f.write(flr.read())
-            flr.close()
-        f.close()
-            
-    elif len(all_catalogtxt)==1:
-        shutil.copyfile(all_catalogtxt[0],catfile)
-        if os.path.exists(catfile):
-            logger.debug(f"Catalog file: {catfile}")
+    first = datasets[0]
+    if not os.path.exists(first.inventoryfile):
+        try:
+            logger.info("## Operating get_stnxml method")
+            first.get_stnxml(network=network, station=station)
+        except Exception as e:
+            logger.error(e)
+            logger.error("Timeout while requesting...Please try again after some time", exc_info=True)
+            return
+    elif first.inv_table is None:
+        first.inv_table = load_inventory_table(first.inventoryfile)
+    for data in datasets[1:]:
+        if not os.path.exists(data.inventoryfile):
+            logger.info(f"Using the {first.method} inventory for {data.method}")
+            data.share_inventory(first)
+    logger.info("\n")
+    logger.info("Obtaining the shared events catalog")
+    first.obtain_shared_events(datasets,catalogxmllocs,magnitudes)
 
 
 def select_to_download_events(catalogloc,datafileloc,dest_map,RFsta,rf_data,minmagnitudeRF,maxmagnitudeRF,plot_stations,plot_events,locations,method='RF'):
@@ -157,40 +159,28 @@ def select_to_download_events(catalogloc,datafileloc,dest_map,RFsta,rf_data,minm
     stns = all_stations_df['Station'].values
     
 
-    net_sta_list=[]
+    ## number of events of each station in the station index written by obtain_events
+    counts = rf_data.station_event_counts()
+    num_lines = {}
     for net, sta in zip(nets,stns):
-        catfile = catalogloc+f"{net}-{sta}-events-info-{method}.txt"
         net_sta = f"{net}-{sta}"
-        
-        all_catalogtxt = glob.glob(catalogloc+f'{net}-{sta}-*-events-info-{method}.txt')
-        # logger.info(len(all_catalogtxt),all_catalogtxt[0])
-        if len(all_catalogtxt)!=0:
-            concat_event_catalog(catfile,all_catalogtxt)
-            # logger.info(f"Catalog file exists for {net_sta}!")
-            if net_sta not in net_sta_list:
-                net_sta_list.append(net_sta)
+        if net_sta in num_lines:
+            continue
+        if net_sta in counts:
+            num_lines[net_sta] = counts[net_sta]
         else:
-            logger.error(f"No catalog file exists for {net_sta}!", exc_info=True)
+            logger.error(f"No events in the station index for {net_sta}!")
 
 
-    if len(net_sta_list)==0:
-        logger.error("No catalog file found! Exiting...")
+    if len(num_lines)==0:
+        logger.error(f"No events found in {rf_data.indexfile}! Exiting...")
         sys.exit()
         
-    total_events,rem_events=0,0
-    for net_sta in net_sta_list:
-        net = net_sta.split("-")[0]
-        sta = net_sta.split("-")[1]
-        if not os.path.exists(datafileloc+f'{net}-{sta}-rf_profile_data.h5'):
-            catfile = catalogloc+f"{net}-{sta}-events-info-{method}.txt"
-            catfileout = catalogloc+f"{net}-{sta}-events-info-{method}-out.txt"
-            rem_duplicate_lines(catfile,catfileout)
-            shutil.move(catfileout,catfile)
-            rem_events += int(pd.read_csv(catfile,sep="|",header=None).shape[0])
-        total_events += int(pd.read_csv(catfile,sep="|",header=None).shape[0])
+    total_events = sum(num_lines.values())
+    rem_events = sum(nlines for net_sta,nlines in num_lines.items() if not os.path.exists(datafileloc+f'{net_sta}-rf_profile_data.h5'))
       
 
-    if rem_events:
+    if rem_events or rf_data.retry_failed_only or rf_data.incremental:
         logger.info("\n")
         logger.info("## Operating download method")
         rf_data.download_data(catalogtxtloc=catalogloc,datafileloc=datafileloc,tot_evnt_stns=total_events,rem_evnts=rem_events, plot_stations=plot_stations, plot_events=plot_events,dest_map=dest_map,locations=locations)
@@ -200,27 +190,78 @@ def select_to_download_events(catalogloc,datafileloc,dest_map,RFsta,rf_data,minm
 
 
  
-class Timeout():
-    """Timeout class using ALARM signal."""
-    class Timeout(Exception):
-        pass
+class RequestTimeout(Exception):
+    """Raised when a request does not complete within its deadline"""
+    pass
+
+
+class Deadline():
+    """Time budget shared by all the requests made for one event.
+    Based on a monotonic clock, so it can be used from any thread (unlike signal.alarm)."""
  
     def __init__(self, sec):
         self.sec = sec
+        self.start = time.monotonic()
  
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self.raise_timeout)
-        signal.alarm(self.sec)
+    def elapsed(self):
+        return time.monotonic() - self.start
  
-    def __exit__(self, *args):
-        signal.alarm(0)    # disable alarm
+    def remaining(self):
+        if self.sec is None:
+            return None
+        return max(0.0, self.sec - self.elapsed())
  
-    def raise_timeout(self, *args):
-        logger = logging.getLogger(__name__)
+    def expired(self):
+        return self.sec is not None and self.remaining() <= 0
+ 
+    def budget(self, timeout):
+        """Timeout of the next request: the smallest of timeout and the remaining budget"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+
+def timed_call(timeout, func, *args, slot=None, **kwargs):
+    '''
+    Call func(*args, **kwargs) and wait at most timeout seconds for it to return.
+    The call runs in a daemon thread, so the caller is released with RequestTimeout even if
+    the request is stalled; the socket timeout of the client then ends the stalled request.
+    slot (a semaphore bounding the concurrent requests of a datacenter) is acquired before the call and
+    released by the thread when the call returns, so a timed-out request keeps its slot until it really ends.
+    '''
+    if slot is not None:
+        slot.acquire()
+    if timeout is None:
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if slot is not None:
+                slot.release()
+    result = {}
+    def target():
         try:
-            raise Timeout.Timeout()
-        except:
-            pass
+            result['value'] = func(*args, **kwargs)
+        except BaseException as exception:
+            result['error'] = exception
+        finally:
+            if slot is not None:
+                slot.release()
+    thread = threading.Thread(target=target, daemon=True)
+    try:
+        thread.start()
+    except BaseException:
+        if slot is not None:
+            slot.release()
+        raise
+    thread.join(timeout)
+    if thread.is_alive():
+        raise RequestTimeout(f"{getattr(func,'__name__','request')} did not complete within {timeout:.1f} s")
+    if 'error' in result:
+        raise result['error']
+    return result['value']
 
 
 def organize_inventory(inventorytxtfile):
@@ -230,25 +271,18 @@ def organize_inventory(inventorytxtfile):
     out_inventorytxtfile = inventorytxtfile.split(".")[0]+'_combined'+'.txt'
     inv_df = pd.read_csv(inventorytxtfile,sep="|",keep_default_na=False, na_values=[""])
  
-    inv_df['EndTime'].fillna('2599-12-31T23:59:59',inplace=True)
-    net_sta_set = set(inv_df['#Network']+'_'+inv_df['Station']) #get rid of repeated stations by joining rows info
-
+    inv_df['EndTime'] = inv_df['EndTime'].fillna('2599-12-31T23:59:59')
 
     inv_df['StartTimeNum'] = inv_df['StartTime'].apply(lambda x: int(x.split("-")[0]+x.split("-")[1]+x.split("-")[2][0:2]))
     inv_df['EndTimeNum'] = inv_df['EndTime'].apply(lambda x: int(x.split("-")[0]+x.split("-")[1]+x.split("-")[2][0:2]))
-    all_dicts=[]
-    for net_sta in net_sta_set:
-        net = net_sta.split("_")[0]
-        sta = net_sta.split("_")[1]
-        # finding all rows with same net and sta
-        row = inv_df[(inv_df['#Network']==net) & (inv_df['Station']==sta)]
-        row=row.reset_index()
-        rowtimemax = row.loc[row['EndTimeNum'].idxmax()]
-        rowtimemin = row.loc[row['StartTimeNum'].idxmin()]
-
-        dict_row = {'#Network':net,'Station':sta,'Latitude':row.loc[0,'Latitude'],'Longitude':row.loc[0,'Longitude'],'Elevation':row.loc[0,'Elevation'],'SiteName':row.loc[0,'SiteName'],'StartTime':rowtimemin['StartTime'],'EndTime':rowtimemax['EndTime']}
-        all_dicts.append(dict_row)
-    new_inv_df=pd.DataFrame(all_dicts)
+    # get rid of repeated stations by joining rows info: coordinates and site of the first epoch,
+    # earliest start time and latest end time of all the epochs
+    keys = ['#Network','Station']
+    groups = inv_df.groupby(keys,sort=False)
+    new_inv_df = inv_df.drop_duplicates(keys,keep='first').set_index(keys)[['Latitude','Longitude','Elevation','SiteName']]
+    new_inv_df['StartTime'] = inv_df.loc[groups['StartTimeNum'].idxmin(),keys+['StartTime']].set_index(keys)['StartTime']
+    new_inv_df['EndTime'] = inv_df.loc[groups['EndTimeNum'].idxmax(),keys+['EndTime']].set_index(keys)['EndTime']
+    new_inv_df = new_inv_df.reset_index()
     # os.remove(inventorytxtfile)
     new_inv_df.to_csv(out_inventorytxtfile, index=False,sep="|")
 
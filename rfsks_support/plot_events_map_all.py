@@ -7,9 +7,11 @@ import warnings, matplotlib.cbook
 warnings.filterwarnings("ignore", category=FutureWarning)
 from rfsks_support.plotting_libs import equi, plot_events_loc
 from rfsks_support.plotting_map import plot_topo_simple
+from rfsks_support.download_ledger import DownloadLedger
+from rfsks_support.event_table import StationEventIndex
 DEG2KM = 111.2
 
-def plot_events_map_all(all_stations_file = "results/InfoRF/all_stations_rf_retrieved.txt"):
+def plot_events_map_all(all_stations_file = "results/InfoRF/all_stations_rf_retrieved.txt",ledgerfile=None):
     # all_stations_file = "/Users/utpalkumar50/Desktop/RF_SKS/results/InfoSKS/all_stations_sks_retrieved.txt"
     method = all_stations_file.split("/")[-1].split("_")[-2].upper()
     fig_loc = all_stations_file.split("/")[:-1]
@@ -20,6 +22,10 @@ def plot_events_map_all(all_stations_file = "results/InfoRF/all_stations_rf_retr
     for loc in all_stations_file.split("/")[0:-1]:
         info_loc += loc+"/"
     all_stations_df = pd.read_csv(all_stations_file,sep="|")
+    ## retrieved events from the download ledger, or from the events-info-available files of older projects
+    ledger = DownloadLedger(ledgerfile) if ledgerfile and os.path.exists(ledgerfile) else None
+    ## all the events of the stations from the station index of the method
+    event_index = StationEventIndex.load(StationEventIndex.indexfile(info_loc,method))
 
     net_sta_stalon_stalat_list = []
     for net,sta,stalon,stalat  in zip(all_stations_df['#Network'],all_stations_df['Station'],all_stations_df['Longitude'],all_stations_df['Latitude']):
@@ -36,14 +42,16 @@ def plot_events_map_all(all_stations_file = "results/InfoRF/all_stations_rf_retr
             stalat = float(net_sta_stalon_stalat.split("_")[3])
             # stalon = -90
             print(f'Plotting events map for {net}-{sta}')
-            event_catalog = info_loc + f"{net}-{sta}-events-info-{method}.txt"
-            df_all = pd.read_csv(event_catalog)
+            df_all = event_index.station_catalog(net,sta)
             evmg_all = df_all['evmg'].values
             # evmg_all = [float(val.split()[0]) for val in df_all['evmg']]
 
-            df = pd.read_csv(info_loc + f"{net}-{sta}-events-info-available-{method}.txt",delimiter="\||,", names=['evtime','evlat','evlon','evdp','evmg','client'],header=None,engine="python")
-            # evmg = df['evmg'].values
-            evmg = [float(val.split()[0]) for val in df['evmg']]
+            if ledger is not None:
+                df = ledger.available_events(method,net,sta)
+                evmg = df['evmg'].values
+            else:
+                df = pd.read_csv(info_loc + f"{net}-{sta}-events-info-available-{method}.txt",delimiter="\||,", names=['evtime','evlat','evlon','evdp','evmg','client'],header=None,engine="python")
+                evmg = [float(val.split()[0]) for val in df['evmg']]
 
             warnings.filterwarnings("ignore",category=matplotlib.cbook.mplDeprecation)
             plt.figure(figsize=(16,12))
@@ -0,0 +1,58 @@
+import numpy as np
+from scipy.signal import butter, detrend, sosfiltfilt
+
+## noise and signal windows (s relative to the onset) and band (Hz) of the SNR of each phase;
+## the P windows fit in the 25 s kept before the onset by filter_traces_rf
+SNR_SETTINGS = {
+    'P': {'noise': (-20,-2), 'signal': (-1,10), 'band': (0.1,2.0)},
+    'SKS': {'noise': (-50,-10), 'signal': (-5,20), 'band': (0.04,0.5)},
+}
+
+
+def snr(data,sampling_rate,onset,noise,signal,band=None):
+    '''
+    Ratio of the RMS amplitudes of the signal and noise windows (s relative to onset, the onset time in s
+    from the first sample) of each row of data, computed at once on the 2D array (windows x samples)
+    '''
+    data = detrend(np.atleast_2d(np.asarray(data,dtype=float)),axis=-1)
+    if band is not None:
+        nyquist = 0.5*sampling_rate
+        sos = butter(2,[band[0]/nyquist,min(band[1],0.9*nyquist)/nyquist],btype='band',output='sos')
+        data = sosfiltfilt(sos,data,axis=-1)
+    def rms(window):
+        i1 = max(0,int(round((onset+window[0])*sampling_rate)))
+        i2 = min(data.shape[-1],int(round((onset+window[1])*sampling_rate)))
+        if i2 <= i1:
+            return np.full(data.shape[0],np.nan)
+        return np.sqrt(np.mean(data[:,i1:i2]**2,axis=-1))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return rms(signal)/rms(noise)
+
+
+def radial(north,east,back_azimuth):
+    '''
+    Radial component of the north and east components (same convention as the NE->RT rotation of obspy)
+    '''
+    baz = np.radians(back_azimuth)
+    return -north*np.cos(baz) - east*np.sin(baz)
+
+
+def window_snr(strm,phase='P'):
+    '''
+    SNR of a downloaded 3C window: on the vertical component for P, on the radial component for SKS.
+    Returns nan if the components or the onset are missing
+    '''
+    comps = {tr.stats.channel[-1]: tr for tr in strm}
+    if phase not in SNR_SETTINGS or not {'Z','N','E'} <= set(comps):
+        return np.nan
+    tr = comps['Z']
+    onset = tr.stats.get('onset')
+    if onset is None:
+        return np.nan
+    npts = min(len(comps[comp].data) for comp in 'ZNE')
+    if phase == 'P':
+        data = tr.data[:npts]
+    else:
+        data = radial(comps['N'].data[:npts].astype(float),comps['E'].data[:npts].astype(float),tr.stats.get('back_azimuth',0.0))
+    settings = SNR_SETTINGS[phase]
+    return float(snr(data,tr.stats.sampling_rate,onset-tr.stats.starttime,settings['noise'],settings['signal'],settings['band'])[0])
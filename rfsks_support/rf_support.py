@@ -20,21 +20,33 @@ with open('Settings/advRFparam.yaml') as f:
     inpRFdict = yaml.load(f, Loader=yaml.FullLoader)
 
 ### Compute RF
-def compute_rf(dataRFfileloc):
+def compute_rf(dataRFfileloc,incremental=False):
+    '''
+    Compute the RFs of the station data files. With incremental, the RFs of the events of the data file
+    missing from an existing RF file are computed and appended to it
+    '''
     logger = logging.getLogger(__name__)
     all_rfdatafile = glob.glob(dataRFfileloc+f"*-{str(inpRFdict['filenames']['data_rf_suffix'])}.h5")
     for jj,rfdatafile in enumerate(all_rfdatafile):
         network = rfdatafile.split("-")[0]
         station = rfdatafile.split("-")[1]
         rffile = f"{network}-{station}-{str(inpRFdict['filenames']['rf_compute_data_suffix'])}.h5"
-        datatmp = read_rf(rfdatafile, 'H5')
-        if not os.path.exists(rffile):
+        done = set()
+        if incremental and os.path.exists(rffile):
+            ## events already in the RF file, compared on the headers only
+            done = {str(tr.stats.event_time) for tr in read_rf(rffile, 'H5', headonly=True)}
+            if not {str(tr.stats.event_time) for tr in read_rf(rfdatafile, 'H5', headonly=True)} - done:
+                logger.info(f"--> No new events for {rffile}, {jj+1}/{len(all_rfdatafile)}")
+                continue
+        if not os.path.exists(rffile) or incremental:
             logger.info(f"--> Computing RF for {rfdatafile}, {jj+1}/{len(all_rfdatafile)}")
             data = read_rf(rfdatafile, 'H5')
             stream = RFStream()
             for stream3c in tqdm.tqdm(IterMultipleComponents(data, 'onset', 3)):
                 if len(stream3c) != 3:
                     continue
+                if str(stream3c[0].stats.event_time) in done:
+                    continue
                 
                 ## check if the length of all three traces are equal
                 lenphase = 100
@@ -80,7 +92,11 @@ def compute_rf(dataRFfileloc):
                     logger.warning("Problem applying rf method", exc_info=True)
                 stream3c.moveout()
                 stream.extend(stream3c)
-            stream.write(rffile, 'H5')
+            if not os.path.exists(rffile):
+                stream.write(rffile, 'H5')
+            elif len(stream):
+                logger.info(f"--> Appending {len(stream)//3} new RFs to {rffile}")
+                stream.write(rffile, 'H5', mode='a', override='ignore')
         else:
             # logger.info(f"--> {rffile} already exists!, {jj}/{len(all_rfdatafile)}")
             logger.info(f"--> Verifying RF computation {jj+1}/{len(all_rfdatafile)}")
@@ -3,16 +3,18 @@ import numpy as np
 from rf import RFStream
 import tqdm
 from obspy.geodetics import gps2dist_azimuth
-from obspy.clients.fdsn import Client
+from rfsks_support.fdsn_clients import get_client
 from obspy import UTCDateTime as UTC
-from obspy.taup import TauPyModel
+from rfsks_support.travel_times import taup_model
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 # plt.style.use('ggplot')
 plt.style.use('seaborn')
 import logging
-from rfsks_support.other_support import Timeout
+import time
+from rfsks_support.other_support import Deadline, RequestTimeout
+from rfsks_support.waveform_cache import cached_waveforms
 import matplotlib.gridspec as gridspec
 
 
@@ -218,11 +220,54 @@ def iter_event_data(events, inventory, get_waveforms, phase='P',
             tr.stats.update(stats)
         yield RFStream(stream)
 
-def retrieve_waveform(client,net,stn,t1,t2,stats_dict=None,cha="BHE,BHN,BHZ",attach_response=False,loc="",pharr=None, phasenm = 'P'):  
+def order_locations(locations,priority=None):
+    '''
+    Location codes sorted by priority: the codes listed in priority first (in that order), then the others
+    '''
+    priority = [str(loc) for loc in priority] if priority else []
+    return sorted(locations,key=lambda loc: (priority.index(loc) if loc in priority else len(priority),str(loc)))
+
+def location_list(locations):
+    '''
+    Location codes of one FDSN request ("--" for the empty location)
+    '''
+    return ",".join(loc if loc else "--" for loc in locations)
+
+def retrieve_waveform(client,net,stn,t1,t2,stats_dict=None,cha="BHE,BHN,BHZ",attach_response=False,loc="",pharr=None, phasenm = 'P',timeout=None,info=None,cache=None,slot=None):  
+    '''
+    Download and process one window. Raises RequestTimeout if the request takes more than timeout seconds.
+    slot is the semaphore bounding the concurrent requests of the datacenter, if any.
+    loc can be a list of location codes, requested at once: the first complete 3C set in the list order is kept.
+    If given, info is filled with the raw 'nbytes' received or the error 'message', 'cached'
+    when the window was read from the WaveformCache cache and the 'location' of the stream
+    '''
+    info = info if info is not None else {}
+    locations = list(loc) if isinstance(loc,(list,tuple)) else [loc]
     try:  
-        st = client.get_waveforms(net, stn, loc, cha, t1, t2,attach_response=attach_response)
-    except:
+        st, info['cached'] = cached_waveforms(client,cache,net,stn,location_list(locations) if len(locations)>1 else locations[0],cha,t1,t2,attach_response=attach_response,timeout=timeout,slot=slot)
+    except RequestTimeout:
+        raise
+    except Exception as exception:
+        info['message'] = str(exception).split("\n")[0]
         return False
+    info['nbytes'] = 0 if info['cached'] else sum(tr.data.nbytes for tr in st)
+    if len(locations) == 1:
+        info['location'] = locations[0]
+        return process_waveform(st,stats_dict=stats_dict,pharr=pharr,phasenm=phasenm)
+    for location in locations:
+        sub = st.select(location=location)
+        if len(sub):
+            strm = process_waveform(sub.copy(),stats_dict=dict(stats_dict) if stats_dict else None,pharr=pharr,phasenm=phasenm)
+            if strm:
+                info['location'] = location
+                return strm
+    return False
+
+def process_waveform(st,stats_dict=None,pharr=None, phasenm = 'P'):
+    '''
+    Cut and resample the raw traces around the phase arrival and attach the event stats.
+    Returns the 3C RFStream or False
+    '''
     # print("Retrieving")
     if phasenm == 'P':
         # filter_traces(st,lenphase=int(t2-t1))
@@ -250,59 +295,87 @@ def retrieve_waveform(client,net,stn,t1,t2,stats_dict=None,cha="BHE,BHN,BHZ",att
         # print("--------> There's a gap/overlap in the data")
         return False
 
-def multi_download(client,inv,net,stn,slat,slon,elat,elon,evdp,evtime,em,emt,fcat,stalons,stalats,staNetNames,phase='P',locations=[""]):
+def event_window(net,stn,slat,slon,elat,elon,evdp,evtime,em,emt,phase='P',arrival=None):
+    '''
+    Compute the request window around the phase arrival of one event at one station.
+    arrival is the (onset time, incidence angle, ray parameter) of the phase, computed with TauP if not given.
+    Returns a dict with the station/event info, the window (t1, t2), the arrival pharr and the trace stats
+    '''
+    if arrival is None:
+        arrivals = taup_model('iasp91').get_travel_times_geo(float(evdp),slat,slon,float(elat),float(elon),phase_list=[phase])
+        arrival = (arrivals[0].time, arrivals[0].incident_angle, arrivals[0].ray_param_sec_degree)
+    ttime, incidence, rayp = arrival
+    if np.isnan(ttime):
+        raise ValueError(f"No {phase} arrival for the event {evtime} at {net}-{stn}")
+    if phase=='P':
+        t1 = UTC(str(evtime)) + int(ttime - 50)
+        t2 = UTC(str(evtime)) + int(ttime + 110)
+        # t1 = UTC(str(evtime)) + int(ttime - 25)
+        # t2 = UTC(str(evtime)) + int(ttime + 75)
+    elif phase=='SKS':
+        t1 = UTC(str(evtime)) + int(ttime - 80)
+        t2 = UTC(str(evtime)) + int(ttime + 80)
+    pharr = UTC(str(evtime)) + ttime
+    stats_args = {"_format":'H5', "onset" : pharr, "event_latitude": elat, "event_longitude": elon,"event_depth":evdp, "event_magnitude":em,"event_time":UTC(str(evtime)),"phase":phase,"station_latitude":slat,"station_longitude":slon,"inclination":incidence,"slowness":rayp}
+    return {'net':net,'stn':stn,'slat':slat,'slon':slon,'elat':elat,'elon':elon,'evdp':evdp,'evtime':evtime,'em':em,'emt':emt,'phase':phase,'t1':t1,'t2':t2,'pharr':pharr,'stats':stats_args}
+
+def multi_download(client,net,stn,slat,slon,elat,elon,evdp,evtime,em,emt,phase='P',locations=[""],client_slots=None,win=None,timeouts=None,attempts=None,cache=None,single_request=False):
+    '''
+    Download the 3C window of one event, trying the clients in order.
+    client_slots maps a client name to a semaphore bounding the concurrent requests sent to that datacenter.
+    win is the precomputed event_window of the event, if available.
+    timeouts is a dict with the 'connect' and 'read' timeouts of a request and the 'event' budget, in s.
+    A datacenter exceeding its timeout is skipped for this event and reported in the returned message.
+    Each request is appended to the attempts list as a dict (client, location, status, nbytes, latency, message).
+    cache is the WaveformCache read before sending the requests, if any.
+    With single_request, all the locations are requested in one call per client and the first complete
+    3C set in the locations order is kept, instead of one request per location.
+    '''
     logger = logging.getLogger(__name__)
     strm = None
     j=0
     msg = None
-    model = TauPyModel('iasp91')
-    arrivals = model.get_travel_times_geo(float(evdp),slat,slon,float(elat),float(elon),phase_list=[phase])
-    if phase=='P':
-        t1 = UTC(str(evtime)) + int(arrivals[0].time - 50)
-        t2 = UTC(str(evtime)) + int(arrivals[0].time + 110)
-        # t1 = UTC(str(evtime)) + int(arrivals[0].time - 25)
-        # t2 = UTC(str(evtime)) + int(arrivals[0].time + 75)
-    elif phase=='SKS':
-        t1 = UTC(str(evtime)) + int(arrivals[0].time - 80)
-        t2 = UTC(str(evtime)) + int(arrivals[0].time + 80)
-    # sel_inv = inv.select(network=net).select(station=stn)[0][0]
-    # if not sel_inv.is_active(starttime=t1, endtime=t2):
-    #     # logger.warning(f"------> Station not active during {evtime}")
-    #     msg = f"Station not active during {evtime}"
-    #     return strm, 0, msg
+    if win is None:
+        win = event_window(net,stn,slat,slon,elat,elon,evdp,evtime,em,emt,phase=phase)
+    t1, t2, pharr = win['t1'], win['t2'], win['pharr']
     # process_id = os.getpid()
-    pharr = UTC(str(evtime)) + arrivals[0].time
+    client_slots = client_slots if client_slots is not None else {}
+    timeouts = timeouts if timeouts is not None else {}
+    attempts = attempts if attempts is not None else []
+    deadline = Deadline(timeouts.get('event'))
+    timed_out = []
     while not strm:
-        client_local = Client(client[j])
-        stats_args = {"_format":'H5', "onset" : UTC(str(evtime)) + arrivals[0].time, "event_latitude": elat, "event_longitude": elon,"event_depth":evdp, "event_magnitude":em,"event_time":UTC(str(evtime)),"phase":phase,"station_latitude":slat,"station_longitude":slon,"inclination":arrivals[0].incident_angle,"slowness":arrivals[0].ray_param_sec_degree}
-        if phase=='P':
-            for loc in locations:
-                with Timeout(5):
-                    strm = retrieve_waveform(client_local,net,stn,t1,t2,stats_dict=stats_args,cha="BHE,BHN,BHZ",loc=loc,pharr = pharr, phasenm = phase)
-                    if strm:
-                        break
-                
-        elif phase=='SKS':
-            for loc in locations:
+        if deadline.expired():
+            res = 0
+            msg = f"Timed out {evtime} after {deadline.elapsed():.1f} s ({', '.join(timed_out) if timed_out else 'event budget'})"
+            break
+        slot = client_slots.get(client[j])
+        stats_args = dict(win['stats'])
+        loc = ""
+        tstart = time.monotonic()
+        try:
+            client_local = get_client(client[j],timeout=timeouts.get('read'),connect_timeout=timeouts.get('connect'))
+            for loc in ([list(locations)] if single_request and len(locations)>1 else locations):
                 # print(f"Location: {loc}")
-                with Timeout(5):
-                    
-                    strm = retrieve_waveform(client_local,net,stn,t1,t2,stats_dict=stats_args,cha="BHE,BHN,BHZ",attach_response=True,loc=loc,pharr = pharr, phasenm = phase)
-                    if strm:
-                        break #break the locations loop
-                
+                info = {}
+                tstart = time.monotonic()
+                strm = retrieve_waveform(client_local,net,stn,t1,t2,stats_dict=stats_args,cha=win.get('cha',"BHE,BHN,BHZ"),attach_response=(phase=='SKS'),loc=loc,pharr = pharr, phasenm = phase,timeout=deadline.budget(timeouts.get('read')),info=info,cache=cache,slot=slot)
+                attempts.append({'client':client[j],'location':info.get('location',location_list(loc) if isinstance(loc,list) else loc),'status':'ok' if strm else 'nodata','nbytes':info.get('nbytes',0),'latency':time.monotonic()-tstart,'message':'cache' if info.get('cached') else info.get('message','')})
+                if strm or deadline.expired():
+                    break #break the locations loop
+        except RequestTimeout as exception:
+            logger.warning(f"{client[j]}: {net}-{stn} {evtime}: {exception}")
+            attempts.append({'client':client[j],'location':location_list(loc) if isinstance(loc,list) else loc,'status':'timeout','nbytes':0,'latency':time.monotonic()-tstart,'message':str(exception)})
+            timed_out.append(client[j])
+
         if strm:
-            fcat.write('{} | {:9.4f}, {:9.4f} | {:5.1f} | {:5.1f} {:4s} | {}\n'.format(evtime,elat,elon,evdp,em,emt,client[j]))
-            stalons.append(slon)
-            stalats.append(slat)
-            staNetNames.append(f"{net}_{stn}")
             # print("stream obtained\n")
             msg = f"Data {evtime}"
             res = 1
             break
         elif j == len(client)-1:
             res = 0
-            msg = f"No data {evtime}"
+            msg = f"Timed out {evtime} ({', '.join(timed_out)})" if timed_out else f"No data {evtime}"
             break
         j+=1
     return strm, res, msg
@@ -26,6 +26,26 @@ from rfsks_support.plotting_libs import mean_angle, plot_sks_station_map, plot_s
 with open('Settings/advSKSparam.yaml') as f:
     inpSKSdict = yaml.load(f, Loader=yaml.FullLoader)
 
+def station_measurements_summary(sks_meas_file,null_meas_file):
+    '''
+    Station longitude, latitude, fast directions, lag times and number of null measurements saved in the station
+    measurement files (used to summarize a station measured over several incremental runs)
+    '''
+    with open(sks_meas_file) as f:
+        f.readline()
+        stlon, stlat = [float(val) for val in f.readline().split()]
+    meas = pd.read_csv(sks_meas_file,skiprows=2,delim_whitespace=True)
+    fast_dirs = meas['FastDirection(degs)'].values if meas.shape[0] else np.array([])
+    ## same half of projection as the measurements of SKScalc
+    fast_dirs = np.where((fast_dirs<-45) & (fast_dirs>-91),fast_dirs+180,fast_dirs)
+    lags = meas['LagTime(s)'].values if meas.shape[0] else np.array([])
+    num_null = 0
+    if os.path.exists(null_meas_file):
+        with open(null_meas_file) as f:
+            num_null = max(0,sum(1 for line in f if line.strip())-3)
+    return stlon, stlat, fast_dirs, lags, num_null
+
+
 class sks_measurements:
 
     def __init__(self,plot_measure_loc=None):
@@ -35,8 +55,12 @@ class sks_measurements:
         # pass
 
     ## Pre-processing
-    def SKScalc(self, dataSKSfileloc,trace_loc_ENZ=None,trace_loc_RTZ=None,trigger_loc=None,method = 'None'):
-        
+    def SKScalc(self, dataSKSfileloc,trace_loc_ENZ=None,trace_loc_RTZ=None,trigger_loc=None,method = 'None',incremental=False):
+        '''
+        Measure the splitting of the SKS data files. The events already measured (done_measurements.txt) are skipped;
+        with incremental, the new measurements are appended to the existing station files and the stations
+        summary is computed from these files
+        '''
         # self.logger.info("Cut the traces around the SKS arrival")
         sksfiles = glob.glob(dataSKSfileloc+f"*-{str(inpSKSdict['filenames']['data_sks_suffix'])}.h5")
         # self.logger.info(sksfiles)
@@ -47,19 +71,35 @@ class sks_measurements:
 
         meas_file = self.plot_measure_loc+'done_measurements.txt'
         f, finished_file, finished_events = measure_status(meas_file) #track the measurements
+        finished = set(zip(finished_file,[str(evt) for evt in finished_events]))
+        if incremental:
+            all_measurements = open(self.plot_measure_loc+"../"+"sks_measurements_all.txt",'w')
+            all_measurements.write("NET STA LON LAT AvgFastDir AvgLagTime NumMeasurements NumNull\n")
+            all_meas_start = False
         
         for i,sksfile in enumerate(sksfiles):
             count=0
-            data = read_rf(sksfile, 'H5')
-            self.logger.info(f"SKS measurements for {sksfile}\n")
             net_name = os.path.basename(sksfile).split("-")[0]
             stn_name = os.path.basename(sksfile).split("-")[1]
+            sks_measurements_stn = self.plot_measure_loc+f"{net_name}_{stn_name}_{str(inpSKSdict['filenames']['sks_meas_indiv'])}"
+            null_measurements_stn = self.plot_measure_loc+f"{net_name}_{stn_name}_null_measurements.txt"
+            if incremental and os.path.exists(sks_measurements_stn):
+                ## skip the stations without new events from the headers of the data file
+                if all((sksfile,str(tr.stats.event_time)) in finished for tr in read_rf(sksfile, 'H5', headonly=True)):
+                    self.logger.info(f"No new SKS events for {sksfile}")
+                    self.write_station_summary(all_measurements,net_name,stn_name,sks_measurements_stn,null_measurements_stn)
+                    continue
+            data = read_rf(sksfile, 'H5')
+            self.logger.info(f"SKS measurements for {sksfile}\n")
 
             stn_meas_close = False
             # if stn_meas_start:
-            sks_measurements_stn = self.plot_measure_loc+f"{net_name}_{stn_name}_{str(inpSKSdict['filenames']['sks_meas_indiv'])}"
-            null_measurements_stn = self.plot_measure_loc+f"{net_name}_{stn_name}_null_measurements.txt"
-            if not os.path.exists(sks_measurements_stn):
+            if incremental and os.path.exists(sks_measurements_stn):
+                ## append the new measurements of the station
+                sks_meas_file = open(sks_measurements_stn,'a')
+                sks_meas_file_null = open(null_measurements_stn,'a')
+                stn_meas_close = True
+            elif not os.path.exists(sks_measurements_stn):
                 sks_meas_file = sks_measure_file_start(sks_measurements_stn,data[0].stats.station_longitude,data[0].stats.station_latitude,"EventTime EvLong EvLat Evdp Baz FastDirection(degs) deltaFastDir(degs) LagTime(s) deltaLagTime(s) SI\n")
                 
                 sks_meas_file_null = sks_measure_file_start(null_measurements_stn,data[0].stats.station_longitude,data[0].stats.station_latitude,"EventTime EvLong EvLat Evdp Baz\n")
@@ -82,7 +122,7 @@ class sks_measurements:
                 if not len(set(tr_lens))==1:
                     continue
 
-                if sksfile in finished_file and str(stream3c[0].stats.event_time) in finished_events:
+                if (sksfile,str(stream3c[0].stats.event_time)) in finished:
                     continue
                 else:
                     if all_meas_start:
@@ -256,15 +296,27 @@ class sks_measurements:
                 if os.path.exists(sks_meas_file) and not os.path.exists(outfig):
                     plot_baz_si_map(sks_meas_file = sks_meas_file, outfig = outfig)
             
-            if all_meas_close:
+            if incremental:
+                self.write_station_summary(all_measurements,net_name,stn_name,sks_measurements_stn,null_measurements_stn)
+            elif all_meas_close:
                 mean_fast_dir_all = mean_angle(fast_dir_all) if len(fast_dir_all) else 0
                 
                 all_measurements.write("{} {} {:.4f} {:.4f} {:.2f} {:.1f} {} {}\n".format(net_name,stn_name,data[0].stats.station_longitude,data[0].stats.station_latitude,mean_fast_dir_all,np.mean(lag_time_all),num_measurements, num_null))
 
         f.close()
-        if all_meas_close:
+        if all_meas_close or incremental:
             all_measurements.close()
 
+    def write_station_summary(self,all_measurements,net_name,stn_name,sks_meas_file,null_meas_file):
+        '''
+        Write the summary line of a station from its measurement files
+        '''
+        if not os.path.exists(sks_meas_file):
+            return
+        stlon, stlat, fast_dirs, lags, num_null = station_measurements_summary(sks_meas_file,null_meas_file)
+        mean_fast_dir = mean_angle(fast_dirs) if len(fast_dirs) else 0
+        all_measurements.write("{} {} {:.4f} {:.4f} {:.2f} {:.1f} {} {}\n".format(net_name,stn_name,stlon,stlat,mean_fast_dir,np.mean(lags) if len(lags) else np.nan,len(fast_dirs),num_null))
+
 
     ## plotting the measurement
     def plot_sks_map(self):
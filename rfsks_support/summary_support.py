@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import yaml
+from rfsks_support.event_table import EventTable, StationEventIndex, load_station_indexes
 
 with open('Settings/advSKSparam.yaml') as f:
     inpSKSdict = yaml.load(f, Loader=yaml.FullLoader)
@@ -80,44 +81,31 @@ class sum_support:
 
         ## Corresponding events info
         self.newline()
-        all_events_file_list = glob.glob(f"{self.SKSsta_path}/*-*-*-*-events-info-*.txt")
-        
         total_events = 0
-        minmg = 100
-        maxmg = 0
-        mindp, maxdp = 99999,-10
-        min_evs,max_evs = 999999,-10
-        for ff in all_events_file_list:
-            dff = pd.read_csv(ff,sep=",")
-            if dff.shape[0]>0:
-                total_events+=dff.shape[0]
-                if dff.shape[0] < min_evs:
-                    min_evs = dff.shape[0]
-                    min_ev_catlog = ff
-                if dff.shape[0] > max_evs:
-                    max_evs = dff.shape[0]
-                    max_ev_catlog = ff
-                ## magnitude
-                mag_array = dff['evmg'].values
-                minmag = np.min(mag_array)
-                maxmag = np.max(mag_array)
-                if minmag < minmg:
-                    minmg = minmag
-                if maxmag > maxmg:
-                    maxmg = maxmag
-                ## depth
-                mindep = dff['evdp'].min()
-                maxdep = dff['evdp'].max()
-                if mindep < mindp:
-                    mindp = mindep
-                if maxdep > maxdp:
-                    maxdp = maxdep
-
-
-        self.write_strings("Total event catalogs generated: {}".format(len(all_events_file_list)))
+        minmg, maxmg = np.nan, np.nan
+        mindp, maxdp = np.nan, np.nan
+        min_ev_catlog, min_evs, max_ev_catlog, max_evs = None, 0, None, 0
+        indexes = load_station_indexes(self.SKSsta_path)
+        for method,index in indexes.items():
+            counts = index.counts()
+            if not counts:
+                continue
+            total_events += sum(counts.values())
+            ## events of the station index in the event table of the project
+            table = EventTable.load(index.eventfile)
+            dff = table.events.iloc[np.unique(index.pairs['row'].values)]
+            minmg, maxmg = np.nanmin([minmg,dff['evmg'].min()]), np.nanmax([maxmg,dff['evmg'].max()])
+            mindp, maxdp = np.nanmin([mindp,dff['evdp'].min()]), np.nanmax([maxdp,dff['evdp'].max()])
+            least, most = min(counts,key=counts.get), max(counts,key=counts.get)
+            if min_ev_catlog is None or counts[least] < min_evs:
+                min_ev_catlog, min_evs = least, counts[least]
+            if max_ev_catlog is None or counts[most] > max_evs:
+                max_ev_catlog, max_evs = most, counts[most]
+
+        self.write_strings("Station event indexes: {}".format(", ".join(StationEventIndex.indexfile(self.SKSsta_path,method) for method in indexes)))
         self.write_strings("Total events in total: {}".format(total_events))
-        self.write_strings("Catalog with least events: {} ({} events)".format(min_ev_catlog,min_evs))
-        self.write_strings("Catalog with most events: {} ({} events)".format(max_ev_catlog,max_evs))
+        self.write_strings("Station with least events: {} ({} events)".format(min_ev_catlog,min_evs))
+        self.write_strings("Station with most events: {} ({} events)".format(max_ev_catlog,max_evs))
         self.write_strings("Min mag: {}, Max mag: {}".format(minmg,maxmg))
         self.write_strings("Min depth: {} km, Max depth: {} km".format(mindp, maxdp))
     
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import time
+import socket
+import threading
+import logging
+import numpy as np
+from obspy import UTCDateTime as UTC
+
+## upper bounds (s) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+## minimum interval (s) between two writes of the live Prometheus textfile
+TEXTFILE_INTERVAL = 10
+## HTTP status of the FDSN exceptions raised by obspy
+EXCEPTION_STATUS = {'FDSNNoDataException': '204', 'FDSNBadRequestException': '400', 'FDSNUnauthorizedException': '401',
+    'FDSNForbiddenException': '403', 'FDSNRequestTooLargeException': '413', 'FDSNTooManyRequestsException': '429',
+    'FDSNInternalServerException': '500', 'FDSNServiceUnavailableException': '503', 'FDSNTimeoutException': 'timeout'}
+
+
+def request_status(exception=None):
+    '''
+    HTTP status code of a request ('200' if exception is None), 'timeout' or 'error'
+    '''
+    if exception is None:
+        return '200'
+    name = type(exception).__name__
+    if name in EXCEPTION_STATUS:
+        return EXCEPTION_STATUS[name]
+    if isinstance(exception,(socket.timeout,TimeoutError)) or 'timed out' in str(exception):
+        return 'timeout'
+    code = getattr(exception,'code',None)
+    return str(code) if code else 'error'
+
+
+def service_of(url):
+    '''
+    FDSN service of a request URL (dataselect, station, event, availability)
+    '''
+    match = re.search(r'/fdsnws/(\w+)/',str(url))
+    return match.group(1) if match else 'other'
+
+
+class Telemetry:
+    '''
+    Process-wide counters of the requests sent to each datacenter and service: number of requests per HTTP status,
+    timeouts, bytes received and latency histogram. Exported as JSON at the end of a stage and, if a textfile is
+    configured, written in the Prometheus text format while the requests are running (node_exporter textfile collector)
+    '''
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stats = {}
+        self.textfile = None
+        self.last_write = 0.0
+        self.started = str(UTC())
+
+    def configure(self,textfile=None):
+        self.textfile = textfile or None
+
+    def record(self,datacenter,service,latency,nbytes=0,status='200'):
+        with self.lock:
+            stat = self.stats.setdefault((datacenter,service),{'requests':0,'bytes':0,'timeouts':0,'latency_sum':0.0,
+                        'buckets':[0]*len(LATENCY_BUCKETS),'status':{}})
+            stat['requests'] += 1
+            stat['bytes'] += int(nbytes)
+            stat['latency_sum'] += float(latency)
+            stat['buckets'][int(np.searchsorted(LATENCY_BUCKETS,latency))] += 1
+            stat['status'][status] = stat['status'].get(status,0)+1
+            if status == 'timeout':
+                stat['timeouts'] += 1
+        if self.textfile and time.monotonic()-self.last_write >= TEXTFILE_INTERVAL:
+            self.write_prometheus(self.textfile)
+
+    def snapshot(self):
+        '''
+        Copy of the counters as a list of dicts (one per datacenter and service)
+        '''
+        with self.lock:
+            rows = []
+            for (datacenter,service),stat in sorted(self.stats.items()):
+                row = {'datacenter':datacenter,'service':service,'requests':stat['requests'],'bytes':stat['bytes'],
+                        'timeouts':stat['timeouts'],'latency_sum':round(stat['latency_sum'],3),
+                        'latency_mean':round(stat['latency_sum']/stat['requests'],3) if stat['requests'] else None,
+                        'latency_buckets':{str(le):count for le,count in zip(LATENCY_BUCKETS,stat['buckets'])},
+                        'status':dict(stat['status'])}
+                rows.append(row)
+            return rows
+
+    def write_json(self,fname):
+        with open(fname+'.tmp','w') as f:
+            json.dump({'started':self.started,'written':str(UTC()),'datacenters':self.snapshot()},f,indent=1)
+        os.replace(fname+'.tmp',fname)
+
+    def write_prometheus(self,fname):
+        ## skip if another thread is already writing the file
+        if not self.write_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_write = time.monotonic()
+            lines = ['# HELP rfsks_fdsn_requests_total FDSN requests by datacenter, service and HTTP status',
+                    '# TYPE rfsks_fdsn_requests_total counter']
+            rows = self.snapshot()
+            for row in rows:
+                for status,count in sorted(row['status'].items()):
+                    lines.append(f'rfsks_fdsn_requests_total{{datacenter="{row["datacenter"]}",service="{row["service"]}",status="{status}"}} {count}')
+            for name,key,text in (('rfsks_fdsn_bytes_total','bytes','Bytes received'),
+                                    ('rfsks_fdsn_timeouts_total','timeouts','Requests ended by a timeout')):
+                lines += [f'# HELP {name} {text}',f'# TYPE {name} counter']
+                lines += [f'{name}{{datacenter="{row["datacenter"]}",service="{row["service"]}"}} {row[key]}' for row in rows]
+            lines += ['# HELP rfsks_fdsn_request_duration_seconds Latency of the FDSN requests',
+                    '# TYPE rfsks_fdsn_request_duration_seconds histogram']
+            for row in rows:
+                labels = f'datacenter="{row["datacenter"]}",service="{row["service"]}"'
+                cumulative = np.cumsum(list(row['latency_buckets'].values()))
+                for le,count in zip(LATENCY_BUCKETS,cumulative):
+                    lines.append(f'rfsks_fdsn_request_duration_seconds_bucket{{{labels},le="{"+Inf" if np.isinf(le) else le}"}} {count}')
+                lines.append(f'rfsks_fdsn_request_duration_seconds_sum{{{labels}}} {row["latency_sum"]}')
+                lines.append(f'rfsks_fdsn_request_duration_seconds_count{{{labels}}} {row["requests"]}')
+            with open(fname+'.tmp','w') as f:
+                f.write("\n".join(lines)+"\n")
+            os.replace(fname+'.tmp',fname)
+        except Exception as exception:
+            self.logger.debug(f"Unable to write the Prometheus textfile {fname}: {exception}")
+        finally:
+            self.write_lock.release()
+
+
+## shared by all the FDSN clients of the process
+telemetry = Telemetry()
+
+
+def instrument(client,datacenter):
+    '''
+    Record the requests of an obspy FDSN client in the telemetry: every service request of the client
+    (dataselect, station, event) goes through its _download method, which is wrapped on the instance
+    '''
+    download = getattr(client,'_download',None)
+    if download is None:
+        return client
+    def metered(url,*args,**kwargs):
+        start = time.monotonic()
+        try:
+            result = download(url,*args,**kwargs)
+        except Exception as exception:
+            telemetry.record(datacenter,service_of(url),time.monotonic()-start,0,request_status(exception))
+            raise
+        if hasattr(result,'getbuffer'):
+            nbytes = result.getbuffer().nbytes
+        else:
+            nbytes = len(result) if isinstance(result,(bytes,str)) else 0
+        telemetry.record(datacenter,service_of(url),time.monotonic()-start,nbytes)
+        return result
+    client._download = metered
+    client.datacenter = datacenter
+    return client
@@ -0,0 +1,129 @@
+import os
+import threading
+import logging
+from functools import lru_cache
+import numpy as np
+from obspy.taup import TauPyModel
+
+## Tables already loaded in this process, keyed by (model, phase, ddist, ddepth)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def taup_model(model='iasp91'):
+    '''
+    Shared TauPyModel instance (loading the model is slow)
+    '''
+    return TauPyModel(model)
+
+
+def first_arrival(phase,distance,depth,model='iasp91'):
+    '''
+    Onset time, incidence angle and ray parameter (s/deg) of the first arrival of the phase,
+    NaNs if the phase does not exist at that distance
+    '''
+    arrivals = taup_model(model).get_travel_times(source_depth_in_km=float(depth),distance_in_degree=float(distance),phase_list=[phase])
+    if not len(arrivals):
+        return np.nan, np.nan, np.nan
+    return arrivals[0].time, arrivals[0].incident_angle, arrivals[0].ray_param_sec_degree
+
+
+class TravelTimeTable:
+    '''
+    Onset time, incidence angle and ray parameter of one phase on a regular (distance, depth) grid,
+    interpolated bilinearly for any number of event-station pairs
+    '''
+    keys = ('time','incident_angle','ray_param')
+
+    def __init__(self,phase='P',model='iasp91',mindist=25,maxdist=125,ddist=0.5,maxdepth=700,ddepth=20):
+        self.logger = logging.getLogger(__name__)
+        self.phase = phase
+        self.model = model
+        self.distances = np.arange(float(mindist),float(maxdist)+ddist/2,float(ddist))
+        self.depths = np.arange(0,float(maxdepth)+ddepth/2,float(ddepth))
+        self.grids = {}
+
+    def filename(self,tabledir):
+        return os.path.join(tabledir,f"ttable-{self.model}-{self.phase}-{self.distances[0]:g}-{self.distances[-1]:g}-{self.distances[1]-self.distances[0]:g}-{self.depths[-1]:g}-{self.depths[1]-self.depths[0]:g}.npz")
+
+    def build(self):
+        self.logger.info(f"Computing {self.model} travel time table for {self.phase} ({len(self.distances)}x{len(self.depths)} nodes)")
+        shape = (len(self.distances),len(self.depths))
+        for key in self.keys:
+            self.grids[key] = np.full(shape,np.nan)
+        for i,dist in enumerate(self.distances):
+            for j,depth in enumerate(self.depths):
+                values = first_arrival(self.phase,dist,depth,model=self.model)
+                for key,val in zip(self.keys,values):
+                    self.grids[key][i,j] = val
+
+    def save(self,tabledir):
+        np.savez(self.filename(tabledir),distances=self.distances,depths=self.depths,**self.grids)
+
+    def load(self,tabledir):
+        tablefile = self.filename(tabledir)
+        if not os.path.exists(tablefile):
+            return False
+        with np.load(tablefile) as data:
+            self.distances = data['distances']
+            self.depths = data['depths']
+            self.grids = {key: data[key] for key in self.keys}
+        return True
+
+    def lookup(self,distances,depths):
+        '''
+        Interpolate the table at the given epicentral distances (deg) and event depths (km).
+        Returns a dict of arrays; NaN outside the grid or where the phase does not exist
+        '''
+        dist = np.atleast_1d(np.asarray(distances,dtype=float))
+        dep = np.clip(np.atleast_1d(np.asarray(depths,dtype=float)),0,None)
+        ndist, ndep = len(self.distances), len(self.depths)
+        fi = (dist-self.distances[0])/(self.distances[1]-self.distances[0])
+        fj = (dep-self.depths[0])/(self.depths[1]-self.depths[0])
+        inside = (fi >= 0) & (fi <= ndist-1) & (fj >= 0) & (fj <= ndep-1)
+        i0 = np.clip(np.floor(fi).astype(int),0,ndist-2)
+        j0 = np.clip(np.floor(fj).astype(int),0,ndep-2)
+        wi, wj = fi-i0, fj-j0
+        values = {}
+        for key in self.keys:
+            grid = self.grids[key]
+            val = (grid[i0,j0]*(1-wi)*(1-wj) + grid[i0+1,j0]*wi*(1-wj)
+                    + grid[i0,j0+1]*(1-wi)*wj + grid[i0+1,j0+1]*wi*wj)
+            val[~inside] = np.nan
+            values[key] = val
+        return values
+
+
+def get_table(phase='P',model='iasp91',tabledir=None,**kwargs):
+    '''
+    Return the travel time table of the phase, loading it from tabledir or computing
+    (and saving) it on first use
+    '''
+    table = TravelTimeTable(phase=phase,model=model,**kwargs)
+    key = (model,phase,table.filename(""))
+    with _tables_lock:
+        if key in _tables:
+            return _tables[key]
+        if not (tabledir and table.load(tabledir)):
+            table.build()
+            if tabledir:
+                os.makedirs(tabledir,exist_ok=True)
+                table.save(tabledir)
+        _tables[key] = table
+    return table
+
+
+def arrivals_for_events(phase,distances,depths,model='iasp91',tabledir=None,**kwargs):
+    '''
+    Onset times, incidence angles and ray parameters for arrays of event-station distances and depths.
+    Pairs the table cannot interpolate are computed directly with TauP
+    '''
+    values = get_table(phase=phase,model=model,tabledir=tabledir,**kwargs).lookup(distances,depths)
+    dist = np.atleast_1d(np.asarray(distances,dtype=float))
+    dep = np.atleast_1d(np.asarray(depths,dtype=float))
+    for idx in np.flatnonzero(np.isnan(values['time'])):
+        direct = first_arrival(phase,dist[idx],dep[idx],model=model)
+        for key,val in zip(TravelTimeTable.keys,direct):
+            values[key][idx] = val
+    return values
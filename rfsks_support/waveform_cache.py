@@ -0,0 +1,170 @@
+import os
+import io
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+from obspy import read, Stream
+from obspy import UTCDateTime as UTC
+from rfsks_support.other_support import timed_call
+
+
+class WaveformCache:
+    '''
+    On-disk cache of the raw waveforms, shared between projects and reruns.
+    Each requested (net, stn, loc, cha, start, end) window is stored once as miniSEED, the file being named
+    after the hash of its content, and indexed in an SQLite table. Any window inside a cached one is served
+    from disk. The least recently used windows are evicted once the cache exceeds max_size_gb.
+    miniSEED does not keep the instrument response: the streams served from the cache have no response attached.
+    '''
+    def __init__(self,cachedir,max_size_gb=20):
+        self.logger = logging.getLogger(__name__)
+        self.cachedir = os.path.expanduser(str(cachedir))
+        self.max_bytes = int(float(max_size_gb)*1024**3)
+        self.lock = threading.Lock()
+        os.makedirs(self.cachedir,exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.cachedir,'index.sqlite'),check_same_thread=False,timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS windows (
+                net TEXT, stn TEXT, loc TEXT, cha TEXT, starttime REAL, endtime REAL,
+                digest TEXT, nbytes INTEGER, last_access REAL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS windows_nslc ON windows (net, stn, loc, cha, starttime)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS windows_digest ON windows (digest)')
+        ## running size of the cached files, updated on insert and delete
+        self.total = self.size()
+
+    def path(self,digest):
+        return os.path.join(self.cachedir,digest[:2],digest+'.mseed')
+
+    def get(self,net,stn,loc,cha,t1,t2):
+        '''
+        Stream of the channels (comma separated cha) between t1 and t2 if all of them are cached, None otherwise
+        '''
+        t1, t2 = UTC(t1), UTC(t2)
+        found = []
+        with self.lock:
+            for ch in cha.split(","):
+                row = self.conn.execute('''SELECT rowid, digest FROM windows WHERE net=? AND stn=? AND loc=? AND cha=?
+                    AND starttime<=? AND endtime>=? ORDER BY endtime-starttime LIMIT 1''',
+                    (str(net),str(stn),str(loc),ch.strip(),t1.timestamp,t2.timestamp)).fetchone()
+                if row is None:
+                    return None
+                found.append(row)
+            with self.conn:
+                self.conn.executemany('UPDATE windows SET last_access=? WHERE rowid=?',[(time.time(),rowid) for rowid,_ in found])
+        st = Stream()
+        for _,digest in found:
+            try:
+                st += read(self.path(digest),format='MSEED',starttime=t1,endtime=t2)
+            except Exception as exception:
+                self.logger.warning(f"Unreadable cache file {self.path(digest)}: {exception}")
+                self.discard(digest)
+                return None
+        return st
+
+    def put(self,net,stn,loc,cha,t1,t2,st):
+        '''
+        Store the traces of each channel returned for the request window t1-t2 (an empty channel is not stored)
+        '''
+        t1, t2 = UTC(t1), UTC(t2)
+        rows = []
+        for ch in cha.split(","):
+            sel = st.select(network=net,station=stn,channel=ch.strip()).split()
+            if not len(sel):
+                continue
+            buf = io.BytesIO()
+            sel.write(buf,format='MSEED')
+            data = buf.getvalue()
+            digest = hashlib.sha1(data).hexdigest()
+            fname = self.path(digest)
+            if not os.path.exists(fname):
+                os.makedirs(os.path.dirname(fname),exist_ok=True)
+                tmpname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmpname,'wb') as fout:
+                    fout.write(data)
+                os.replace(tmpname,fname)
+            rows.append((str(net),str(stn),str(loc),ch.strip(),t1.timestamp,t2.timestamp,digest,len(data),time.time()))
+        if rows:
+            with self.lock, self.conn:
+                for row in rows:
+                    if self.conn.execute('SELECT 1 FROM windows WHERE digest=? LIMIT 1',(row[6],)).fetchone() is None:
+                        self.total += row[7]
+                self.conn.executemany('INSERT INTO windows VALUES (?,?,?,?,?,?,?,?,?)',rows)
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(nbytes),0) FROM (SELECT DISTINCT digest, nbytes FROM windows)').fetchone()[0]
+
+    def discard(self,digest):
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT nbytes FROM windows WHERE digest=? LIMIT 1',(digest,)).fetchone()
+            if row is not None:
+                self.total -= row[0]
+            self.conn.execute('DELETE FROM windows WHERE digest=?',(digest,))
+        if os.path.exists(self.path(digest)):
+            os.remove(self.path(digest))
+
+    def evict(self):
+        '''
+        Remove the least recently used windows until the cache is below 90% of its maximum size.
+        Called by put once the running size goes over the maximum, the exact size being recomputed here
+        '''
+        ## the files may also have been added or removed by another process sharing the cache
+        self.total = total = self.size()
+        if total <= self.max_bytes:
+            return
+        with self.lock:
+            rows = self.conn.execute('SELECT digest, nbytes, MAX(last_access) AS last FROM windows GROUP BY digest ORDER BY last').fetchall()
+        removed = 0
+        for digest,nbytes,_ in rows:
+            if total <= 0.9*self.max_bytes:
+                break
+            self.discard(digest)
+            total -= nbytes
+            removed += 1
+        self.logger.info(f"Waveform cache: evicted {removed} files, {total/1024**2:.1f} MB left")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def cached_waveforms(client,cache,net,stn,loc,cha,t1,t2,attach_response=False,timeout=None,slot=None):
+    '''
+    get_waveforms through the cache: the window is read from disk if cached, else downloaded and stored.
+    Returns the stream and whether it came entirely from the cache: the locations missing from the cache are
+    downloaded and merged with the cached ones. Local sources are read directly.
+    slot is the semaphore of the datacenter, held only while a request is sent (see timed_call)
+    '''
+    if getattr(client,'local',False):
+        cache = None
+    ## a request of several locations ("00,--") is cached per location
+    locations = ["" if val == "--" else val for val in loc.split(",")]
+    cached = Stream()
+    missing = locations
+    if cache is not None:
+        missing = []
+        for location in locations:
+            sub = cache.get(net,stn,location,cha,t1,t2)
+            if sub is None:
+                missing.append(location)
+            else:
+                cached += sub
+        if not missing:
+            return cached, True
+    ## only the locations not (fully) cached are requested
+    request = loc if len(missing) == len(locations) else ",".join(val if val else "--" for val in missing)
+    st = timed_call(timeout, client.get_waveforms, net, stn, request, cha, t1, t2,attach_response=attach_response,slot=slot)
+    if cache is not None:
+        try:
+            for location in missing:
+                cache.put(net,stn,location,cha,t1,t2,st.select(location=location))
+        except Exception as exception:
+            logging.getLogger(__name__).warning(f"Could not cache {net}-{stn} {t1}: {exception}")
+        st += cached
+    return st, False
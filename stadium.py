@@ -19,7 +19,8 @@ import time
 
 
 
-def main():
+def main(first_run=True):
+    ## the later runs of the watch mode never start fresh (no prompt, the results are kept)
     with open('input_file.yaml') as f:
         inp = yaml.load(f, Loader=yaml.FullLoader)
 
@@ -42,7 +43,7 @@ def main():
 
 
     ## Input parameters  ## General
-    fresh_start=int(inp['fresh_start'])       #0/1
+    fresh_start=int(inp['fresh_start']) if first_run else 0       #0/1
     mnlong,mxlong=float(inp['mnlong']),float(inp['mxlong'])   #min and max longitude 
     mnlat,mxlat=float(inp['mnlat']),float(inp['mxlat'])   #min and max latitude 
     client=inp_step['data_settings']['client'].split(",")   #client name to retrieve the data
@@ -176,15 +177,28 @@ def main():
     #####################                 #######################
     #############################################################
     #############################################################
+    shared_metadata = int((inp_step.get('download_settings') or {}).get('shared_metadata',0))
+    incremental = int((inp_step.get('download_settings') or {}).get('incremental',0))
+    shared_metadata = makeRF and makeSKS and shared_metadata and int(inp_step['rf_stepwise']['obtain_inventory_RF']) and int(inp_step['sks_stepwise']['obtain_inventory_SKS'])
+    ## one downloadDataclass per method, shared by the metadata and waveform stages (SKS uses the RF inventory table if shared)
+    logger.info("#Initializing the downloadDataclass")
+    rf_data, sks_data = None, None
+    if makeRF:
+        rf_data=downloadDataclass(inventoryfile=invRFfile,inventorytxtfile=RFsta,client=client,minlongitude=mnlong,maxlongitude=mxlong,minlatitude=mnlat,maxlatitude=mxlat,fig_frmt=fig_frmt,method='RF',channel=channel,tmpdir=str(dirs.loc['tmpdir','DIR_NAME']))
+    if makeSKS:
+        sks_data=downloadDataclass(inventoryfile=invSKSfile,inventorytxtfile=SKSsta,client=client,minlongitude=mnlong,maxlongitude=mxlong,minlatitude=mnlat,maxlatitude=mxlat,fig_frmt=fig_frmt,method='SKS',channel=channel,tmpdir=str(dirs.loc['tmpdir','DIR_NAME']),inventory_source=rf_data if shared_metadata else None)
+    if shared_metadata:
+        logger.info("\n")
+        logger.info("OBTAINING THE SHARED RF/SKS INVENTORY AND EVENTS")
+        oss.obtain_shared_inventory_events([rf_data,sks_data],[str(dirs.loc['RFinfoloc','DIR_NAME']),str(dirs.loc['SKSinfoloc','DIR_NAME'])],[(minmagnitudeRF,maxmagnitudeRF),(minmagnitudeSKS,maxmagnitudeSKS)],network,station)
+
     if makeRF:
         logger.info("\n")
         logger.info("WORKING ON RF")
-        logger.info("#Initializing the downloadDataclass")
         sum_sup_class.write_strings("####")
         sum_sup_class.write_strings("--> RECEIVER FUNCTIONS PART:")
         sum_sup_class.write_strings("####")
 
-        rf_data=downloadDataclass(inventoryfile=invRFfile,inventorytxtfile=RFsta,client=client,minlongitude=mnlong,maxlongitude=mxlong,minlatitude=mnlat,maxlatitude=mxlat,fig_frmt=fig_frmt,method='RF',channel=channel)
         catalogxmlloc = str(dirs.loc['RFinfoloc','DIR_NAME'])
         ## Obtain inventory and events info
         if int(inp_step['rf_stepwise']['obtain_inventory_RF']):
@@ -209,7 +223,7 @@ def main():
         
 
             retrived_stn_file = str(dirs.loc['RFinfoloc','DIR_NAME'])+str(inpRFdict['filenames']['retr_stations'])
-            if not os.path.exists(retrived_stn_file):
+            if not os.path.exists(retrived_stn_file) or rf_data.retry_failed_only or rf_data.incremental:
                 logger.info(f"{retrived_stn_file} does not exist...obtaining events catalog..")
                 catalogloc = str(dirs.loc['RFinfoloc','DIR_NAME'])
                 dest_map=str(dirs.loc['RFstaevnloc','DIR_NAME'])
@@ -225,7 +239,7 @@ def main():
             RFsta_path = "/".join(RFsta.split("/")[0:-1])
             RFsta_prex = RFsta.split("/")[-1].split(".")[0]
             full_RFsta_path = f"{RFsta_path}/{RFsta_prex}_combined.txt"
-            plot_events_map_all(all_stations_file = str(dirs.loc['RFinfoloc','DIR_NAME'])+str(inpRFdict['filenames']['retr_stations']))
+            plot_events_map_all(all_stations_file = str(dirs.loc['RFinfoloc','DIR_NAME'])+str(inpRFdict['filenames']['retr_stations']),ledgerfile=str(dirs.loc['tmpdir','DIR_NAME'])+'download_ledger.sqlite')
             plot_station_map_all(retr_stationsfile = str(dirs.loc['RFinfoloc','DIR_NAME'])+str(inpRFdict['filenames']['retr_stations']),all_stationsfile=full_RFsta_path)
         
         if len(glob.glob(datafileloc+"*.h5"))>0:
@@ -236,7 +250,7 @@ def main():
                     try:
                         logger.info("\n")
                         logger.info("## Computing RF")
-                        rfs.compute_rf(dataRFfileloc)
+                        rfs.compute_rf(dataRFfileloc,incremental=incremental)
                         logger.info("\n")
                         logger.info("## Operating plot_RF method")
                         rfs.plot_RF(dataRFfileloc,destImg=str(dirs.loc['RFplotloc','DIR_NAME']))
@@ -289,13 +303,10 @@ def main():
 
         logger.info("\n")
         logger.info("WORKING ON SKS")
-        logger.info("# Initializing the downloadDataclass")
         sum_sup_class.write_strings("####")
         sum_sup_class.write_strings("--> SHEAR-WAVE SPLITTING PART:")
         sum_sup_class.write_strings("####")
 
-        sks_data=downloadDataclass(inventoryfile=invSKSfile,inventorytxtfile=SKSsta,client=client,minlongitude=mnlong,maxlongitude=mxlong,minlatitude=mnlat,maxlatitude=mxlat,fig_frmt=fig_frmt,method='SKS',channel=channel)
-
         catalogxmlloc=str(dirs.loc['SKSinfoloc','DIR_NAME'])
 
 
@@ -319,7 +330,7 @@ def main():
                 sum_sup_class.write_data_summary(SKSsta)
 
             retrived_stn_file = str(dirs.loc['SKSinfoloc','DIR_NAME'])+str(inpSKSdict['filenames']['retr_stations'])
-            if not os.path.exists(retrived_stn_file):
+            if not os.path.exists(retrived_stn_file) or sks_data.retry_failed_only or sks_data.incremental:
                 logger.info(f"{retrived_stn_file} does not exist...obtaining inventory!")
                 catalogloc = str(dirs.loc['SKSinfoloc','DIR_NAME'])
                 dest_map=str(dirs.loc['SKSstaevnloc','DIR_NAME'])
@@ -334,7 +345,7 @@ def main():
             SKSsta_prex = SKSsta.split("/")[-1].split(".")[0]
             full_SKSsta_path = f"{SKSsta_path}/{SKSsta_prex}_combined.txt"
             # all_station_file = str(dirs.loc['SKSinfoloc','DIR_NAME'])+str(inpSKSdict['filenames']['SKSsta'])
-            plot_events_map_all(all_stations_file = str(dirs.loc['SKSinfoloc','DIR_NAME'])+str(inpSKSdict['filenames']['retr_stations']))
+            plot_events_map_all(all_stations_file = str(dirs.loc['SKSinfoloc','DIR_NAME'])+str(inpSKSdict['filenames']['retr_stations']),ledgerfile=str(dirs.loc['tmpdir','DIR_NAME'])+'download_ledger.sqlite')
             plot_station_map_all(retr_stationsfile = str(dirs.loc['SKSinfoloc','DIR_NAME'])+str(inpSKSdict['filenames']['retr_stations']),all_stationsfile=full_SKSsta_path)
 
         if len(glob.glob(datafileloc+"*.h5"))>0:
@@ -351,7 +362,7 @@ def main():
                 logger.info("## SKS-measurements")
                 plot_measure_loc = str(dirs.loc['SKSplot_measure_loc','DIR_NAME']) if plot_SKS_measure else None
                 sksMeasure = skss.sks_measurements(plot_measure_loc=plot_measure_loc)
-                sksMeasure.SKScalc(str(dirs.loc['SKSdatafileloc','DIR_NAME']),trace_loc_ENZ,trace_loc_RTZ,trigger_loc,method = str(inpSKSdict['sks_picking']['picking_algo']['sks_picking_algo']))
+                sksMeasure.SKScalc(str(dirs.loc['SKSdatafileloc','DIR_NAME']),trace_loc_ENZ,trace_loc_RTZ,trigger_loc,method = str(inpSKSdict['sks_picking']['picking_algo']['sks_picking_algo']),incremental=incremental)
                 
                 sum_sup_class.write_sks_meas_sum(measure_loc = plot_measure_loc,trace_loc_ENZ=trace_loc_ENZ,trace_loc_RTZ=trace_loc_RTZ,trigger_loc=trigger_loc)
                 
@@ -365,5 +376,13 @@ def main():
         
     sum_sup_class.close_sumfile()
 if __name__ == '__main__':
+    with open('Settings/stepwise.yaml') as f:
+        dl_settings = yaml.load(f, Loader=yaml.FullLoader).get('download_settings') or {}
     main()
+    ## watch mode: run the incremental pipeline again every watch_interval hours
+    watch_interval = float(dl_settings.get('watch_interval',0) or 0)
+    while watch_interval > 0 and int(dl_settings.get('incremental',0)):
+        print(f"\nNext incremental run in {watch_interval} h")
+        time.sleep(watch_interval*3600)
+        main(first_run=False)
 
@@ -0,0 +1,35 @@
+from rfsks_support.bulk_download import plan_bulk_requests, bulk_lines
+
+
+def window(net, stn, evtime, **kwargs):
+    return dict(net=net, stn=stn, evtime=evtime, t1=0, t2=1, **kwargs)
+
+
+def test_station_groups_are_split_in_chunks():
+    windows = [window('XX', 'A', f'2020-01-0{i}') for i in range(1, 6)] + [window('XX', 'B', '2020-01-01')]
+    chunks = plan_bulk_requests(windows, group_by='station', max_size=2)
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1, 1]
+    assert all(len({(win['net'], win['stn']) for win in chunk}) == 1 for chunk in chunks)
+
+
+def test_event_groups_are_split_per_network():
+    windows = [window('XX', 'A', '2020-01-01'), window('YY', 'B', '2020-01-01'),
+               window('XX', 'C', '2020-01-01'), window('XX', 'A', '2020-01-02')]
+    chunks = plan_bulk_requests(windows, group_by='event', max_size=50)
+    assert sorted((chunk[0]['evtime'], chunk[0]['net'], len(chunk)) for chunk in chunks) == \
+        [('2020-01-01', 'XX', 2), ('2020-01-01', 'YY', 1), ('2020-01-02', 'XX', 1)]
+
+
+def test_max_size_is_at_least_one():
+    windows = [window('XX', 'A', f'2020-01-0{i}') for i in range(1, 4)]
+    assert len(plan_bulk_requests(windows, group_by='station', max_size=0)) == 3
+
+
+def test_bulk_lines_use_the_window_channels_and_locations():
+    windows = [window('XX', 'A', '2020-01-01', cha='HHE,HHN,HHZ', locations=['00']),
+               window('XX', 'B', '2020-01-01')]
+    assert [line[:4] for line in bulk_lines(windows, loc='')] == \
+        [('XX', 'B', '--', 'BHE'), ('XX', 'B', '--', 'BHN'), ('XX', 'B', '--', 'BHZ')]
+    assert [line[:4] for line in bulk_lines(windows, loc='00')] == \
+        [('XX', 'A', '00', 'HHE'), ('XX', 'A', '00', 'HHN'), ('XX', 'A', '00', 'HHZ'),
+         ('XX', 'B', '00', 'BHE'), ('XX', 'B', '00', 'BHN'), ('XX', 'B', '00', 'BHZ')]
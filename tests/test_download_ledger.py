@@ -0,0 +1,50 @@
+from rfsks_support.download_ledger import DownloadLedger, OK, NODATA, TIMEOUT, LOWSNR, UNAVAILABLE
+
+
+def window(evtime, stn='A'):
+    return dict(net='XX', stn=stn, evtime=evtime, elat=10.0, elon=20.0, evdp=10.0, em=6.0, emt='Mww')
+
+
+def attempt(client, status):
+    return {'client': client, 'location': '', 'status': status, 'nbytes': 100 if status == OK else 0, 'latency': 1.0, 'message': ''}
+
+
+def test_last_status_of_each_event():
+    ledger = DownloadLedger()
+    ledger.record_event('RF', window('2020-01-01'), TIMEOUT, [attempt('IRIS', TIMEOUT)])
+    ledger.record_event('RF', window('2020-01-01'), OK, [attempt('IRIS', OK)], client='IRIS', location='')
+    ledger.record_event('RF', window('2020-01-02'), NODATA, [attempt('IRIS', NODATA)])
+    ledger.record_event('RF', window('2020-01-03'), LOWSNR, [attempt('IRIS', OK)])
+    assert ledger.event_status('RF', 'XX', 'A') == {'2020-01-01': OK, '2020-01-02': NODATA, '2020-01-03': LOWSNR}
+    assert ledger.event_status('SKS', 'XX', 'A') == {}
+    assert ledger.has_failed('RF', 'XX', 'A')
+    assert ledger.status_counts('RF') == {OK: 1, NODATA: 1, LOWSNR: 1}
+
+
+def test_retrieved_stations_and_events():
+    ledger = DownloadLedger()
+    ledger.record_event('RF', window('2020-01-01'), OK, [attempt('IRIS', OK)], client='IRIS', location='00')
+    ledger.record_event('RF', window('2020-01-01', stn='B'), NODATA, [attempt('IRIS', NODATA)])
+    assert ledger.retrieved_stations('RF') == ['XX_A']
+    assert list(ledger.available_events('RF', 'XX', 'A')['client']) == ['IRIS']
+    assert not ledger.has_failed('RF', 'XX', 'A')
+
+
+def test_prefilter_attempts_are_not_in_the_client_history():
+    ledger = DownloadLedger()
+    ledger.record_event('RF', window('2020-01-01'), NODATA, [attempt('IRIS', UNAVAILABLE), attempt('GFZ', UNAVAILABLE)])
+    ledger.record_event('RF', window('2020-01-02'), OK, [attempt('IRIS', OK)], client='IRIS', location='')
+    assert [row[:4] for row in ledger.client_history()] == [('XX', 'IRIS', OK, 1)]
+    assert ledger.throughput() == (1, 100, 1.0)
+
+
+def test_ledger_is_kept_between_runs(tmp_path):
+    dbfile = str(tmp_path/'download_ledger.sqlite')
+    ledger = DownloadLedger(dbfile)
+    ledger.record_event('RF', window('2020-01-01'), OK, [attempt('IRIS', OK)], client='IRIS', location='')
+    ledger.set_catalog_cutoff('RF', 'XX', 'A', 'XX.A.2000', '2020-02-01T00:00:00')
+    ledger.close()
+    ledger = DownloadLedger(dbfile)
+    assert ledger.event_status('RF', 'XX', 'A') == {'2020-01-01': OK}
+    assert str(ledger.catalog_cutoff('RF', 'XX.A.2000')).startswith('2020-02-01')
+    assert ledger.catalog_cutoff('RF', 'XX.B.2000') is None
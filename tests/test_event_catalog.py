@@ -0,0 +1,42 @@
+import pandas as pd
+from rfsks_support.event_catalog import merge_catalogs, duplicate_groups
+
+
+def table(provider, rows):
+    df = pd.DataFrame(rows, columns=['evid', 'evtime', 'evlat', 'evlon', 'evdp', 'evmg', 'evmgtp'])
+    df['provider'] = provider
+    return df
+
+
+IRIS = table('IRIS', [('iris1', '2020-01-01T00:00:00', 10.0, 20.0, 10.0, 6.0, 'Mww'),
+                      ('iris2', '2020-01-02T00:00:00', -30.0, 70.0, 35.0, 5.8, 'Mww')])
+USGS = table('USGS', [('usgs1', '2020-01-01T00:00:05', 10.2, 20.1, 12.0, 6.1, 'mb'),
+                      ('usgs2', '2020-01-03T00:00:00', 45.0, 150.0, 20.0, 6.5, 'Mww')])
+
+
+def test_duplicates_are_grouped_within_the_tolerances():
+    groups = duplicate_groups(['2020-01-01T00:00:00', '2020-01-01T00:00:10', '2020-01-01T00:00:40'],
+                              [10.0, 10.5, 10.0], [20.0, 20.0, 20.0], seconds=16, km=100)
+    assert groups[0] == groups[1] != groups[2]
+
+
+def test_duplicates_across_time_cells_are_grouped():
+    ## 15 s apart, on both sides of a 16 s cell boundary
+    groups = duplicate_groups(['2020-01-01T00:00:10', '2020-01-01T00:00:25'], [0.0, 0.0], [0.0, 0.0], seconds=16, km=100)
+    assert groups[0] == groups[1]
+
+
+def test_merge_keeps_the_event_of_the_first_provider():
+    merged = merge_catalogs([USGS, IRIS], ['IRIS', 'USGS'])
+    assert sorted(merged['evid']) == ['iris1', 'iris2', 'usgs2']
+    assert merged.set_index('evid').loc['iris1', 'evmg'] == 6.0
+
+
+def test_merge_replaces_the_known_events():
+    known = table('IRIS', [('old1', '2020-01-01T00:00:02', 10.1, 20.0, 10.0, 6.0, 'Mww')])
+    merged = merge_catalogs([USGS, IRIS], ['IRIS', 'USGS'], known=known)
+    assert sorted(merged['evid']) == ['iris2', 'old1', 'usgs2']
+
+
+def test_merge_of_no_event():
+    assert not merge_catalogs([], ['IRIS']).shape[0]
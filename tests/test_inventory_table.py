@@ -0,0 +1,40 @@
+import pandas as pd
+from rfsks_support.inventory_table import InventoryTable, ChannelSelector
+
+
+def inventory_table(channels):
+    rows = [('XX', stn, loc, band+comp, 0.0, 0.0, start, end, rate)
+            for stn, loc, band, rate, start, end in channels for comp in 'ENZ']
+    return InventoryTable(pd.DataFrame(columns=InventoryTable.station_columns),
+                          pd.DataFrame(rows, columns=InventoryTable.channel_columns))
+
+
+def test_lowest_rate_band_above_the_minimum():
+    table = inventory_table([('A', '', 'BH', 40.0, '2000-01-01', ''), ('A', '', 'HH', 100.0, '2000-01-01', '')])
+    selector = ChannelSelector(table, bands=['BH', 'HH'], min_rate=20)
+    assert selector.select('XX', 'A', '2020-01-01') == ('BHE,BHN,BHZ', [''])
+    selector = ChannelSelector(table, bands=['BH', 'HH'], min_rate=50)
+    assert selector.select('XX', 'A', '2020-01-01') == ('HHE,HHN,HHZ', [''])
+
+
+def test_band_of_the_station_epoch():
+    table = inventory_table([('A', '', 'BH', 20.0, '2000-01-01', '2010-01-01'), ('A', '', 'HH', 100.0, '2010-01-01', '')])
+    selector = ChannelSelector(table, bands=['BH', 'HH'], min_rate=20)
+    assert selector.select('XX', 'A', '2005-01-01')[0] == 'BHE,BHN,BHZ'
+    assert selector.select('XX', 'A', '2015-01-01')[0] == 'HHE,HHN,HHZ'
+
+
+def test_default_channels_without_a_complete_band():
+    table = inventory_table([('A', '', 'BH', 20.0, '2000-01-01', '')])
+    table.channels = table.channels[table.channels['cha'] != 'BHN']
+    selector = ChannelSelector(table, bands=['BH', 'HH'], default='BHE,BHN,BHZ')
+    assert selector.select('XX', 'A', '2020-01-01', ['', '00']) == ('BHE,BHN,BHZ', ['', '00'])
+    assert selector.select('XX', 'B', '2020-01-01') == ('BHE,BHN,BHZ', [''])
+
+
+def test_band_is_only_requested_at_its_locations():
+    table = inventory_table([('A', '00', 'HH', 100.0, '2000-01-01', ''), ('A', '10', 'HH', 100.0, '2000-01-01', ''),
+                             ('A', '', 'BH', 20.0, '2000-01-01', '')])
+    selector = ChannelSelector(table, bands=['BH', 'HH'], min_rate=20)
+    assert selector.select('XX', 'A', '2020-01-01', ['00', '', '10']) == ('HHE,HHN,HHZ', ['00', '10'])
+    assert selector.select('XX', 'A', '2020-01-01', ['', '00']) == ('BHE,BHN,BHZ', [''])
@@ -0,0 +1,44 @@
+import numpy as np
+from obspy import Trace, Stream
+from obspy import UTCDateTime as UTC
+from rfsks_support.waveform_cache import WaveformCache
+
+T0 = UTC('2020-01-01T00:00:00')
+
+
+def stream(stn, seed, npts=2000):
+    data = np.random.RandomState(seed).randint(-1000, 1000, npts).astype(np.int32)
+    return Stream([Trace(data=data, header={'network': 'XX', 'station': stn, 'location': '', 'channel': 'BHZ',
+                                            'sampling_rate': 20.0, 'starttime': T0})])
+
+
+def test_windows_inside_a_cached_window_are_served(tmp_path):
+    cache = WaveformCache(tmp_path, max_size_gb=1)
+    cache.put('XX', 'A', '', 'BHZ', T0, T0+99, stream('A', 0))
+    st = cache.get('XX', 'A', '', 'BHZ', T0+10, T0+50)
+    assert len(st) == 1 and st[0].stats.starttime == T0+10
+    assert cache.get('XX', 'A', '', 'BHZ', T0+10, T0+200) is None
+    assert cache.get('XX', 'A', '', 'BHZ,BHN', T0+10, T0+50) is None
+
+
+def test_least_recently_used_windows_are_evicted(tmp_path):
+    cache = WaveformCache(tmp_path, max_size_gb=1)
+    for i, stn in enumerate('ABC'):
+        cache.put('XX', stn, '', 'BHZ', T0, T0+99, stream(stn, i))
+    ## room for three files: A is read again, so B is the least recently used and evicted when D comes in
+    cache.max_bytes = int(cache.size()*1.2)
+    assert cache.get('XX', 'A', '', 'BHZ', T0, T0+99) is not None
+    cache.put('XX', 'D', '', 'BHZ', T0, T0+99, stream('D', 3))
+    assert cache.get('XX', 'B', '', 'BHZ', T0, T0+99) is None
+    assert cache.get('XX', 'A', '', 'BHZ', T0, T0+99) is not None
+    assert cache.get('XX', 'D', '', 'BHZ', T0, T0+99) is not None
+    assert cache.total == cache.size() <= cache.max_bytes
+
+
+def test_running_size_counts_identical_files_once(tmp_path):
+    cache = WaveformCache(tmp_path, max_size_gb=1)
+    cache.put('XX', 'A', '', 'BHZ', T0, T0+99, stream('A', 0))
+    cache.put('XX', 'A', '', 'BHZ', T0, T0+99, stream('A', 0))
+    assert cache.total == cache.size() > 0
+    cache.close()
+    assert WaveformCache(tmp_path, max_size_gb=1).total == cache.total